@@ -0,0 +1,78 @@
+"""
+Memory benchmark: columnar AllocationState against the per-donation dict layout
+
+Run from the root of the repo:
+
+    python -m benchmarks.bench_allocation_memory --donations 1000000
+"""
+from matcher.allocation import RESERVED
+from matcher.allocation_state import AllocationState
+from datetime import datetime
+import argparse
+import random
+import tracemalloc
+
+class DictAllocation(object):
+    """
+    Allocation as it was held in the dict based allocation state
+    """
+
+    def __init__(self, match_fund_id, match_fund_allocation, status):
+        self.match_fund_id = match_fund_id
+        self.match_fund_allocation = match_fund_allocation
+        self.status = status
+
+def make_reservations(count, funds, seed):
+    rng = random.Random(seed)
+    for ix in range(count):
+        amount = round(rng.uniform(5, 500), 2)
+        split = rng.random() < 0.2
+        fund_ids = rng.sample(funds, 2) if split else [rng.choice(funds)]
+        matches = [(fund_id, amount / len(fund_ids)) for fund_id in fund_ids]
+        yield "donation_%s" % ix, amount, 0.0, matches
+
+def build_dict_state(reservations):
+    state = {}
+    for donation_id, amount, unmatched, matches in reservations:
+        state[donation_id] = {
+            'allocations': [DictAllocation(fund_id, allocated, RESERVED) for fund_id, allocated in matches],
+            'created_time': datetime.now(),
+            'updated_time': datetime.now(),
+            'original_donation': amount,
+            'donation_balance_unmatched': unmatched,
+            'overall_status': RESERVED
+        }
+    return state
+
+def build_columnar_state(reservations):
+    state = AllocationState()
+    for donation_id, amount, unmatched, matches in reservations:
+        state.add(donation_id, amount, unmatched, matches, datetime.now())
+    return state
+
+def measure(builder, reservations):
+    tracemalloc.start()
+    state = builder(reservations)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return state, current, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--donations", type=int, default=200000)
+    parser.add_argument("--funds", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    funds = ["fund_%s" % ix for ix in range(args.funds)]
+
+    print("%-10s %14s %14s %12s" % ("store", "retained MiB", "peak MiB", "bytes/don"))
+    for name, builder in (("dict", build_dict_state), ("columnar", build_columnar_state)):
+        reservations = list(make_reservations(args.donations, funds, args.seed))
+        # the donation id strings are shared by both layouts - measure only the store
+        state, current, peak = measure(builder, reservations)
+        print("%-10s %14.1f %14.1f %12.1f" % (name, current / 2 ** 20, peak / 2 ** 20, current / args.donations))
+        del state
+
+if __name__ == "__main__":
+    main()
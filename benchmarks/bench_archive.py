@@ -0,0 +1,98 @@
+"""
+Archival benchmark: a long campaign with and without archiving settled donations
+
+Runs rounds of reservations, settling the previous round's donations (most collected,
+the rest expired) as each round starts; with archival on, donations settled are moved
+to a SQLite archive after every round. Each mode runs in a process of its own and
+reports the reservation latency and the time to list what is still reserved, both
+over the last round, and the resident memory at the end.
+
+    python -m benchmarks.bench_archive --rounds 20 --round-size 50000
+"""
+from matcher.archive import Archive
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher, RESERVED
+from matcher.match_fund import MatchFund
+from datetime import timedelta
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = ("memory", "archive")
+
+def resident_mib():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentile(latencies, share):
+    return sorted(latencies)[int(share * (len(latencies) - 1))]
+
+def child(mode, rounds, round_size, archive_path):
+    rng = random.Random(1)
+    fund_matcher = FundMatcher([MatchFund("fund_%s" % ix, 1e12, ix % 10, [rng.randint(1, 3), 1]) for ix in range(50)])
+    if mode == "archive":
+        fund_matcher.archive = Archive(archive_path, capacity=rounds * round_size)
+
+    previous = []
+    for round_ix in range(rounds):
+        donation_ids = ["donation_%s_%s" % (round_ix, ix) for ix in range(round_size)]
+        amounts = [rng.uniform(5, 500) for _ in donation_ids]
+
+        collected = [donation_id for donation_id in previous if rng.random() < 0.7]
+        fund_matcher.collect_donations(collected)
+        fund_matcher.expire_donations(sorted(set(previous) - set(collected)))
+        if mode == "archive":
+            fund_matcher.archive_settled(timedelta(0))
+
+        latencies = []
+        for donation_id, amount in zip(donation_ids, amounts):
+            start = time.perf_counter()
+            fund_matcher.reserve_funds(Donation(donation_id, amount))
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        reserved = sum(1 for _ in fund_matcher.iter_match_fund_allocations(status=RESERVED))
+        list_seconds = time.perf_counter() - start
+        previous = donation_ids
+
+    print(json.dumps({
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "list_ms": list_seconds * 1e3,
+        "reserved": reserved,
+        "in_memory": len(fund_matcher.allocation_state),
+        "rss_mib": resident_mib()
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--round-size", type=int, default=20000)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "ARCHIVE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.rounds, args.round_size, args.child[1])
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("%-8s %10s %10s %10s %12s %10s" % ("mode", "p50 us", "p99 us", "list ms", "in memory", "RSS MiB"))
+        for mode in MODES:
+            output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_archive", "--rounds", str(args.rounds),
+                                              "--round-size", str(args.round_size),
+                                              "--child", mode, os.path.join(directory, "archive.db")])
+            result = json.loads(output)
+            print("%-8s %10.1f %10.1f %10.1f %12d %10.1f" % (mode, result["p50_us"], result["p99_us"], result["list_ms"],
+                                                             result["in_memory"], result["rss_mib"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Latency benchmark: AsyncFundMatcher micro-batching under many concurrent callers
+
+Each caller reserves a donation and awaits the result. Reports throughput and the
+p50/p99 latency seen by callers for each (max_batch_size, max_delay) setting,
+alongside calling the FundMatcher directly from every coroutine.
+
+    python -m benchmarks.bench_async --callers 20000
+"""
+from matcher.async_fund_matcher import AsyncFundMatcher
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import argparse
+import asyncio
+import random
+import time
+
+def make_funds(count, seed):
+    rng = random.Random(seed)
+    return [MatchFund("fund_%s" % ix, rng.uniform(1000, 100000), rng.randint(0, 100), [rng.randint(1, 3), 1])
+            for ix in range(count)]
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def run(callers, funds, seed, max_batch_size=None, max_delay=None):
+    fund_matcher = FundMatcher(make_funds(funds, seed))
+    rng = random.Random(seed)
+    donations = [Donation("donation_%s" % ix, rng.uniform(5, 500)) for ix in range(callers)]
+
+    if max_batch_size is None:
+        async def reserve(donation):
+            fund_matcher.reserve_funds(donation)
+    else:
+        async_matcher = AsyncFundMatcher(fund_matcher, max_batch_size, max_delay)
+        reserve = async_matcher.reserve
+
+    latencies = []
+
+    async def caller(donation):
+        start = time.perf_counter()
+        await reserve(donation)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[caller(donation) for donation in donations])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return callers / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--callers", type=int, default=20000)
+    parser.add_argument("--funds", type=int, default=500)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 256, 4096])
+    parser.add_argument("--delays", type=float, nargs="+", default=[0.0005, 0.002, 0.01])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%-12s %-10s %12s %10s %10s" % ("batch size", "delay ms", "ops/s", "p50 ms", "p99 ms"))
+    ops, p50, p99 = asyncio.run(run(args.callers, args.funds, args.seed))
+    print("%-12s %-10s %12.0f %10.2f %10.2f" % ("direct", "-", ops, p50 * 1000, p99 * 1000))
+
+    for max_batch_size in args.batch_sizes:
+        for max_delay in args.delays:
+            ops, p50, p99 = asyncio.run(run(args.callers, args.funds, args.seed, max_batch_size, max_delay))
+            print("%-12s %-10s %12.0f %10.2f %10.2f" % (max_batch_size, max_delay * 1000, ops, p50 * 1000, p99 * 1000))
+
+if __name__ == "__main__":
+    main()
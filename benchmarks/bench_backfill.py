@@ -0,0 +1,71 @@
+"""
+Backfill benchmark: incremental backfill against rescanning the reserved donations
+
+The funds run dry part way through the reservations, leaving the later donations
+under-matched; expiries of earlier donations then release capacity a little at a time.
+Incremental backfill matches each release against the queue of under-matched donations;
+the rescan walks every reserved donation after each release looking for ones to top up,
+as a periodic job would. Reports the latency of an expiry with its backfill.
+
+    python -m benchmarks.bench_backfill --donations 10000 100000 --expiries 2000
+"""
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import argparse
+import random
+import time
+
+def percentile(latencies, share):
+    return sorted(latencies)[int(share * (len(latencies) - 1))]
+
+def make_matcher(donations, seed):
+    rng = random.Random(seed)
+    amounts = [rng.uniform(5, 50) for _ in range(donations)]
+    # enough for the first nine tenths of the donations
+    funds = [MatchFund("fund_%s" % ix, sum(amounts) * 0.9 / 20, ix) for ix in range(20)]
+    return FundMatcher(funds), amounts
+
+def rescan(fund_matcher):
+    state = fund_matcher.allocation_state
+    for row in list(state.iter_rows(reserved_only=True)):
+        if state.unmatched(row) == 0:
+            continue
+        matches, donation_balance = fund_matcher._match_amount(state.unmatched(row))
+        if not matches:
+            return
+        state.backfill(row, matches, donation_balance)
+
+def run(donations, expiries, seed, incremental):
+    fund_matcher, amounts = make_matcher(donations, seed)
+    if incremental:
+        fund_matcher.enable_backfill()
+    for ix, amount in enumerate(amounts):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, amount))
+
+    latencies = []
+    for ix in range(expiries):
+        start = time.perf_counter()
+        fund_matcher.expire_donation("donation_%s" % ix)
+        if not incremental:
+            rescan(fund_matcher)
+        latencies.append(time.perf_counter() - start)
+
+    unmatched = sum(doc['donation_balance_unmatched'] for doc in fund_matcher.list_match_fund_allocations())
+    return percentile(latencies, 0.5), percentile(latencies, 0.99), unmatched
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--donations", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--expiries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%-10s %-12s %10s %10s %14s" % ("donations", "mode", "p50 us", "p99 us", "unmatched"))
+    for donations in args.donations:
+        for mode, incremental in (("incremental", True), ("rescan", False)):
+            p50, p99, unmatched = run(donations, args.expiries, args.seed, incremental)
+            print("%-10s %-12s %10.1f %10.1f %14.2f" % (donations, mode, p50 * 1e6, p99 * 1e6, unmatched))
+
+if __name__ == "__main__":
+    main()
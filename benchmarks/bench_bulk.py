@@ -0,0 +1,54 @@
+"""
+Settlement benchmark: bulk collect and expire against one call per donation
+
+Reserves --donations donations, then collects half and expires the other half, either
+one donation at a time or with collect_donations and expire_donations in chunks.
+
+    python -m benchmarks.bench_bulk --donations 200000 --chunk 5000
+"""
+from benchmarks.workload import Workload
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+import argparse
+import time
+
+def build(workload, donations):
+    fund_matcher = FundMatcher(workload.make_funds())
+    fund_matcher.reserve_funds_batch([Donation("donation_%s" % ix, 20) for ix in range(donations)])
+    return fund_matcher
+
+def run_single(fund_matcher, collect_ids, expire_ids, chunk):
+    start = time.perf_counter()
+    for donation_id in collect_ids:
+        fund_matcher.collect_donation(donation_id)
+    for donation_id in expire_ids:
+        fund_matcher.expire_donation(donation_id)
+    return time.perf_counter() - start
+
+def run_bulk(fund_matcher, collect_ids, expire_ids, chunk):
+    start = time.perf_counter()
+    for ix in range(0, len(collect_ids), chunk):
+        fund_matcher.collect_donations(collect_ids[ix:ix + chunk])
+    for ix in range(0, len(expire_ids), chunk):
+        fund_matcher.expire_donations(expire_ids[ix:ix + chunk])
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--donations", type=int, default=200000)
+    parser.add_argument("--funds", type=int, default=200)
+    parser.add_argument("--chunk", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workload = Workload("bulk", funds=args.funds, seed=args.seed, fund_size=(1e5, 1e6))
+    collect_ids = ["donation_%s" % ix for ix in range(0, args.donations, 2)]
+    expire_ids = ["donation_%s" % ix for ix in range(1, args.donations, 2)]
+
+    print("%-8s %14s" % ("mode", "donations/s"))
+    for name, run in (("single", run_single), ("bulk", run_bulk)):
+        elapsed = run(build(workload, args.donations), collect_ids, expire_ids, args.chunk)
+        print("%-8s %14.0f" % (name, args.donations / elapsed))
+
+if __name__ == "__main__":
+    main()
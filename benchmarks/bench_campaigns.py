@@ -0,0 +1,81 @@
+"""
+Scaling benchmark: CampaignRegistry across worker counts
+
+Spreads reservations, with a share of them expired, over many campaigns with funds
+of their own, and sends them to a registry in batches of mixed campaigns. The
+baseline is one FundMatcher per campaign in this process, called one operation at a
+time. Speed-up over the baseline is bounded by the cores the machine has; with
+--max-resident below the campaign count, workers also pay for evicting and reloading.
+
+    python -m benchmarks.bench_campaigns --workers 1 2 4 8 --campaigns 200
+"""
+from matcher.async_fund_matcher import RESERVE, EXPIRE
+from matcher.campaigns import CampaignRegistry, CREATE
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import argparse
+import os
+import random
+import tempfile
+import time
+
+def make_funds(count, rng):
+    return [MatchFund("fund_%s" % ix, rng.uniform(1e6, 1e7), rng.randint(0, 100), [rng.randint(1, 3), 1])
+            for ix in range(count)]
+
+def make_operations(campaigns, operations, expire_share, seed):
+    rng = random.Random(seed)
+    batch = []
+    for ix in range(operations):
+        campaign_id = "campaign_%s" % rng.randrange(campaigns)
+        donation_id = "donation_%s" % ix
+        batch.append((RESERVE, campaign_id, Donation(donation_id, rng.uniform(5, 500))))
+        if rng.random() < expire_share:
+            batch.append((EXPIRE, campaign_id, donation_id))
+    return batch
+
+def run_baseline(creates, operations):
+    fund_matchers = {campaign_id: FundMatcher(match_funds) for _, campaign_id, match_funds in creates}
+    start = time.perf_counter()
+    for operation, campaign_id, argument in operations:
+        if operation == RESERVE:
+            fund_matchers[campaign_id].reserve_funds(argument)
+        else:
+            fund_matchers[campaign_id].expire_donation(argument)
+    return len(operations) / (time.perf_counter() - start)
+
+def run_registry(workers, max_resident, creates, operations, batch_size):
+    with tempfile.TemporaryDirectory() as directory:
+        with CampaignRegistry(directory, workers=workers, max_resident=max_resident) as registry:
+            registry.execute(creates)
+            start = time.perf_counter()
+            for ix in range(0, len(operations), batch_size):
+                registry.execute(operations[ix:ix + batch_size])
+            return len(operations) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--campaigns", type=int, default=200)
+    parser.add_argument("--funds", type=int, default=50)
+    parser.add_argument("--operations", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=2000)
+    parser.add_argument("--max-resident", type=int, default=1000)
+    parser.add_argument("--expire-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    creates = [(CREATE, "campaign_%s" % ix, make_funds(args.funds, rng)) for ix in range(args.campaigns)]
+    operations = make_operations(args.campaigns, args.operations, args.expire_share, args.seed)
+
+    print("%d cores" % os.cpu_count())
+    print("%-10s %12s" % ("workers", "ops/s"))
+    print("%-10s %12.0f" % ("in-process", run_baseline(creates, operations)))
+    for workers in args.workers:
+        print("%-10s %12.0f" % (workers, run_registry(workers, args.max_resident, creates, operations,
+                                                       args.batch_size)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Compaction benchmark: the cost of archive_settled against the number of donations kept
+
+Reserves a hot set of donations that stay reserved, then settles a number of others
+and times one archive_settled moving them to an in-memory archive. Finding the settled
+donations costs in proportion to how many there are; rebuilding the allocation state
+without them costs in proportion to the hot set, which is the figure to watch when
+choosing how often to archive.
+
+    python -m benchmarks.bench_compaction --hot 10000 100000 1000000 --settled 100 10000
+"""
+from matcher.archive import Archive
+from matcher.allocation_state import to_timestamp
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from datetime import datetime, timedelta
+import argparse
+import random
+import time
+
+def make_matcher(hot, settled, seed):
+    rng = random.Random(seed)
+    fund_matcher = FundMatcher([MatchFund("fund_%s" % ix, 1e12, ix % 10, [rng.randint(1, 3), 1]) for ix in range(20)])
+    fund_matcher.archive = Archive(":memory:", capacity=settled)
+
+    settled_ids = ["settled_%s" % ix for ix in range(settled)]
+    for donation_id in settled_ids:
+        fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 500)))
+    for ix in range(hot):
+        fund_matcher.reserve_funds(Donation("hot_%s" % ix, rng.uniform(5, 500)))
+    fund_matcher.collect_donations(settled_ids)
+    return fund_matcher
+
+def run(hot, settled, seed):
+    fund_matcher = make_matcher(hot, settled, seed)
+
+    start = time.perf_counter()
+    found = sum(1 for _ in fund_matcher.allocation_state.iter_settled_rows(to_timestamp(datetime.now())))
+    find_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    archived = fund_matcher.archive_settled(timedelta(0))
+    total_seconds = time.perf_counter() - start
+
+    assert found == archived == settled
+    return find_seconds, total_seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hot", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--settled", type=int, nargs="+", default=[100, 10000])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%-10s %-10s %10s %12s" % ("hot", "settled", "find ms", "archive ms"))
+    for hot in args.hot:
+        for settled in args.settled:
+            find_seconds, total_seconds = run(hot, settled, args.seed)
+            print("%-10s %-10s %10.2f %12.1f" % (hot, settled, find_seconds * 1e3, total_seconds * 1e3))
+
+if __name__ == "__main__":
+    main()
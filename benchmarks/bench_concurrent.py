@@ -0,0 +1,78 @@
+"""
+Throughput benchmark: ConcurrentFundMatcher across thread counts
+
+Compares per-fund locking against a FundMatcher behind one global lock, with each
+thread reserving donations and expiring a share of them.
+
+    python -m benchmarks.bench_concurrent --threads 1 2 4 8
+"""
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import argparse
+import random
+import threading
+import time
+
+class GlobalLockFundMatcher(FundMatcher):
+    """
+    Baseline: every operation serialised on a single lock
+    """
+
+    def __init__(self, match_funds):
+        super().__init__(match_funds)
+        self._lock = threading.Lock()
+
+    def reserve_funds(self, donation):
+        with self._lock:
+            super().reserve_funds(donation)
+
+    def expire_donation(self, donation_id):
+        with self._lock:
+            super().expire_donation(donation_id)
+
+def make_funds(count, seed):
+    rng = random.Random(seed)
+    return [MatchFund("fund_%s" % ix, rng.uniform(1000, 100000), rng.randint(0, 100), [rng.randint(1, 3), 1])
+            for ix in range(count)]
+
+def run(matcher_class, thread_count, operations, funds, expire_share, seed):
+    fund_matcher = matcher_class(make_funds(funds, seed))
+    per_thread = operations // thread_count
+
+    def worker(thread_ix):
+        rng = random.Random(seed + thread_ix)
+        for ix in range(per_thread):
+            donation_id = "donation_%s_%s" % (thread_ix, ix)
+            fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 500)))
+            if rng.random() < expire_share:
+                fund_matcher.expire_donation(donation_id)
+
+    threads = [threading.Thread(target=worker, args=(ix,)) for ix in range(thread_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return per_thread * thread_count / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--operations", type=int, default=80000)
+    parser.add_argument("--funds", type=int, default=500)
+    parser.add_argument("--expire-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%-8s %18s %18s" % ("threads", "global lock ops/s", "per-fund ops/s"))
+    for thread_count in args.threads:
+        results = [run(matcher_class, thread_count, args.operations, args.funds, args.expire_share, args.seed)
+                   for matcher_class in (GlobalLockFundMatcher, ConcurrentFundMatcher)]
+        print("%-8s %18.0f %18.0f" % (thread_count, results[0], results[1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Expiry benchmark: ExpiryScheduler.expire_due against scanning the allocation state
+
+Reserves --donations donations, then repeatedly expires the next --due overdue ones,
+either by popping the scheduler heap or by scanning every reserved donation for a
+created_time older than the TTL, and reports the time per sweep.
+
+    python -m benchmarks.bench_expiry --donations 200000 --due 100
+"""
+from benchmarks.workload import Workload
+from matcher.allocation_state import to_timestamp
+from matcher.donation import Donation
+from matcher.expiry_scheduler import ExpiryScheduler
+from matcher.fund_matcher import FundMatcher
+from datetime import timedelta
+import argparse
+import time
+
+TTL = timedelta(minutes=15)
+
+def build(workload, donations):
+    scheduler = ExpiryScheduler(FundMatcher(workload.make_funds()), TTL)
+    for ix in range(donations):
+        scheduler.reserve_funds(Donation("donation_%s" % ix, 20))
+    return scheduler
+
+def scan_expire(fund_matcher, now):
+    state = fund_matcher.allocation_state
+    cutoff = to_timestamp(now - TTL)
+    due = [state.donation_id(row) for row in state.iter_rows(reserved_only=True) if state.created_timestamp(row) <= cutoff]
+    fund_matcher.expire_donations(due)
+    return due
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--donations", type=int, default=200000)
+    parser.add_argument("--due", type=int, default=100)
+    parser.add_argument("--sweeps", type=int, default=20)
+    parser.add_argument("--funds", type=int, default=200)
+    args = parser.parse_args()
+
+    workload = Workload("expiry", funds=args.funds, fund_size=(1e5, 1e6))
+
+    print("%-10s %14s" % ("mode", "ms per sweep"))
+    for mode in ("heap", "scan"):
+        scheduler = build(workload, args.donations)
+        state = scheduler.allocation_state
+        elapsed = 0
+        for sweep in range(1, args.sweeps + 1):
+            # the moment the donation sweep * due reservations in falls due
+            now = state["donation_%s" % (sweep * args.due - 1)]['created_time'] + TTL
+            start = time.perf_counter()
+            if mode == "heap":
+                scheduler.expire_due(now)
+            else:
+                scan_expire(scheduler.fund_matcher, now)
+            elapsed += time.perf_counter() - start
+        print("%-10s %14.3f" % (mode, 1e3 * elapsed / args.sweeps))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Fork benchmark: copy-on-write previews against deep copies of a matcher
+
+Builds a matcher with many funds and reservations, then previews a handful of
+pledged donations on each of many forks, reporting the time to create a fork, the
+time to run the preview and the memory each fork holds, against doing the same on
+a deep copy of the matcher.
+
+    python -m benchmarks.bench_fork --funds 10000 --donations 200000 --forks 100
+"""
+from benchmarks.workload import Workload
+from matcher.donation import Donation
+from matcher.fork import ForkedFundMatcher
+from matcher.fund_matcher import FundMatcher
+import argparse
+import copy
+import random
+import time
+import tracemalloc
+
+def build(funds, donations, seed):
+    rng = random.Random(seed)
+    fund_matcher = FundMatcher(Workload("fork", funds=funds, fund_size=(1e3, 1e5), seed=seed).make_funds())
+    fund_matcher.reserve_funds_batch([Donation("donation_%s" % ix, rng.uniform(5, 200)) for ix in range(donations)])
+    return fund_matcher
+
+def preview(target, pledges, fork_ix):
+    for ix, amount in enumerate(pledges):
+        target.reserve_funds(Donation("pledge_%s_%s" % (fork_ix, ix), amount))
+
+def run(make_preview, fund_matcher, forks, pledges):
+    tracemalloc.start()
+    try:
+        previews = []
+        create = 0.0
+        start = time.perf_counter()
+        for fork_ix in range(forks):
+            created = time.perf_counter()
+            target = make_preview(fund_matcher)
+            create += time.perf_counter() - created
+            preview(target, pledges, fork_ix)
+            previews.append(target)
+        elapsed = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return create / forks, elapsed / forks, memory / forks
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--funds", type=int, default=1000)
+    parser.add_argument("--donations", type=int, default=50000)
+    parser.add_argument("--forks", type=int, default=20)
+    parser.add_argument("--pledges", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    fund_matcher = build(args.funds, args.donations, args.seed)
+    rng = random.Random(args.seed + 1)
+    pledges = [rng.uniform(5, 500) for _ in range(args.pledges)]
+
+    print("%-10s %14s %16s %14s" % ("preview", "create us", "create+run us", "KiB per fork"))
+    for name, make_preview in (("fork", ForkedFundMatcher), ("deepcopy", copy.deepcopy)):
+        create, elapsed, memory = run(make_preview, fund_matcher, args.forks, pledges)
+        print("%-10s %14.1f %16.1f %14.1f" % (name, create * 1e6, elapsed * 1e6, memory / 1024))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Fund churn benchmark: registry updates alongside donation traffic
+
+First times add_match_fund, top_up, reorder_match_fund and retire_match_fund against
+registries of growing size. Then runs donation threads against a ConcurrentFundMatcher
+with and without a thread churning funds at the same time, and reports donation ops/s.
+
+    python -m benchmarks.bench_fund_churn --sizes 1000 10000 100000 --threads 4
+"""
+from benchmarks.workload import Workload
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import argparse
+import random
+import threading
+import time
+
+def time_registry(size, updates, seed):
+    rng = random.Random(seed)
+    fund_matcher = FundMatcher(Workload("churn", funds=size, seed=seed).make_funds())
+    fund_ids = list(fund_matcher.match_funds)
+
+    timings = {}
+
+    start = time.perf_counter()
+    for ix in range(updates):
+        fund_matcher.add_match_fund(MatchFund("added_%s" % ix, 1000.00, rng.randint(0, 100)))
+    timings["add"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ix in range(updates):
+        fund_matcher.top_up(rng.choice(fund_ids), 10)
+    timings["top_up"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ix in range(updates):
+        fund_matcher.reorder_match_fund(rng.choice(fund_ids), rng.randint(0, 100))
+    timings["reorder"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ix in range(updates):
+        fund_matcher.retire_match_fund("added_%s" % ix)
+    timings["retire"] = time.perf_counter() - start
+
+    return {name: 1e6 * elapsed / updates for name, elapsed in timings.items()}
+
+def run_traffic(thread_count, operations, funds, churn, seed):
+    fund_matcher = ConcurrentFundMatcher(Workload("traffic", funds=funds, seed=seed, fund_size=(1e3, 1e5)).make_funds())
+    done = threading.Event()
+    churn_count = [0]
+
+    def donor(thread_ix):
+        rng = random.Random(seed + thread_ix)
+        for ix in range(operations // thread_count):
+            donation_id = "donation_%s_%s" % (thread_ix, ix)
+            fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 500)))
+            if rng.random() < 0.3:
+                fund_matcher.expire_donation(donation_id)
+
+    def churner():
+        rng = random.Random(seed)
+        ix = 0
+        while not done.is_set():
+            match_fund_id = "churn_%s" % ix
+            fund_matcher.add_match_fund(MatchFund(match_fund_id, 5000.00, rng.randint(0, 100)))
+            fund_matcher.top_up(match_fund_id, 1000)
+            fund_matcher.reorder_match_fund(match_fund_id, rng.randint(0, 100))
+            if ix % 2:
+                fund_matcher.retire_match_fund(match_fund_id)
+            churn_count[0] += 4
+            ix += 1
+            time.sleep(0.0005)
+
+    threads = [threading.Thread(target=donor, args=(ix,)) for ix in range(thread_count)]
+    churn_thread = threading.Thread(target=churner) if churn else None
+
+    start = time.perf_counter()
+    if churn_thread:
+        churn_thread.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    if churn_thread:
+        churn_thread.join()
+
+    return operations / elapsed, churn_count[0] / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--operations", type=int, default=100000)
+    parser.add_argument("--funds", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%-10s %10s %10s %10s %10s" % ("funds", "add us", "top_up us", "reorder us", "retire us"))
+    for size in args.sizes:
+        timings = time_registry(size, args.updates, args.seed)
+        print("%-10s %10.2f %10.2f %10.2f %10.2f" % (size, timings["add"], timings["top_up"], timings["reorder"], timings["retire"]))
+
+    print()
+    print("%-10s %16s %16s" % ("churn", "donation ops/s", "registry ops/s"))
+    for churn in (False, True):
+        donation_rate, churn_rate = run_traffic(args.threads, args.operations, args.funds, churn, args.seed)
+        print("%-10s %16.0f %16.0f" % ("on" if churn else "off", donation_rate, churn_rate))
+
+if __name__ == "__main__":
+    main()
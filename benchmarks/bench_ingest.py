@@ -0,0 +1,73 @@
+"""
+Ingestion benchmark: streaming a donations file through the matcher
+
+Writes a synthetic donations file (with a share of bad rows) and match funds to a
+temporary directory, then runs the ingestion pipeline over it at each chunk size,
+reporting rows/s and the peak memory traced. The allocation state grows with the
+donations reserved whatever the chunk size; the rest of the peak is the chunk.
+
+    python -m benchmarks.bench_ingest --rows 1000000 --chunk-sizes 1000 10000 100000
+"""
+from benchmarks.workload import Workload
+from matcher.fund_matcher import FundMatcher
+from matcher.ingest import ingest, iter_records, file_format, AllocationWriter, RejectWriter
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+def write_donations(path, rows, bad_share, seed):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("donation_id,amount\n")
+        for ix in range(rows):
+            if rng.random() < bad_share:
+                f.write("donation_%s,%s\n" % (ix, rng.choice(["", "abc", "1.00", "99999"])))
+            else:
+                f.write("donation_%s,%.2f\n" % (ix, min(rng.lognormvariate(3.5, 1.0) + 5, 25000)))
+
+def run(donations_path, funds, chunk_size, output_format, trace):
+    fund_matcher = FundMatcher(Workload("ingest", funds=funds).make_funds())
+    output_path = donations_path + ".out." + output_format
+
+    if trace:
+        tracemalloc.start()
+    try:
+        with open(donations_path, newline="") as donations, open(output_path, "w", newline="") as output, \
+                open(os.devnull, "w") as rejects:
+            start = time.perf_counter()
+            stats = ingest(fund_matcher, iter_records(donations, file_format(donations_path)),
+                           AllocationWriter(output, output_format), RejectWriter(rejects), chunk_size)
+            elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace else None
+    finally:
+        if trace:
+            tracemalloc.stop()
+        os.remove(output_path)
+
+    return stats, elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--funds", type=int, default=200)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--format", choices=("csv", "ndjson"), default="csv", help="format of the allocations written")
+    parser.add_argument("--bad-share", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        donations_path = os.path.join(directory, "donations.csv")
+        write_donations(donations_path, args.rows, args.bad_share, args.seed)
+
+        print("%10s %10s %10s %12s %10s" % ("chunk", "reserved", "rejected", "rows/s", "peak MiB"))
+        for chunk_size in args.chunk_sizes:
+            stats, elapsed, _ = run(donations_path, args.funds, chunk_size, args.format, trace=False)
+            _, _, peak = run(donations_path, args.funds, chunk_size, args.format, trace=True)
+            print("%10d %10d %10d %12.0f %10.1f" % (chunk_size, stats.reserved, stats.rejected, stats.rows / elapsed, peak))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Overhead benchmark: InstrumentedFundMatcher enabled and disabled against a bare FundMatcher
+
+Runs the same reserve/collect/expire workload three ways and reports ops/s and the
+overhead per operation relative to the bare matcher.
+
+    python -m benchmarks.bench_metrics --operations 200000
+"""
+from benchmarks.workload import Workload, apply, RESERVE, COLLECT, EXPIRE
+from matcher.fund_matcher import FundMatcher
+from matcher.metrics import InstrumentedFundMatcher, Metrics
+import argparse
+import time
+
+def run(workload, operations, instrument, enabled):
+    fund_matcher = FundMatcher(workload.make_funds())
+    if instrument:
+        fund_matcher = InstrumentedFundMatcher(fund_matcher, Metrics(enabled=enabled))
+
+    start = time.perf_counter()
+    for operation, argument in operations:
+        apply(fund_matcher, operation, argument)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--operations", type=int, default=200000)
+    parser.add_argument("--funds", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workload = Workload("metrics", operations=args.operations, funds=args.funds, seed=args.seed,
+                        operation_mix={RESERVE: 6, COLLECT: 3, EXPIRE: 1})
+    operations = list(workload.iter_operations())
+
+    modes = [("bare", False, False), ("disabled", True, False), ("enabled", True, True)]
+    best = {name: min(run(workload, operations, instrument, enabled) for _ in range(args.repeat))
+            for name, instrument, enabled in modes}
+
+    print("%-10s %12s %16s" % ("metrics", "ops/s", "overhead ns/op"))
+    for name, _, _ in modes:
+        print("%-10s %12.0f %16.0f" % (name, len(operations) / best[name],
+                                       1e9 * (best[name] - best["bare"]) / len(operations)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Money benchmark: float matching against the exact integer minor unit engine
+
+Runs the same workload of reservations and expiries through FundMatcher and
+ExactFundMatcher, one at a time and in batches, and reports throughput together
+with how far each engine's books drift: the difference between every fund's
+starting amount and its balance plus its live allocations, in minor units.
+
+    python -m benchmarks.bench_money --donations 200000
+"""
+from matcher.allocation import EXPIRED
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from matcher.money import ExactFundMatcher, to_minor_units
+import argparse
+import random
+import time
+
+BATCH_SIZE = 1000
+
+def make_funds_data(count, seed):
+    rng = random.Random(seed)
+    return [["fund_%s" % ix, round(rng.uniform(1e4, 1e5), 2), rng.randint(0, 100), [rng.randint(1, 7), rng.randint(1, 3)]]
+            for ix in range(count)]
+
+def make_amounts(count, seed):
+    rng = random.Random(seed)
+    return [round(rng.uniform(5, 500), 2) for _ in range(count)]
+
+def run(matcher_class, funds_data, amounts, batched):
+    fund_matcher = matcher_class([MatchFund(*fd) for fd in funds_data])
+
+    start = time.perf_counter()
+    if batched:
+        for batch_start in range(0, len(amounts), BATCH_SIZE):
+            fund_matcher.reserve_funds_batch([Donation(ix, amounts[ix])
+                                              for ix in range(batch_start, min(batch_start + BATCH_SIZE, len(amounts)))])
+    else:
+        for ix, amount in enumerate(amounts):
+            fund_matcher.reserve_funds(Donation(ix, amount))
+    for ix in range(0, len(amounts), 5):
+        fund_matcher.expire_donation(ix)
+    elapsed = time.perf_counter() - start
+
+    return len(amounts) / elapsed, drift(fund_matcher, funds_data)
+
+def drift(fund_matcher, funds_data):
+    """
+    Total absolute difference, in minor units, between the starting fund amounts and
+    the fund balances plus live allocations
+    """
+
+    scale = 1 if isinstance(fund_matcher, ExactFundMatcher) else 100
+    allocated = {}
+    state = fund_matcher.allocation_state
+    for donation_id in state:
+        row = state.row(donation_id)
+        if state.status(row) != EXPIRED:
+            for match_fund_id, amount in state.matches(row):
+                allocated[match_fund_id] = allocated.get(match_fund_id, 0) + amount
+
+    return sum(abs(to_minor_units(fd[1]) - (fund_matcher.match_funds[fd[0]].total_amount + allocated.get(fd[0], 0)) * scale)
+               for fd in funds_data)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--donations", type=int, default=200000)
+    parser.add_argument("--funds", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    funds_data = make_funds_data(args.funds, args.seed)
+    amounts = make_amounts(args.donations, args.seed)
+
+    print("%-18s %-10s %12s %16s" % ("engine", "mode", "ops/s", "drift (minor)"))
+    for matcher_class in (FundMatcher, ExactFundMatcher):
+        for batched in (False, True):
+            ops, total_drift = run(matcher_class, funds_data, amounts, batched)
+            print("%-18s %-10s %12.0f %16.6g" % (matcher_class.__name__, "batch" if batched else "sequential", ops, total_drift))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Quote benchmark: quote() against reserving and expiring to preview a match
+
+Many small funds, so a large donation draws from a long run of them; before each
+quote another donation is reserved, and half of them expired, so the index is kept
+up to date as it would be in a live campaign. Reports the latency of a quote of the totals, a quote
+with the allocation breakdown, and the reserve then expire it replaces.
+
+    python -m benchmarks.bench_quote --funds 100 10000 100000 --amount 500
+"""
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import argparse
+import random
+import time
+
+def percentile(latencies, share):
+    return sorted(latencies)[int(share * (len(latencies) - 1))]
+
+def timed(call):
+    start = time.perf_counter()
+    call()
+    return time.perf_counter() - start
+
+def run(funds, amount, quotes, seed):
+    rng = random.Random(seed)
+    fund_matcher = FundMatcher([MatchFund("fund_%s" % ix, rng.uniform(1, 20), rng.randint(0, 1000), [rng.randint(1, 3), 1])
+                                for ix in range(funds)])
+    fund_matcher.quote(amount)
+
+    latencies = {"quote": [], "breakdown": [], "reserve+expire": []}
+    for ix in range(quotes):
+        donation_id = "donation_%s" % ix
+        fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 50)))
+        if rng.random() < 0.5:
+            fund_matcher.expire_donation(donation_id)
+
+        latencies["quote"].append(timed(lambda: fund_matcher.quote(amount)))
+        latencies["breakdown"].append(timed(lambda: fund_matcher.quote(amount, breakdown=True)))
+
+    # previews change every fund they draw from and put back, so they are timed apart
+    for ix in range(quotes):
+        def preview():
+            fund_matcher.reserve_funds(Donation("preview_%s" % ix, amount))
+            fund_matcher.expire_donation("preview_%s" % ix)
+        latencies["reserve+expire"].append(timed(preview))
+
+    return {name: percentile(values, 0.5) for name, values in latencies.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--funds", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--amount", type=float, default=500)
+    parser.add_argument("--quotes", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%-8s %12s %14s %18s" % ("funds", "quote us", "breakdown us", "reserve+expire us"))
+    for funds in args.funds:
+        result = run(funds, args.amount, args.quotes, args.seed)
+        print("%-8s %12.1f %14.1f %18.1f" % (funds, result["quote"] * 1e6, result["breakdown"] * 1e6,
+                                            result["reserve+expire"] * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Throughput benchmark: SharedFundMatcher across process counts
+
+Every process reserves its share of the donations, expiring a share of them, against
+one SharedFundTable; the baseline is a single FundMatcher in one process doing all
+of them. Funds hold enough that none runs dry. Throughput from many processes is
+bounded by the cores the machine has, and by the table lock every reservation takes.
+
+    python -m benchmarks.bench_shared_funds --processes 1 2 4 8
+"""
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from matcher.shared_funds import SharedFundTable, SharedFundMatcher
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+def make_funds(count, seed):
+    rng = random.Random(seed)
+    return [MatchFund("fund_%s" % ix, rng.uniform(1e6, 1e7), rng.randint(0, 100), [rng.randint(1, 3), 1])
+            for ix in range(count)]
+
+def reserve(fund_matcher, process_ix, operations, expire_share, seed):
+    rng = random.Random(seed + process_ix)
+    for ix in range(operations):
+        donation_id = "donation_%s_%s" % (process_ix, ix)
+        fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 500)))
+        if rng.random() < expire_share:
+            fund_matcher.expire_donation(donation_id)
+
+def worker(table, process_ix, operations, expire_share, seed, start):
+    fund_matcher = SharedFundMatcher(table)
+    start.wait()
+    reserve(fund_matcher, process_ix, operations, expire_share, seed)
+
+def run_baseline(operations, funds, expire_share, seed):
+    fund_matcher = FundMatcher(make_funds(funds, seed))
+    start = time.perf_counter()
+    reserve(fund_matcher, 0, operations, expire_share, seed)
+    return operations / (time.perf_counter() - start)
+
+def run_shared(process_count, operations, funds, expire_share, seed):
+    table = SharedFundTable(make_funds(funds, seed))
+    per_process = operations // process_count
+    start = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=worker, args=(table, ix, per_process, expire_share, seed, start))
+                 for ix in range(process_count)]
+    for process in processes:
+        process.start()
+
+    started = time.perf_counter()
+    start.set()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    table.close()
+    return per_process * process_count / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--operations", type=int, default=200000)
+    parser.add_argument("--funds", type=int, default=50)
+    parser.add_argument("--expire-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%d cores" % os.cpu_count())
+    print("%-14s %12s" % ("processes", "ops/s"))
+    print("%-14s %12.0f" % ("FundMatcher", run_baseline(args.operations, args.funds, args.expire_share, args.seed)))
+    for process_count in args.processes:
+        print("%-14s %12.0f" % (process_count, run_shared(process_count, args.operations, args.funds,
+                                                          args.expire_share, args.seed)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Startup benchmark: memory-mapped snapshot against log replay and a full rebuild
+
+Builds a matcher with --donations reservations, writes its write-ahead log and a
+snapshot, then starts a fresh process per startup mode and measures the time to
+the first reservation and the resident set size at that point:
+
+    replay    recover by replaying the write-ahead log
+    rebuild   read the snapshot and rebuild every allocation as a new in-memory row
+    mmap      open the snapshot memory-mapped and serve from it
+
+    python -m benchmarks.bench_snapshot --donations 1000000
+"""
+from matcher.allocation_state import AllocationState
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from matcher.snapshot import open_snapshot, read_snapshot, write_snapshot
+from matcher.write_ahead_log import DurableFundMatcher, ASYNC
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = ("replay", "rebuild", "mmap")
+
+def make_funds(count, seed):
+    rng = random.Random(seed)
+    return [MatchFund("fund_%s" % ix, rng.uniform(1e6, 1e7), rng.randint(0, 100), [rng.randint(1, 3), 1])
+            for ix in range(count)]
+
+def build(directory, donations, funds, seed):
+    wal_path = os.path.join(directory, "matcher.wal")
+    snapshot_path = os.path.join(directory, "matcher.snap")
+
+    fund_matcher = DurableFundMatcher(wal_path, make_funds(funds, seed), durability=ASYNC)
+    rng = random.Random(seed)
+    batch = []
+    for ix in range(donations):
+        batch.append(Donation("donation_%s" % ix, rng.uniform(5, 500)))
+        if len(batch) == 10000:
+            fund_matcher.reserve_funds_batch(batch)
+            batch = []
+    if batch:
+        fund_matcher.reserve_funds_batch(batch)
+    for ix in range(0, donations, 5):
+        fund_matcher.expire_donation("donation_%s" % ix)
+    fund_matcher.close()
+
+    write_snapshot(fund_matcher, snapshot_path)
+    return wal_path, snapshot_path
+
+def rebuild(snapshot_path):
+    match_funds, snapshot_state, _ = read_snapshot(snapshot_path)
+    fund_matcher = FundMatcher(match_funds)
+    state = AllocationState()
+    for donation_id in snapshot_state:
+        row = snapshot_state.row(donation_id)
+        record = snapshot_state.record(row)
+        new_row = state.add(donation_id, record['original_donation'], record['donation_balance_unmatched'],
+                            snapshot_state.matches(row), record['created_time'])
+        if record['overall_status'] != state.status(new_row):
+            state.set_status(new_row, record['overall_status'], record['updated_time'])
+    fund_matcher.allocation_state = state
+    return fund_matcher
+
+def resident_mib():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def child(mode, wal_path, snapshot_path):
+    start = time.perf_counter()
+    if mode == "replay":
+        fund_matcher = DurableFundMatcher(wal_path, durability=ASYNC)
+    elif mode == "rebuild":
+        fund_matcher = rebuild(snapshot_path)
+    else:
+        fund_matcher = open_snapshot(snapshot_path)
+    fund_matcher.reserve_funds(Donation("first_reservation", 50))
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"seconds": elapsed, "rss_mib": resident_mib()}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--donations", type=int, default=200000)
+    parser.add_argument("--funds", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--child", nargs=3, metavar=("MODE", "WAL", "SNAPSHOT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        wal_path, snapshot_path = build(directory, args.donations, args.funds, args.seed)
+        print("%-8s %20s %10s" % ("mode", "first reservation s", "RSS MiB"))
+        for mode in MODES:
+            output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_snapshot", "--child", mode, wal_path, snapshot_path])
+            result = json.loads(output)
+            print("%-8s %20.3f %10.1f" % (mode, result["seconds"], result["rss_mib"]))
+
+if __name__ == "__main__":
+    main()
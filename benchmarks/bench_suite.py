@@ -0,0 +1,182 @@
+"""
+Benchmark suite: synthetic workloads over the matcher hot paths, with JSON baselines
+
+Runs each workload against a fresh FundMatcher and reports overall ops/s, latency
+percentiles per operation and the peak memory traced while running it. The
+operations are generated up front so that generating them is not timed; peak memory
+is measured in a second run under tracemalloc, so tracing does not slow the timed run.
+
+    python -m benchmarks.bench_suite --save baseline.json
+    python -m benchmarks.bench_suite --compare baseline.json --threshold 0.1
+
+With --compare, a workload whose ops/s fell, or whose p99 latency or peak memory
+rose, by more than the threshold is flagged and the exit status is 1.
+Workloads can be narrowed with --workloads and scaled with --operations; a custom
+workload can be given with --funds, --ratio-mix, --donation-distribution and --mix.
+"""
+from benchmarks.workload import Workload, apply, RESERVE, COLLECT, EXPIRE, LIST, RATIO_MIXES, DONATION_DISTRIBUTIONS
+from matcher.fund_matcher import FundMatcher
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+DEFAULT_THRESHOLD = 0.1
+
+WORKLOADS = [
+    Workload("reserve_only", operation_mix={RESERVE: 1}),
+    Workload("reserve_collect_expire", operation_mix={RESERVE: 6, COLLECT: 3, EXPIRE: 1}),
+    Workload("expiry_churn", operation_mix={RESERVE: 1, EXPIRE: 1}, funds=50, fund_size=(1e3, 1e4)),
+    Workload("many_funds", operation_mix={RESERVE: 8, EXPIRE: 2}, funds=5000, ratio_mix="awkward",
+             donation_distribution="pareto", fund_size=(10, 1e3)),
+    Workload("listing", operation_mix={RESERVE: 7, COLLECT: 2, LIST: 1})
+]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+def run_workload(workload, matcher_class=FundMatcher):
+    """
+    Time a workload, returning its results as a JSON serialisable dict
+    """
+
+    operations = list(workload.iter_operations())
+
+    fund_matcher = matcher_class(workload.make_funds())
+    latencies = {}
+    clock = time.perf_counter_ns
+
+    start = clock()
+    for operation, argument in operations:
+        operation_start = clock()
+        apply(fund_matcher, operation, argument)
+        latencies.setdefault(operation, []).append(clock() - operation_start)
+    elapsed = (clock() - start) / 1e9
+
+    operation_results = {}
+    for operation, values in latencies.items():
+        values.sort()
+        operation_results[operation] = dict(
+            [('count', len(values))] +
+            [('p%s_us' % p, percentile(values, p) / 1e3) for p in PERCENTILES] +
+            [('max_us', values[-1] / 1e3)])
+
+    return {
+        'workload': workload.to_dict(),
+        'ops_per_sec': len(operations) / elapsed,
+        'operations': operation_results,
+        'peak_memory_mib': peak_memory(workload, operations, matcher_class)
+    }
+
+def peak_memory(workload, operations, matcher_class):
+    tracemalloc.start()
+    try:
+        fund_matcher = matcher_class(workload.make_funds())
+        for operation, argument in operations:
+            apply(fund_matcher, operation, argument)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+def compare(baseline, results, threshold=DEFAULT_THRESHOLD):
+    """
+    List the regressions of results against a baseline, as readable strings
+    Only workloads present in both are compared.
+    """
+
+    regressions = []
+    for name, result in results['workloads'].items():
+        base = baseline['workloads'].get(name)
+        if base is None:
+            continue
+
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            regressions.append("%s: ops/s %.0f -> %.0f" % (name, base['ops_per_sec'], result['ops_per_sec']))
+
+        if result['peak_memory_mib'] > base['peak_memory_mib'] * (1 + threshold):
+            regressions.append("%s: peak memory %.1f -> %.1f MiB" % (name, base['peak_memory_mib'], result['peak_memory_mib']))
+
+        for operation, latency in result['operations'].items():
+            base_latency = base['operations'].get(operation)
+            if base_latency is not None and latency['p99_us'] > base_latency['p99_us'] * (1 + threshold):
+                regressions.append("%s: %s p99 %.1f -> %.1f us" % (name, operation, base_latency['p99_us'], latency['p99_us']))
+
+    return regressions
+
+def print_results(results):
+    print("%-24s %-8s %8s %10s %10s %10s %10s %10s %10s" % (
+        "workload", "op", "count", "p50 us", "p90 us", "p99 us", "p99.9 us", "ops/s", "peak MiB"))
+    for name, result in results['workloads'].items():
+        for ix, (operation, latency) in enumerate(sorted(result['operations'].items())):
+            print("%-24s %-8s %8d %10.1f %10.1f %10.1f %10.1f %10s %10s" % (
+                name if ix == 0 else "", operation, latency['count'], latency['p50_us'], latency['p90_us'],
+                latency['p99_us'], latency['p99.9_us'],
+                "%.0f" % result['ops_per_sec'] if ix == 0 else "",
+                "%.1f" % result['peak_memory_mib'] if ix == 0 else ""))
+
+def parse_mix(text):
+    """
+    Parse an operation mix such as reserve=6,collect=3,expire=1
+    """
+
+    mix = {}
+    for part in text.split(","):
+        operation, _, weight = part.partition("=")
+        mix[operation.strip()] = float(weight)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workloads", nargs="+", choices=[w.name for w in WORKLOADS])
+    parser.add_argument("--operations", type=int, help="operations per workload")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--funds", type=int, help="run a custom workload with this many funds")
+    parser.add_argument("--ratio-mix", choices=sorted(RATIO_MIXES), default="mixed")
+    parser.add_argument("--donation-distribution", choices=sorted(DONATION_DISTRIBUTIONS), default="lognormal")
+    parser.add_argument("--mix", type=parse_mix, default={RESERVE: 6, COLLECT: 3, EXPIRE: 1},
+                        help="operation weights, eg reserve=6,collect=3,expire=1,list=0")
+    parser.add_argument("--save", metavar="PATH", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results against a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.funds is not None:
+        workloads = [Workload("custom", funds=args.funds, ratio_mix=args.ratio_mix,
+                              donation_distribution=args.donation_distribution, operation_mix=args.mix)]
+    else:
+        workloads = [w for w in WORKLOADS if args.workloads is None or w.name in args.workloads]
+
+    for workload in workloads:
+        if args.operations is not None:
+            workload.operations = args.operations
+        if args.seed is not None:
+            workload.seed = args.seed
+
+    results = {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'workloads': {workload.name: run_workload(workload) for workload in workloads}
+    }
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s beyond %.0f%%" % (args.compare, 100 * args.threshold))
+
+if __name__ == "__main__":
+    main()
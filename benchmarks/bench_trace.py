@@ -0,0 +1,66 @@
+"""
+Trace benchmark: the cost of recording a trace, and the speed of replaying it
+
+Runs the same reservations, collections and expiries on a bare FundMatcher and on one
+wrapped in a RecordingFundMatcher, then replays the trace flat out. Reports the
+throughput of each and the size of the trace.
+
+    python -m benchmarks.bench_trace --operations 100000 --funds 50
+"""
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from matcher.trace import RecordingFundMatcher, replay
+import argparse
+import os
+import random
+import tempfile
+import time
+
+def make_funds(count, seed):
+    rng = random.Random(seed)
+    return [MatchFund("fund_%s" % ix, rng.uniform(1e5, 1e6), rng.randint(0, 100), [rng.randint(1, 3), 1])
+            for ix in range(count)]
+
+def run_operations(fund_matcher, operations, seed):
+    rng = random.Random(seed)
+    reserved = []
+    start = time.perf_counter()
+    for ix in range(operations):
+        if reserved and rng.random() < 0.4:
+            donation_id = reserved.pop(rng.randrange(len(reserved)))
+            if rng.random() < 0.5:
+                fund_matcher.collect_donation(donation_id)
+            else:
+                fund_matcher.expire_donation(donation_id)
+        else:
+            donation_id = "donation_%s" % ix
+            fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 500)))
+            reserved.append(donation_id)
+    return operations / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--operations", type=int, default=100000)
+    parser.add_argument("--funds", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    bare = run_operations(FundMatcher(make_funds(args.funds, args.seed)), args.operations, args.seed)
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.trace")
+    with RecordingFundMatcher(FundMatcher(make_funds(args.funds, args.seed)), path) as recorder:
+        recorded = run_operations(recorder, args.operations, args.seed)
+
+    result = replay(path)
+    assert not result['mismatches'], result['mismatches']
+
+    print("%-10s %12s" % ("mode", "ops/s"))
+    print("%-10s %12.0f" % ("bare", bare))
+    print("%-10s %12.0f" % ("recording", recorded))
+    print("%-10s %12.0f" % ("replay", result['calls'] / result['elapsed']))
+    print("trace %.1f bytes per call" % (os.path.getsize(path) / result['calls']))
+    os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Validation benchmark: one Donation per row against validate_donations over a column
+
+Generates a column of amounts as text, as read from a CSV file, with a share of bad
+rows (unparseable, empty or out of bounds), and times validating it row by row with
+Donation and the exceptions it raises, and as a whole column with validate_donations.
+
+    python -m benchmarks.bench_validation --rows 1000000 --bad-shares 0 0.1 0.5
+"""
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.validation import validate_donations
+import argparse
+import random
+import time
+
+def make_column(rows, bad_share, seed):
+    rng = random.Random(seed)
+    return ["%.2f" % rng.uniform(5, 500) if rng.random() >= bad_share else rng.choice(["", "abc", "1.00", "99999"])
+            for _ in range(rows)]
+
+def validate_rows(column):
+    valid = []
+    for ix, value in enumerate(column):
+        try:
+            Donation("donation_%s" % ix, float(value))
+        except (BadRequestException, ValueError):
+            valid.append(False)
+        else:
+            valid.append(True)
+    return valid
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--bad-shares", type=float, nargs="+", default=[0, 0.01, 0.1, 0.5])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%10s %14s %14s %8s" % ("bad share", "rows/s", "column rows/s", "speedup"))
+    for bad_share in args.bad_shares:
+        column = make_column(args.rows, bad_share, args.seed)
+
+        start = time.perf_counter()
+        row_valid = validate_rows(column)
+        row_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, column_valid, _ = validate_donations(column)
+        column_elapsed = time.perf_counter() - start
+
+        assert column_valid.tolist() == row_valid
+        print("%10.2f %14.0f %14.0f %7.1fx" % (bad_share, args.rows / row_elapsed, args.rows / column_elapsed,
+                                              row_elapsed / column_elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Throughput benchmark: DurableFundMatcher at each durability level
+
+Worker threads reserve donations against a durable matcher writing its log to a
+temporary directory (or --directory, to benchmark a particular disk). Reports
+throughput and the number of fsyncs per operation.
+
+    python -m benchmarks.bench_wal --threads 1 8
+"""
+from matcher.donation import Donation
+from matcher.match_fund import MatchFund
+from matcher.write_ahead_log import DurableFundMatcher, DURABILITY_LEVELS
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+def make_funds(count, seed):
+    rng = random.Random(seed)
+    return [MatchFund("fund_%s" % ix, rng.uniform(1000, 100000), rng.randint(0, 100), [rng.randint(1, 3), 1])
+            for ix in range(count)]
+
+def run(directory, durability, thread_count, operations, funds, seed):
+    path = os.path.join(directory, "bench_%s_%s.wal" % (durability, thread_count))
+    fund_matcher = DurableFundMatcher(path, make_funds(funds, seed), durability=durability)
+    per_thread = operations // thread_count
+
+    def worker(thread_ix):
+        rng = random.Random(seed + thread_ix)
+        for ix in range(per_thread):
+            fund_matcher.reserve_funds(Donation("donation_%s_%s" % (thread_ix, ix), rng.uniform(5, 500)))
+
+    threads = [threading.Thread(target=worker, args=(ix,)) for ix in range(thread_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    fund_matcher.close()
+    elapsed = time.perf_counter() - start
+
+    total = per_thread * thread_count
+    os.remove(path)
+    return total / elapsed, fund_matcher.log.fsync_count / total
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--operations", type=int, default=5000)
+    parser.add_argument("--funds", type=int, default=200)
+    parser.add_argument("--directory", default=None)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        print("%-10s %-8s %12s %14s" % ("durability", "threads", "ops/s", "fsyncs/op"))
+        for durability in DURABILITY_LEVELS:
+            for thread_count in args.threads:
+                ops, fsyncs = run(directory, durability, thread_count, args.operations, args.funds, args.seed)
+                print("%-10s %-8s %12.0f %14.3f" % (durability, thread_count, ops, fsyncs))
+
+if __name__ == "__main__":
+    main()
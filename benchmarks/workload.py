@@ -0,0 +1,125 @@
+"""
+Synthetic workload generators for the benchmarks
+
+A Workload describes a stream of matcher operations: how many match funds and with
+which mix of ratios, how donation amounts are distributed, and the share of
+reserve, collect, expire and list operations. Collections and expiries always
+target a donation that is still reserved, so every generated operation is valid.
+"""
+from matcher.donation import Donation, MIN_DONATION, MAX_DONATION
+from matcher.match_fund import MatchFund
+import random
+
+# Operations
+RESERVE = "reserve"
+COLLECT = "collect"
+EXPIRE = "expire"
+LIST = "list"
+
+OPERATIONS = (RESERVE, COLLECT, EXPIRE, LIST)
+
+# Matching ratio mixes, as (weight, [lhs, rhs]) pairs
+RATIO_MIXES = {
+    "one_to_one": [(1, [1, 1])],
+    "mixed": [(4, [1, 1]), (3, [2, 1]), (2, [3, 1]), (1, [1, 2])],
+    "awkward": [(1, [3, 7]), (1, [7, 3]), (1, [5, 3]), (1, [2, 9])]
+}
+
+# Donation amount distributions, clamped to the donation limits when drawn
+DONATION_DISTRIBUTIONS = {
+    "uniform": lambda rng: rng.uniform(5, 500),
+    "lognormal": lambda rng: rng.lognormvariate(3.5, 1.0),
+    "pareto": lambda rng: 5 * rng.paretovariate(1.2)
+}
+
+LIST_PAGE_SIZE = 50
+
+class Workload(object):
+    """
+    Parameters of a synthetic workload
+    operation_mix maps each operation to its relative weight. A collect or expire
+    drawn while nothing is reserved becomes a reserve instead.
+    """
+
+    def __init__(self, name, operations=100000, funds=200, ratio_mix="mixed", donation_distribution="lognormal",
+                 operation_mix=None, fund_size=(1e4, 1e6), seed=1):
+        if ratio_mix not in RATIO_MIXES:
+            raise ValueError("Unknown ratio mix %s" % ratio_mix)
+        if donation_distribution not in DONATION_DISTRIBUTIONS:
+            raise ValueError("Unknown donation distribution %s" % donation_distribution)
+
+        operation_mix = operation_mix or {RESERVE: 1}
+        for operation in operation_mix:
+            if operation not in OPERATIONS:
+                raise ValueError("Unknown operation %s" % operation)
+
+        self.name = name
+        self.operations = operations
+        self.funds = funds
+        self.ratio_mix = ratio_mix
+        self.donation_distribution = donation_distribution
+        self.operation_mix = operation_mix
+        self.fund_size = fund_size
+        self.seed = seed
+
+    def to_dict(self):
+        return {
+            'operations': self.operations,
+            'funds': self.funds,
+            'ratio_mix': self.ratio_mix,
+            'donation_distribution': self.donation_distribution,
+            'operation_mix': self.operation_mix,
+            'fund_size': list(self.fund_size),
+            'seed': self.seed
+        }
+
+    def make_funds(self):
+        rng = random.Random(self.seed)
+        weights, ratios = zip(*RATIO_MIXES[self.ratio_mix])
+        return [MatchFund("fund_%s" % ix, round(rng.uniform(*self.fund_size), 2), rng.randint(0, 100),
+                          list(rng.choices(ratios, weights)[0]))
+                for ix in range(self.funds)]
+
+    def iter_operations(self):
+        """
+        Yield (operation, argument) pairs: a Donation to reserve, a donation id to
+        collect or expire, or the keyword arguments of a listing
+        """
+
+        rng = random.Random(self.seed + 1)
+        amount = DONATION_DISTRIBUTIONS[self.donation_distribution]
+        operations, weights = zip(*self.operation_mix.items())
+        reserved = []
+        next_id = 0
+
+        for _ in range(self.operations):
+            operation = rng.choices(operations, weights)[0]
+
+            if operation in (COLLECT, EXPIRE) and reserved:
+                # swap remove a random reserved donation
+                ix = rng.randrange(len(reserved))
+                reserved[ix], reserved[-1] = reserved[-1], reserved[ix]
+                yield operation, reserved.pop()
+            elif operation == LIST:
+                # a page from a random cursor, as a client paging through would ask for
+                cursor = "donation_%s" % rng.randrange(next_id) if next_id else None
+                yield LIST, {'limit': LIST_PAGE_SIZE, 'after_donation_id': cursor}
+            else:
+                donation_id = "donation_%s" % next_id
+                next_id += 1
+                reserved.append(donation_id)
+                yield RESERVE, Donation(donation_id, round(min(max(amount(rng), MIN_DONATION), MAX_DONATION), 2))
+
+def apply(fund_matcher, operation, argument):
+    """
+    Apply one generated operation to a matcher
+    """
+
+    if operation == RESERVE:
+        fund_matcher.reserve_funds(argument)
+    elif operation == COLLECT:
+        fund_matcher.collect_donation(argument)
+    elif operation == EXPIRE:
+        fund_matcher.expire_donation(argument)
+    else:
+        fund_matcher.list_match_fund_allocations(**argument)
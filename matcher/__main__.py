@@ -0,0 +1,70 @@
+"""
+Match a donations file against a funds file, streaming the allocations out
+
+    python -m matcher --funds funds.csv donations.ndjson --output allocations.csv --rejects rejects.csv
+
+Funds and donations may be CSV or NDJSON, told apart by their extension; funds have
+match_fund_id, total_amount, match_order and match_ratio (lhs:rhs in CSV) fields and
+donations have donation_id and amount. Use - to read donations from stdin or write
+allocations, or else rejects, to stdout, with --format. Rows per second are reported on stderr.
+"""
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import FundMatcher
+from matcher.ingest import ingest, iter_records, open_records, file_format, read_match_funds, AllocationWriter, RejectWriter
+from matcher.ingest import FORMATS, CSV, DEFAULT_CHUNK_SIZE
+from matcher.snapshot import write_snapshot
+from contextlib import ExitStack
+import argparse
+import sys
+
+def open_stream(stack, path, mode, stdio):
+    if path == "-":
+        return stdio
+    if mode == "r":
+        return stack.enter_context(open_records(path))
+    return stack.enter_context(open(path, mode, newline=""))
+
+def report(stats):
+    print("%d rows, %d reserved, %d rejected, %.0f rows/s" % (
+        stats.rows, stats.reserved, stats.rejected, stats.rows_per_sec), file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m matcher", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("donations", help="donations file, or - for stdin")
+    parser.add_argument("--funds", required=True, help="match funds file")
+    parser.add_argument("--output", default="-", help="allocations file, or - for stdout (the default)")
+    parser.add_argument("--rejects", help="file to write rejected donation rows to, as CSV, or - for stdout "
+                                          "when the allocations go to a file")
+    parser.add_argument("--format", choices=FORMATS, help="format of stdin, stdout or a file with another extension")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--progress", action="store_true", help="report rows/s after every chunk")
+    parser.add_argument("--snapshot", metavar="PATH", help="write a snapshot of the matcher when done")
+    args = parser.parse_args(argv)
+    if args.rejects == "-" and args.output == "-":
+        parser.error("--rejects and --output cannot both be stdout")
+
+    try:
+        fund_matcher = FundMatcher(read_match_funds(args.funds))
+
+        with ExitStack() as stack:
+            donations = open_stream(stack, args.donations, "r", sys.stdin)
+            output = open_stream(stack, args.output, "w", sys.stdout)
+            rejects = RejectWriter(open_stream(stack, args.rejects, "w", sys.stdout)) if args.rejects else None
+
+            stats = ingest(fund_matcher,
+                           iter_records(donations, file_format(args.donations, args.format or CSV)),
+                           AllocationWriter(output, file_format(args.output, args.format or CSV)),
+                           rejects, args.chunk_size, report if args.progress else None)
+    except (BadRequestException, OSError, UnicodeError) as e:
+        # stdin is read strictly, so bytes that are not UTF-8 there end the run
+        print("error: %s" % e, file=sys.stderr)
+        return 2
+
+    if args.snapshot:
+        write_snapshot(fund_matcher, args.snapshot)
+
+    report(stats)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,44 @@
+# Valid statuses
+RESERVED = "Reserved"
+COLLECTED = "Collected"
+EXPIRED = "Expired"
+
+# Statuses are stored as small ints, indexing into this tuple
+STATUSES = (RESERVED, COLLECTED, EXPIRED)
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
 class Allocation(object):
+    """
+    View of a single match fund allocation held in an AllocationState
+    Reads and writes go straight to the state's columns, so holding on to an
+    Allocation costs two slots rather than a copy of the record.
+    """
+
+    __slots__ = ('_state', '_index')
+
+    def __init__(self, state, index):
+        self._state = state
+        self._index = index
+
+    @property
+    def match_fund_id(self):
+        return self._state.allocation_fund_id(self._index)
+
+    @property
+    def match_fund_allocation(self):
+        return self._state.allocation_amount(self._index)
+
+    @property
+    def status(self):
+        return self._state.allocation_status(self._index)
 
-    def __init__(self, match_fund_id, match_fund_allocation, status):
-        self.match_fund_id = match_fund_id
-        self.match_fund_allocation = match_fund_allocation
-        self.status = status
+    @status.setter
+    def status(self, status):
+        self._state.set_allocation_status(self._index, status)
 
     def to_dict(self):
         return {
             "match_fund_id": self.match_fund_id,
             "match_fund_allocation": self.match_fund_allocation,
             "status": self.status
-        }
\ No newline at end of file
+        }
@@ -0,0 +1,521 @@
+from array import array
+from bisect import bisect_right, insort
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+from matcher.allocation import Allocation, RESERVED, EXPIRED, STATUSES, STATUS_CODES
+
+# Timestamps are stored as int64 microseconds from this (naive) epoch
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+NO_ALLOCATION = -1
+
+# Typecode of the columns holding amounts: floats, or int64 minor units (see matcher.money)
+FLOAT_AMOUNTS = 'd'
+MINOR_UNIT_AMOUNTS = 'q'
+AMOUNT = None
+
+# (attribute, array typecode) of the columns held per donation row, per allocation and per match fund
+DONATION_COLUMNS = (
+    ('_original_donation', AMOUNT),
+    ('_donation_balance_unmatched', AMOUNT),
+    ('_overall_status', 'b'),
+    ('_created_time', 'q'),
+    ('_updated_time', 'q'),
+    ('_first_allocation', 'q'),
+    ('_last_allocation', 'q'),
+    ('_next_live', 'q'),
+    ('_next_reserved', 'q'),
+    ('_sequence', 'q')
+)
+ALLOCATION_COLUMNS = (
+    ('_allocation_fund', 'i'),
+    ('_allocation_amount', AMOUNT),
+    ('_allocation_status', 'b'),
+    ('_next_allocation', 'q'),
+    ('_allocation_row', 'q'),
+    ('_next_fund_allocation', 'q')
+)
+FUND_COLUMNS = (
+    ('_fund_first_allocation', 'q'),
+    ('_fund_last_allocation', 'q'),
+    ('_fund_reserved', AMOUNT),
+    ('_fund_collected', AMOUNT),
+    ('_fund_expired', AMOUNT),
+    ('_fund_reserved_count', 'q'),
+    ('_fund_collected_count', 'q'),
+    ('_fund_expired_count', 'q')
+)
+
+RECORD_KEYS = (
+    'allocations',
+    'created_time',
+    'updated_time',
+    'original_donation',
+    'donation_balance_unmatched',
+    'overall_status'
+)
+
+def column_typecodes(amount_typecode=FLOAT_AMOUNTS):
+    """
+    Returns the (attribute, array typecode) of every column, for the given amount typecode
+    """
+
+    return [(name, amount_typecode if typecode is AMOUNT else typecode)
+            for name, typecode in DONATION_COLUMNS + ALLOCATION_COLUMNS + FUND_COLUMNS]
+
+def to_timestamp(dt):
+    return (dt - EPOCH) // MICROSECOND
+
+def from_timestamp(timestamp):
+    return EPOCH + timedelta(microseconds=timestamp)
+
+def _skip(pointers, row):
+    """
+    Returns the first row at or after row that is still a member of a skip index
+    A member row points to itself; a row that left the index points further on.
+    Followed pointers are compressed, so rows that left are passed over once.
+    """
+
+    end = len(pointers)
+    member = row
+    while member < end and pointers[member] != member:
+        member = pointers[member]
+
+    while row < member:
+        next_row = pointers[row]
+        pointers[row] = member
+        row = next_row
+
+    return member
+
+class AllocationState(Mapping):
+    """
+    Columnar store of donation reservations, keyed by donation id
+    Donation ids and match fund ids are interned to integer rows. Each column is a
+    typed array, so a reservation costs a few bytes per field instead of a dict,
+    a list of Allocation objects and boxed floats and datetimes.
+    Allocations of a donation are chained through next_allocation, in the order
+    they were made.
+    Rows only ever leave the Reserved status, and never come back from Expired, so
+    membership of the live (not expired) and reserved sets is kept as skip indexes
+    that iterate in row order without visiting rows that have left.
+    Allocations are also chained per match fund, and each fund keeps running totals
+    and counts of its allocations by status, so a fund's summary never needs a scan.
+    Reading state[donation_id] returns an AllocationRecord view with the same keys
+    as the original allocation state documents.
+    """
+
+    def __init__(self, columns=None, donation_ids=None, rows=None, fund_ids=None, amount_typecode=FLOAT_AMOUNTS,
+                 next_sequence=0):
+        """
+        Creates an empty state, or one over existing columns (see matcher.snapshot)
+        Columns only need to support len(), indexing, item assignment and append(),
+        so they can be arrays or views over a memory-mapped file.
+        Amounts are floats, or int64 minor units with amount_typecode=MINOR_UNIT_AMOUNTS.
+        """
+
+        self.amount_typecode = amount_typecode
+
+        # reservation sequence of the next row added; kept by without(), unlike row numbers
+        self.next_sequence = next_sequence
+
+        # bumped by every change, so a fork can tell whether the state moved on under it
+        self.version = 0
+
+        # donation rows: _original_donation, _donation_balance_unmatched, _overall_status,
+        # _created_time, _updated_time, _first_allocation, _last_allocation, and the skip
+        # indexes of live (not expired) and reserved rows, _next_live and _next_reserved, and the
+        # reservation sequence, _sequence
+        # allocation rows: _allocation_fund, _allocation_amount, _allocation_status, _next_allocation,
+        # and the donation row and the next allocation of the same fund, _allocation_row and _next_fund_allocation
+        # fund rows: the ends of each fund's allocation chain, and its totals and counts by status
+        for name, typecode in column_typecodes(amount_typecode):
+            setattr(self, name, columns[name] if columns else array(typecode))
+
+        # fund totals and counts, indexed by status code
+        self._fund_totals = (self._fund_reserved, self._fund_collected, self._fund_expired)
+        self._fund_counts = (self._fund_reserved_count, self._fund_collected_count, self._fund_expired_count)
+
+        # (updated timestamp, row) of settled rows, in the order they were settled; over
+        # existing columns it is only built when first needed
+        self._settled = None if columns else []
+
+        self._donation_ids = donation_ids if donation_ids is not None else []
+        self._rows = rows if rows is not None else {}
+
+        # interned match fund ids
+        self._fund_ids = fund_ids if fund_ids is not None else []
+        self._fund_index = {match_fund_id: fund for fund, match_fund_id in enumerate(self._fund_ids)}
+
+    def __getitem__(self, donation_id):
+        return AllocationRecord(self, self._rows[donation_id])
+
+    def __contains__(self, donation_id):
+        return donation_id in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, donation_id, original_donation, donation_balance_unmatched, matches, created_time):
+        """
+        Add a reserved donation with its list of (match_fund_id, amount) matches
+        The donation id must not be present already.
+        Returns the row of the donation
+        """
+
+        timestamp = to_timestamp(created_time)
+        self.version += 1
+
+        row = len(self._donation_ids)
+        self._rows[donation_id] = row
+        self._donation_ids.append(donation_id)
+        self._original_donation.append(original_donation)
+        self._donation_balance_unmatched.append(donation_balance_unmatched)
+        self._overall_status.append(STATUS_CODES[RESERVED])
+        self._created_time.append(timestamp)
+        self._updated_time.append(timestamp)
+        self._first_allocation.append(NO_ALLOCATION)
+        self._last_allocation.append(NO_ALLOCATION)
+        self._next_live.append(row)
+        self._next_reserved.append(row)
+        self._sequence.append(self.next_sequence)
+        self.next_sequence += 1
+
+        for match_fund_id, amount in matches:
+            self.add_allocation(row, match_fund_id, amount)
+
+        return row
+
+    def add_allocation(self, row, match_fund_id, amount):
+        """
+        Append a reserved allocation to the end of a donation's allocations
+        Returns the index of the allocation
+        """
+
+        self.version += 1
+        fund = self._fund_index.get(match_fund_id)
+        if fund is None:
+            fund = self._add_fund(match_fund_id)
+
+        index = len(self._allocation_amount)
+        self._allocation_fund.append(fund)
+        self._allocation_amount.append(amount)
+        self._allocation_status.append(STATUS_CODES[RESERVED])
+        self._next_allocation.append(NO_ALLOCATION)
+        self._allocation_row.append(row)
+        self._next_fund_allocation.append(NO_ALLOCATION)
+
+        last = self._last_allocation[row]
+        if last == NO_ALLOCATION:
+            self._first_allocation[row] = index
+        else:
+            self._next_allocation[last] = index
+        self._last_allocation[row] = index
+
+        last = self._fund_last_allocation[fund]
+        if last == NO_ALLOCATION:
+            self._fund_first_allocation[fund] = index
+        else:
+            self._next_fund_allocation[last] = index
+        self._fund_last_allocation[fund] = index
+
+        self._fund_reserved[fund] += amount
+        self._fund_reserved_count[fund] += 1
+
+        return index
+
+    def _add_fund(self, match_fund_id):
+        fund = len(self._fund_ids)
+        self._fund_index[match_fund_id] = fund
+        self._fund_ids.append(match_fund_id)
+
+        self._fund_first_allocation.append(NO_ALLOCATION)
+        self._fund_last_allocation.append(NO_ALLOCATION)
+        for column in self._fund_totals + self._fund_counts:
+            column.append(0)
+
+        return fund
+
+    def row(self, donation_id):
+        return self._rows[donation_id]
+
+    def donation_id(self, row):
+        return self._donation_ids[row]
+
+    def record(self, row):
+        return AllocationRecord(self, row)
+
+    def sequence(self, row):
+        """
+        Reservation sequence of a row: rows are numbered as they are added, and keep their
+        number when the state is rebuilt without some of them, or archived
+        """
+
+        return self._sequence[row]
+
+    def last_row_at(self, sequence):
+        """
+        Returns the last row with a reservation sequence at or before sequence, or -1
+        """
+
+        return bisect_right(self._sequence, sequence) - 1
+
+    def created_timestamp(self, row):
+        """
+        Created time of a row, as integer microseconds (see to_timestamp)
+        """
+
+        return self._created_time[row]
+
+    def status(self, row):
+        return STATUSES[self._overall_status[row]]
+
+    def set_status(self, row, status, updated_time):
+        """
+        Set the overall status of a donation and of all of its allocations
+        """
+
+        code = STATUS_CODES[status]
+        self.version += 1
+        self._overall_status[row] = code
+        self._updated_time[row] = to_timestamp(updated_time)
+
+        if status != RESERVED:
+            self._next_reserved[row] = row + 1
+            if self._settled is not None:
+                insort(self._settled, (self._updated_time[row], row))
+        if status == EXPIRED:
+            self._next_live[row] = row + 1
+
+        index = self._first_allocation[row]
+        while index != NO_ALLOCATION:
+            self._move_allocation(index, code)
+            index = self._next_allocation[index]
+
+    def _move_allocation(self, index, code):
+        """
+        Set the status code of an allocation, moving it between its fund's totals
+        """
+
+        old_code = self._allocation_status[index]
+        if old_code == code:
+            return
+
+        fund = self._allocation_fund[index]
+        amount = self._allocation_amount[index]
+        self._fund_totals[old_code][fund] -= amount
+        self._fund_counts[old_code][fund] -= 1
+        self._fund_totals[code][fund] += amount
+        self._fund_counts[code][fund] += 1
+        self._allocation_status[index] = code
+
+    def iter_rows(self, after_row=-1, reserved_only=False):
+        """
+        Iterate the rows of live (Reserved or Collected) donations in the order they were added
+        Starts after after_row; reserved_only restricts the rows to Reserved donations.
+        Rows that have left the index are never visited.
+        """
+
+        pointers = self._next_reserved if reserved_only else self._next_live
+
+        row = _skip(pointers, after_row + 1)
+        while row < len(pointers):
+            yield row
+            row = _skip(pointers, row + 1)
+
+    def iter_settled_rows(self, before_timestamp):
+        """
+        Iterate the rows of Collected or Expired donations last updated at or before a timestamp
+        Rows come in the order they were settled, from an index of settled rows, so the
+        cost is in proportion to the rows returned.
+        """
+
+        if self._settled is None:
+            self._settled = sorted((self._updated_time[row], row) for row in range(len(self._donation_ids))
+                                   if self._overall_status[row] != STATUS_CODES[RESERVED])
+
+        end = bisect_right(self._settled, (before_timestamp, len(self._donation_ids)))
+        for timestamp, row in self._settled[:end]:
+            if self._updated_time[row] == timestamp and self._overall_status[row] != STATUS_CODES[RESERVED] \
+                    and self._rows.get(self._donation_ids[row]) == row:
+                yield row
+
+    def without(self, rows):
+        """
+        A new state holding every donation but the given rows, in the same order
+        Rows and allocation indexes are renumbered, so records and allocations read from
+        this state do not carry over; reservation sequences are kept. The running fund totals
+        and counts are carried over as they are, so fund summaries still cover the donations
+        left out.
+        The new state is built from every row kept, so this costs time in proportion to the
+        rows kept, not to the rows left out.
+        """
+
+        left_out = set(rows)
+        renumbered = {}
+        state = AllocationState(amount_typecode=self.amount_typecode)
+        for match_fund_id in self._fund_ids:
+            state._add_fund(match_fund_id)
+
+        for row in range(len(self._donation_ids)):
+            donation_id = self._donation_ids[row]
+            if row in left_out or self._rows.get(donation_id) != row:
+                continue
+
+            new_row = state.add(donation_id, self._original_donation[row], self._donation_balance_unmatched[row], [],
+                                from_timestamp(self._created_time[row]))
+            renumbered[row] = new_row
+            for index in self.iter_allocation_indexes(row):
+                new_index = state.add_allocation(new_row, self.allocation_fund_id(index), self._allocation_amount[index])
+                state._allocation_status[new_index] = self._allocation_status[index]
+
+            code = self._overall_status[row]
+            state._overall_status[new_row] = code
+            state._updated_time[new_row] = self._updated_time[row]
+            state._sequence[new_row] = self._sequence[row]
+            if code != STATUS_CODES[RESERVED]:
+                state._next_reserved[new_row] = new_row + 1
+            if code == STATUS_CODES[EXPIRED]:
+                state._next_live[new_row] = new_row + 1
+
+        for column, totals in zip(state._fund_totals + state._fund_counts, self._fund_totals + self._fund_counts):
+            for fund in range(len(self._fund_ids)):
+                column[fund] = totals[fund]
+
+        # renumbering keeps the row order, so the settled index stays sorted
+        state._settled = None if self._settled is None else \
+            [(timestamp, renumbered[row]) for timestamp, row in self._settled if row in renumbered]
+        state.next_sequence = self.next_sequence
+        state.version = self.version + 1
+        return state
+
+    def iter_allocation_indexes(self, row):
+        index = self._first_allocation[row]
+        while index != NO_ALLOCATION:
+            yield index
+            index = self._next_allocation[index]
+
+    def allocations(self, row):
+        return [Allocation(self, index) for index in self.iter_allocation_indexes(row)]
+
+    def matches(self, row):
+        """
+        Returns the list of (match_fund_id, amount) allocated to a donation
+        """
+
+        return [(self._fund_ids[self._allocation_fund[index]], self._allocation_amount[index])
+                for index in self.iter_allocation_indexes(row)]
+
+    def unmatched(self, row):
+        return self._donation_balance_unmatched[row]
+
+    def backfill(self, row, matches, donation_balance_unmatched):
+        """
+        Append reserved allocations to a donation, with the unmatched balance they leave
+        """
+
+        for match_fund_id, amount in matches:
+            self.add_allocation(row, match_fund_id, amount)
+        self._donation_balance_unmatched[row] = donation_balance_unmatched
+        self.version += 1
+
+    def allocation_fund_id(self, index):
+        return self._fund_ids[self._allocation_fund[index]]
+
+    def allocation_amount(self, index):
+        return self._allocation_amount[index]
+
+    def allocation_status(self, index):
+        return STATUSES[self._allocation_status[index]]
+
+    def set_allocation_status(self, index, status):
+        self.version += 1
+        self._move_allocation(index, STATUS_CODES[status])
+
+    def allocation_row(self, index):
+        return self._allocation_row[index]
+
+    def iter_fund_allocation_indexes(self, match_fund_id):
+        """
+        Iterate the allocations made from a match fund, in the order they were made
+        """
+
+        fund = self._fund_index.get(match_fund_id)
+        index = NO_ALLOCATION if fund is None else self._fund_first_allocation[fund]
+        while index != NO_ALLOCATION:
+            yield index
+            index = self._next_fund_allocation[index]
+
+    def fund_totals(self, match_fund_id):
+        """
+        Returns the total amount and the number of a match fund's allocations, by status
+        """
+
+        fund = self._fund_index.get(match_fund_id)
+        if fund is None:
+            return {status: 0 for status in STATUSES}, {status: 0 for status in STATUSES}
+
+        return ({status: self._fund_totals[code][fund] for status, code in STATUS_CODES.items()},
+                {status: self._fund_counts[code][fund] for status, code in STATUS_CODES.items()})
+
+    def field(self, row, key):
+        if key == 'allocations':
+            return self.allocations(row)
+        if key == 'created_time':
+            return from_timestamp(self._created_time[row])
+        if key == 'updated_time':
+            return from_timestamp(self._updated_time[row])
+        if key == 'original_donation':
+            return self._original_donation[row]
+        if key == 'donation_balance_unmatched':
+            return self._donation_balance_unmatched[row]
+        if key == 'overall_status':
+            return STATUSES[self._overall_status[row]]
+        raise KeyError(key)
+
+    def to_dict(self, row):
+        """
+        Returns a plain dict of a donation, as listed by list_match_fund_allocations
+        """
+
+        return {
+            'donation_id': self._donation_ids[row],
+            'allocations': [{
+                'match_fund_id': self._fund_ids[self._allocation_fund[index]],
+                'match_fund_allocation': self._allocation_amount[index],
+                'status': STATUSES[self._allocation_status[index]]
+            } for index in self.iter_allocation_indexes(row)],
+            'created_time': from_timestamp(self._created_time[row]),
+            'updated_time': from_timestamp(self._updated_time[row]),
+            'original_donation': self._original_donation[row],
+            'donation_balance_unmatched': self._donation_balance_unmatched[row],
+            'overall_status': STATUSES[self._overall_status[row]]
+        }
+
+class AllocationRecord(Mapping):
+    """
+    Read-only view of one donation in an AllocationState
+    """
+
+    __slots__ = ('_state', '_row')
+
+    def __init__(self, state, row):
+        self._state = state
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._state.field(self._row, key)
+
+    def __iter__(self):
+        return iter(RECORD_KEYS)
+
+    def __len__(self):
+        return len(RECORD_KEYS)
+
+    @property
+    def row(self):
+        return self._row
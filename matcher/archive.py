@@ -0,0 +1,253 @@
+from itertools import groupby
+from matcher.allocation import STATUSES, STATUS_CODES
+from matcher.allocation_state import from_timestamp
+from matcher.dedup import BloomFilter
+from operator import itemgetter
+import sqlite3
+import threading
+
+DEFAULT_CAPACITY = 1000000
+
+# donations read per query while iterating the archive
+PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS donations (
+    seq INTEGER PRIMARY KEY,
+    sequence INTEGER NOT NULL,
+    donation_id UNIQUE NOT NULL,
+    original_donation,
+    donation_balance_unmatched,
+    overall_status INTEGER NOT NULL,
+    created_time INTEGER NOT NULL,
+    updated_time INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS allocations (
+    seq INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    match_fund_id NOT NULL,
+    amount,
+    status INTEGER NOT NULL,
+    PRIMARY KEY (seq, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS donations_by_status ON donations (overall_status, sequence, seq);
+CREATE INDEX IF NOT EXISTS donations_by_sequence ON donations (sequence, seq);
+CREATE INDEX IF NOT EXISTS allocations_by_fund ON allocations (match_fund_id, seq, position);
+"""
+
+DONATION_FIELDS = "d.sequence, d.seq, d.donation_id, d.original_donation, d.donation_balance_unmatched, d.overall_status, " \
+                  "d.created_time, d.updated_time, a.match_fund_id, a.amount, a.status"
+
+class ArchivedAllocation(object):
+    """
+    Read-only allocation of an archived donation, with the attributes of Allocation
+    """
+
+    __slots__ = ('match_fund_id', 'match_fund_allocation', 'status')
+
+    def __init__(self, match_fund_id, match_fund_allocation, status):
+        self.match_fund_id = match_fund_id
+        self.match_fund_allocation = match_fund_allocation
+        self.status = status
+
+    def to_dict(self):
+        return {
+            "match_fund_id": self.match_fund_id,
+            "match_fund_allocation": self.match_fund_allocation,
+            "status": self.status
+        }
+
+class Archive(object):
+    """
+    Cold store of settled donations moved out of an allocation state, in SQLite
+    Donations are kept with their allocations and their reservation sequence (see
+    AllocationState.sequence), and are listed in that order, so that archived and
+    in-memory donations interleave as they were reserved. They are never changed once
+    there: only Collected and Expired donations are archived.
+    A Bloom filter of the archived donation ids is held in memory, so looking up a
+    donation id that was never archived, as every new reservation does, seldom reaches
+    the database. It is sized for capacity ids; past that it lets more lookups through.
+    Donation ids are stored as they are, so 42 and "42" stay apart. The path may be
+    ":memory:" for an archive that lasts as long as the process.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, error_rate=0.001):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+        self._bloom_filter = BloomFilter(capacity, error_rate)
+        for donation_id, in self._connection.execute("SELECT donation_id FROM donations"):
+            self._bloom_filter.add(donation_id)
+
+    def add(self, state, rows):
+        """
+        Copy the given rows of an allocation state into the archive, in one transaction
+        Donation ids already archived, as when a log is replayed after a crash, are skipped.
+        """
+
+        with self._lock, self._connection:
+            for row in rows:
+                donation_id = state.donation_id(row)
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO donations (sequence, donation_id, original_donation, donation_balance_unmatched, "
+                    "overall_status, created_time, updated_time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (state.sequence(row), donation_id, state._original_donation[row], state._donation_balance_unmatched[row],
+                     state._overall_status[row], state._created_time[row], state._updated_time[row]))
+                if not cursor.rowcount:
+                    continue
+
+                seq = cursor.lastrowid
+                self._connection.executemany(
+                    "INSERT INTO allocations (seq, position, match_fund_id, amount, status) VALUES (?, ?, ?, ?, ?)",
+                    [(seq, position, state.allocation_fund_id(index), state._allocation_amount[index],
+                      state._allocation_status[index])
+                     for position, index in enumerate(state.iter_allocation_indexes(row))])
+                self._bloom_filter.add(donation_id)
+
+    def __contains__(self, donation_id):
+        return self._seq(donation_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM donations").fetchone()[0]
+
+    def status(self, donation_id):
+        """
+        Overall status of an archived donation, or None if it is not archived
+        """
+
+        if donation_id not in self._bloom_filter:
+            return None
+        with self._lock:
+            found = self._connection.execute("SELECT overall_status FROM donations WHERE donation_id = ?",
+                                             (donation_id,)).fetchone()
+        return None if found is None else STATUSES[found[0]]
+
+    def record(self, donation_id):
+        """
+        An archived donation with the keys of an AllocationRecord, or None if it is not archived
+        """
+
+        seq = self._seq(donation_id)
+        if seq is None:
+            return None
+        _, doc = next(self._iter_pages("d.seq = ?", (seq,)))
+        del doc['donation_id']
+        doc['allocations'] = [ArchivedAllocation(**allocation) for allocation in doc['allocations']]
+        return doc
+
+    def matches(self, donation_id):
+        """
+        Returns the list of (match_fund_id, amount) allocated to an archived donation
+        """
+
+        return [(allocation.match_fund_id, allocation.match_fund_allocation)
+                for allocation in self.record(donation_id)['allocations']]
+
+    def iter_dicts(self, after=None, status=None):
+        """
+        Iterate archived donations as (reservation sequence, plain dict), the dicts as listed
+        by list_match_fund_allocations
+        Donations come in reservation sequence order, starting after the listing key after
+        (see listing_key), and status keeps only donations with that overall status.
+        """
+
+        after = (-1, 0) if after is None else after
+        if status is None:
+            return self._iter_pages("(d.sequence, d.seq) > (?, ?)", after, paged=True)
+        return self._iter_pages("d.overall_status = ? AND (d.sequence, d.seq) > (?, ?)",
+                                (STATUS_CODES[status],) + after, paged=True)
+
+    def next_sequence(self):
+        """
+        Reservation sequence after every one archived, for a matcher that takes on this archive
+        """
+
+        with self._lock:
+            last = self._connection.execute("SELECT MAX(sequence) FROM donations").fetchone()[0]
+        return 0 if last is None else last + 1
+
+    def listing_key(self, donation_id):
+        """
+        Position of an archived donation in the listings, as (reservation sequence, archive
+        order), or None if it is not archived
+        """
+
+        if donation_id not in self._bloom_filter:
+            return None
+        with self._lock:
+            return self._connection.execute("SELECT sequence, seq FROM donations WHERE donation_id = ?",
+                                            (donation_id,)).fetchone()
+
+    def iter_fund_allocations(self, match_fund_id):
+        """
+        Iterate the archived allocations of a match fund, as (donation_id, amount, status)
+        """
+
+        last = (0, -1)
+        while True:
+            with self._lock:
+                page = self._connection.execute(
+                    "SELECT a.seq, a.position, d.donation_id, a.amount, a.status FROM allocations a "
+                    "JOIN donations d ON d.seq = a.seq WHERE a.match_fund_id = ? AND (a.seq, a.position) > (?, ?) "
+                    "ORDER BY a.seq, a.position LIMIT ?", (match_fund_id,) + last + (PAGE_SIZE,)).fetchall()
+            for _, _, donation_id, amount, status in page:
+                yield donation_id, amount, STATUSES[status]
+            if len(page) < PAGE_SIZE:
+                return
+            last = page[-1][:2]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _seq(self, donation_id):
+        if donation_id not in self._bloom_filter:
+            return None
+        with self._lock:
+            found = self._connection.execute("SELECT seq FROM donations WHERE donation_id = ?",
+                                             (donation_id,)).fetchone()
+        return None if found is None else found[0]
+
+    def _iter_pages(self, condition, parameters, paged=False):
+        """
+        Iterate the donations matching a condition, with their allocations, as (reservation
+        sequence, plain dict), in reservation sequence order
+        With paged set, the condition ends in "(d.sequence, d.seq) > (?, ?)" and is run a
+        page at a time.
+        """
+
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT %s FROM (SELECT * FROM donations d WHERE %s ORDER BY d.sequence, d.seq LIMIT ?) d "
+                    "LEFT JOIN allocations a ON a.seq = d.seq ORDER BY d.sequence, d.seq, a.position"
+                    % (DONATION_FIELDS, condition), parameters + (PAGE_SIZE,)).fetchall()
+
+            key = None
+            count = 0
+            for key, donation_rows in groupby(rows, key=itemgetter(0, 1)):
+                count += 1
+                yield key[0], _to_dict(list(donation_rows))
+            if not paged or count < PAGE_SIZE:
+                return
+            parameters = parameters[:-2] + key
+
+def _to_dict(donation_rows):
+    _, _, donation_id, original_donation, donation_balance_unmatched, overall_status, created_time, updated_time = \
+        donation_rows[0][:8]
+    return {
+        'donation_id': donation_id,
+        'allocations': [{
+            'match_fund_id': match_fund_id,
+            'match_fund_allocation': amount,
+            'status': STATUSES[status]
+        } for _, _, _, _, _, _, _, _, match_fund_id, amount, status in donation_rows if match_fund_id is not None],
+        'created_time': from_timestamp(created_time),
+        'updated_time': from_timestamp(updated_time),
+        'original_donation': original_donation,
+        'donation_balance_unmatched': donation_balance_unmatched,
+        'overall_status': STATUSES[overall_status]
+    }
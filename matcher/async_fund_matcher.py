@@ -0,0 +1,139 @@
+from matcher.exceptions import BadRequestException
+import asyncio
+
+# Operations queued by AsyncFundMatcher
+RESERVE = "reserve"
+COLLECT = "collect"
+EXPIRE = "expire"
+
+DEFAULT_MAX_BATCH_SIZE = 256
+DEFAULT_MAX_DELAY = 0.002
+
+class AsyncFundMatcher(object):
+    """
+    Asyncio front-end to a FundMatcher that micro-batches requests
+    Requests are queued as they arrive and applied to the matcher in one pass when
+    max_batch_size requests are waiting, or max_delay seconds after the first one
+    arrived, whichever comes first. Requests are applied in arrival order, with runs
+    of reservations going through reserve_funds_batch.
+    Raising max_delay and max_batch_size trades latency for throughput.
+    Each caller gets back its own result, or its own exception. Any other exception
+    raised by the matcher, such as an OSError from a write-ahead log that could not
+    sync, goes to every caller of the call that raised it, and the rest of the batch
+    is still applied.
+    The matcher is called on the event loop's thread, so the loop waits on each pass,
+    log syncs included; a matcher slow enough to hold up other tasks should be fronted
+    by one that hands its calls to an executor.
+    """
+
+    def __init__(self, fund_matcher, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_delay=DEFAULT_MAX_DELAY):
+        if max_batch_size < 1:
+            raise BadRequestException("max_batch_size must be at least 1, %s" % max_batch_size)
+
+        self.fund_matcher = fund_matcher
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self._pending = []
+        self._flush_handle = None
+
+    async def reserve(self, donation):
+        """
+        Reserve a donation, returning its allocation state
+        """
+
+        return await self._submit(RESERVE, donation)
+
+    async def collect(self, donation_id):
+        await self._submit(COLLECT, donation_id)
+
+    async def expire(self, donation_id):
+        await self._submit(EXPIRE, donation_id)
+
+    async def flush(self):
+        """
+        Apply every queued request now
+        """
+
+        self._flush()
+
+    def _submit(self, operation, argument):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((operation, argument, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_delay, self._flush)
+
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+
+        ix = 0
+        while ix < len(batch):
+            operation = batch[ix][0]
+
+            if operation == RESERVE:
+                end = ix
+                while end < len(batch) and batch[end][0] == RESERVE:
+                    end += 1
+                self._reserve_run(batch[ix:end])
+                ix = end
+                continue
+
+            _, donation_id, future = batch[ix]
+            try:
+                if operation == COLLECT:
+                    self.fund_matcher.collect_donation(donation_id)
+                else:
+                    self.fund_matcher.expire_donation(donation_id)
+            except Exception as e:
+                _set_exception(future, e)
+            else:
+                _set_result(future, None)
+            ix += 1
+
+    def _reserve_run(self, requests):
+        """
+        Reserve a run of consecutive reservations in one batch
+        A batch rejected as a whole, as for a retry with a different amount, changes
+        nothing; the run is then reserved one request at a time, so that only the
+        caller that made the bad request gets the exception. Any other exception goes to
+        every caller of the run.
+        """
+
+        donations = [donation for _, donation, _ in requests]
+        try:
+            results = self.fund_matcher.reserve_funds_batch(donations)
+        except BadRequestException:
+            for _, donation, future in requests:
+                try:
+                    result = self.fund_matcher.reserve_funds(donation)
+                except Exception as e:
+                    _set_exception(future, e)
+                else:
+                    _set_result(future, result)
+            return
+        except Exception as e:
+            for _, _, future in requests:
+                _set_exception(future, e)
+            return
+
+        for (_, _, future), result in zip(requests, results):
+            _set_result(future, result)
+
+def _set_result(future, result):
+    # the caller may have been cancelled while its request was queued
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
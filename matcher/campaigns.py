@@ -0,0 +1,261 @@
+from collections import OrderedDict
+from matcher.allocation_state import AllocationRecord
+from matcher.async_fund_matcher import RESERVE, COLLECT, EXPIRE
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import FundMatcher
+from matcher.snapshot import write_snapshot, open_snapshot
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import zlib
+
+# Operations routed by CampaignRegistry, as (operation, campaign_id, argument), besides
+# RESERVE (a Donation), COLLECT and EXPIRE (a donation id)
+CREATE = "create"      # argument: list of MatchFunds
+SUMMARY = "summary"    # argument: None
+
+OPERATIONS = (CREATE, RESERVE, COLLECT, EXPIRE, SUMMARY)
+
+DEFAULT_MAX_RESIDENT = 64
+
+class CampaignRegistry(object):
+    """
+    Many independent campaigns, each with its own FundMatcher, spread over worker processes
+    A campaign belongs to one worker, picked by a stable hash of its id, which holds its
+    matcher in memory; every call for the campaign is routed there, so campaigns on
+    different workers run on different cores. execute() takes a batch of operations
+    for any campaigns, sends each worker its share as one message, lets the workers run
+    at the same time and hands back one outcome per operation, in order.
+    Each worker keeps at most max_resident campaigns in memory; the least recently used
+    is written to a snapshot in directory and dropped, and opened again from there the
+    next time it is called. close() writes out every campaign, so a registry opened on
+    the same directory, with the same number of workers or not, carries on where it
+    left off. Campaigns are only written out on eviction and close: a worker that
+    dies loses the changes to the campaigns it held.
+    """
+
+    def __init__(self, directory, workers=None, max_resident=DEFAULT_MAX_RESIDENT):
+        if max_resident < 1:
+            raise BadRequestException("max_resident must be at least 1, %s" % max_resident)
+
+        self.directory = directory
+        self.workers = workers or os.cpu_count() or 1
+        self.max_resident = max_resident
+        os.makedirs(directory, exist_ok=True)
+
+        self._connections = []
+        self._processes = []
+        self._locks = []
+        for _ in range(self.workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_worker, args=(worker_connection, directory, max_resident),
+                                              daemon=True)
+            process.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+            self._locks.append(threading.Lock())
+
+    def create_campaign(self, campaign_id, match_funds):
+        self._one(CREATE, campaign_id, list(match_funds))
+
+    def reserve_funds(self, campaign_id, donation):
+        """
+        Reserve a donation in a campaign
+        Returns the allocation state of the donation, as a plain dict
+        """
+
+        return self._one(RESERVE, campaign_id, donation)
+
+    def collect_donation(self, campaign_id, donation_id):
+        self._one(COLLECT, campaign_id, donation_id)
+
+    def expire_donation(self, campaign_id, donation_id):
+        self._one(EXPIRE, campaign_id, donation_id)
+
+    def get_summary(self, campaign_id):
+        return self._one(SUMMARY, campaign_id, None)
+
+    def execute(self, operations):
+        """
+        Run a batch of (operation, campaign_id, argument) operations, one message per worker
+        Operations on one campaign are applied in the order given; those on campaigns of
+        different workers run in parallel.
+        Returns one outcome per operation, in order: the result of the operation (the
+        allocation state as a plain dict for RESERVE, the summary for SUMMARY, otherwise
+        None), or the exception it raised: a BadRequestException explaining why it was
+        refused, or any other exception raised by a malformed operation
+        """
+
+        operations = list(operations)
+        shares = {}
+        for ix, (operation, campaign_id, argument) in enumerate(operations):
+            if operation not in OPERATIONS:
+                raise BadRequestException("Invalid operation %s" % operation)
+            shares.setdefault(self.worker_of(campaign_id), []).append(ix)
+
+        workers = sorted(shares)
+        for worker in workers:
+            self._locks[worker].acquire()
+        try:
+            for worker in workers:
+                self._connections[worker].send([operations[ix] for ix in shares[worker]])
+
+            outcomes = [None] * len(operations)
+            for worker in workers:
+                for ix, outcome in zip(shares[worker], self._connections[worker].recv()):
+                    outcomes[ix] = outcome
+        finally:
+            for worker in workers:
+                self._locks[worker].release()
+
+        return outcomes
+
+    def worker_of(self, campaign_id):
+        return zlib.crc32(_encode_id(campaign_id)) % self.workers
+
+    def close(self):
+        """
+        Write every campaign out to its snapshot and stop the workers
+        """
+
+        for worker, connection in enumerate(self._connections):
+            with self._locks[worker]:
+                connection.send(None)
+                connection.recv()
+                connection.close()
+        for process in self._processes:
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _one(self, operation, campaign_id, argument):
+        outcome, = self.execute([(operation, campaign_id, argument)])
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+class CampaignWorker(object):
+    """
+    The campaigns of one worker process, at most max_resident of them in memory
+    """
+
+    def __init__(self, directory, max_resident):
+        self.directory = directory
+        self.max_resident = max_resident
+        # campaign id: (fund_matcher, state version as last written to its snapshot)
+        self._resident = OrderedDict()
+
+    def execute(self, operations):
+        """
+        Apply a worker's share of a batch, a campaign at a time
+        Operations are taken campaign by campaign, in the order given for each, so each
+        campaign is looked up, and loaded if need be, once per batch. Reservations are
+        made one by one: with runs as short as those of a mix of campaigns,
+        reserve_funds_batch costs more per donation than it saves.
+        An operation that raises, for whatever reason, has the exception as its outcome,
+        so one malformed operation cannot take down the worker and its campaigns.
+        Returns one outcome per operation, in the order given
+        """
+
+        outcomes = [None] * len(operations)
+        by_campaign = {}
+        for ix, (_, campaign_id, _) in enumerate(operations):
+            try:
+                by_campaign.setdefault(campaign_id, []).append(ix)
+            except TypeError as e:
+                # an unhashable campaign id
+                outcomes[ix] = e
+
+        for campaign_id, indexes in by_campaign.items():
+            fund_matcher = None
+            for ix in indexes:
+                operation, _, argument = operations[ix]
+                try:
+                    if operation == CREATE:
+                        self._create(campaign_id, argument)
+                        continue
+                    if fund_matcher is None:
+                        fund_matcher = self._matcher(campaign_id)
+                    outcomes[ix] = _apply(fund_matcher, operation, argument)
+                except Exception as e:
+                    outcomes[ix] = e
+
+        return outcomes
+
+    def close(self):
+        while self._resident:
+            self._evict()
+
+    def _create(self, campaign_id, match_funds):
+        if campaign_id in self._resident or os.path.exists(self._path(campaign_id)):
+            raise BadRequestException("Campaign %s already exists" % campaign_id)
+        self._admit(campaign_id, FundMatcher(match_funds), None)
+
+    def _matcher(self, campaign_id):
+        resident = self._resident.get(campaign_id)
+        if resident is not None:
+            self._resident.move_to_end(campaign_id)
+            return resident[0]
+
+        path = self._path(campaign_id)
+        if not os.path.exists(path):
+            raise BadRequestException("Invalid campaign id %s" % campaign_id)
+        fund_matcher = open_snapshot(path)
+        self._admit(campaign_id, fund_matcher, fund_matcher._state_version())
+        return fund_matcher
+
+    def _admit(self, campaign_id, fund_matcher, written_version):
+        self._resident[campaign_id] = (fund_matcher, written_version)
+        while len(self._resident) > self.max_resident:
+            self._evict()
+
+    def _evict(self):
+        # a campaign only read since it was loaded is dropped without writing
+        campaign_id, (fund_matcher, written_version) = self._resident.popitem(last=False)
+        if fund_matcher._state_version() != written_version:
+            write_snapshot(fund_matcher, self._path(campaign_id), campaign_id=campaign_id)
+
+    def _path(self, campaign_id):
+        return os.path.join(self.directory, "campaign_%s.snap" % hashlib.sha1(_encode_id(campaign_id)).hexdigest())
+
+def _run_worker(connection, directory, max_resident):
+    worker = CampaignWorker(directory, max_resident)
+    while True:
+        operations = connection.recv()
+        if operations is None:
+            worker.close()
+            connection.send(None)
+            return
+        connection.send(worker.execute(operations))
+
+def _apply(fund_matcher, operation, argument):
+    if operation == RESERVE:
+        return _plain(fund_matcher, argument.donation_id, fund_matcher.reserve_funds(argument))
+    if operation == COLLECT:
+        return fund_matcher.collect_donation(argument)
+    if operation == EXPIRE:
+        return fund_matcher.expire_donation(argument)
+    return fund_matcher.get_summary()
+
+def _plain(fund_matcher, donation_id, allocation_state_doc):
+    """
+    An allocation state as a plain dict, to send between processes
+    """
+
+    if isinstance(allocation_state_doc, AllocationRecord):
+        return fund_matcher.allocation_state.to_dict(allocation_state_doc.row)
+
+    doc = dict(allocation_state_doc)
+    doc['donation_id'] = donation_id
+    doc['allocations'] = [allocation.to_dict() for allocation in doc['allocations']]
+    return doc
+
+def _encode_id(campaign_id):
+    return json.dumps(campaign_id).encode()
@@ -0,0 +1,104 @@
+class FenwickTree(object):
+    """
+    Prefix sums over a list of non-negative values, with updates and searches in O(log n)
+    """
+
+    def __init__(self, values):
+        self._size = len(values)
+        self._tree = [0] + list(values)
+        for ix in range(1, self._size + 1):
+            parent = ix + (ix & -ix)
+            if parent <= self._size:
+                self._tree[parent] += self._tree[ix]
+
+        self._top = 1
+        while self._top * 2 <= self._size:
+            self._top *= 2
+
+    def __len__(self):
+        return self._size
+
+    def add(self, position, delta):
+        ix = position + 1
+        while ix <= self._size:
+            self._tree[ix] += delta
+            ix += ix & -ix
+
+    def prefix_sum(self, count):
+        """
+        Sum of the first count values
+        """
+
+        total = 0
+        while count > 0:
+            total += self._tree[count]
+            count -= count & -count
+        return total
+
+    def search(self, target):
+        """
+        The largest count of leading values that sum to less than target, and their sum
+        """
+
+        position = 0
+        total = 0
+        step = self._top if self._size else 0
+        while step:
+            if position + step <= self._size and total + self._tree[position + step] < target:
+                position += step
+                total += self._tree[position]
+            step //= 2
+        return position, total
+
+class CapacityIndex(object):
+    """
+    Fenwick trees over the balances of a matcher's funds and the donation amount each can absorb, in match_order
+    A fund's capacity is the donation amount that drawing it dry would cover, its
+    balance over its ratio in the float engine, so a donation stops at the first fund
+    where the running capacity reaches its amount. Retired funds count as empty.
+    slack is the most a donation can go beyond the capacity of a fund and still end in
+    it, which only the rounding of minor units leaves above 0; it depends on the ratios
+    alone, so is fixed for the registry the index was built for.
+    Funds whose balance changed are queued in changed and brought up to date by
+    refresh(), each in O(log n). Float sums drift as values are updated, so the trees
+    are rebuilt once there have been as many updates as funds.
+    """
+
+    def __init__(self, fund_matcher, registry_version=None):
+        self.registry_version = registry_version
+        self.changed = set()
+        self.fund_ids = [fund_key[2] for fund_key in fund_matcher._fund_order]
+        self._positions = {match_fund_id: position for position, match_fund_id in enumerate(self.fund_ids)}
+        self.slack = max([fund_matcher._capacity_slack(fund_matcher.match_funds[match_fund_id])
+                          for match_fund_id in self.fund_ids], default=0)
+        self._build(fund_matcher)
+
+    def refresh(self, fund_matcher):
+        while self.changed:
+            # taken off the queue before the balance is read, so a change made meanwhile is queued again
+            match_fund_id = self.changed.pop()
+            position = self._positions[match_fund_id]
+            balance, capacity = self._values(fund_matcher, match_fund_id)
+            self.balances.add(position, balance - self._balances[position])
+            self.capacities.add(position, capacity - self._capacities[position])
+            self._balances[position] = balance
+            self._capacities[position] = capacity
+
+            self._updates += 1
+            if self._updates > len(self.fund_ids):
+                self._build(fund_matcher)
+
+    def _build(self, fund_matcher):
+        values = [self._values(fund_matcher, match_fund_id) for match_fund_id in self.fund_ids]
+        self._balances = [balance for balance, _ in values]
+        self._capacities = [capacity for _, capacity in values]
+        self.balances = FenwickTree(self._balances)
+        self.capacities = FenwickTree(self._capacities)
+        self._updates = 0
+
+    def _values(self, fund_matcher, match_fund_id):
+        match_fund = fund_matcher.match_funds[match_fund_id]
+        balance = match_fund.total_amount
+        if balance == 0 or fund_matcher.is_retired(match_fund_id):
+            return 0, 0
+        return balance, fund_matcher._fund_capacity(match_fund)
@@ -0,0 +1,302 @@
+from bisect import bisect_left, bisect_right, insort
+from contextlib import ExitStack
+from matcher.allocation import RESERVED, EXPIRED
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import FundMatcher
+from datetime import datetime
+import threading
+
+class ConcurrentFundMatcher(FundMatcher):
+    """
+    Thread safe FundMatcher with a lock per match fund
+    A reservation walks the active funds in match_order hand over hand: it takes the
+    lock of the next fund before letting go of the one it holds, so a later reservation
+    can never overtake an earlier one on the way down the funds. Fund locks are ranked
+    by registration position, which never changes: expiry and batches take them in that
+    order, and a reservation whose next fund ranks below the one it holds lets go first.
+    Every wait for a fund lock is therefore in one global order, which rules out
+    deadlock, even as funds are added or reordered. Funds registered in match_order, as
+    at construction, never need the let-go step.
+    The active fund index and the allocation state each have a short lock of their
+    own, which is never held while waiting for a fund lock.
+    A donation id being reserved is claimed under the state lock until its row is
+    added, so a retry racing the original waits for it and is answered as a replay.
+    With backfill enabled, capacity released by an expiry, top up or new fund is
+    backfilled once the release is done, holding every fund lock.
+    """
+
+    def __init__(self, match_funds):
+        super().__init__(match_funds)
+
+        self._fund_locks = {match_fund_id: threading.Lock() for match_fund_id in self.match_funds}
+        self._index_lock = threading.Lock()
+        self._state_lock = threading.RLock()
+        # donation ids being reserved, each with an event set once its row is added
+        self._claims = {}
+
+    def reserve_funds(self, donation):
+        """
+        Reserve a donation against match funds
+        Safe to call from many threads; see FundMatcher.reserve_funds
+        """
+
+        donation_id = donation.donation_id
+        while True:
+            with self._state_lock:
+                allocation_state_doc = self._reserved_before(donation_id, donation.amount)
+                if allocation_state_doc is not None:
+                    return allocation_state_doc
+                claim = self._claims.get(donation_id)
+                if claim is None:
+                    claim = self._claims[donation_id] = threading.Event()
+                    break
+            claim.wait()
+
+        try:
+            matches, donation_balance = self._match_amount_hand_over_hand(donation.amount)
+
+            with self._state_lock:
+                row = self.allocation_state.add(donation_id, donation.amount, donation_balance, matches, datetime.now())
+                self._queue_backfill(donation_id, donation_balance)
+                return self.allocation_state.record(row)
+        finally:
+            with self._state_lock:
+                del self._claims[donation_id]
+            claim.set()
+
+    def _reserve_columns(self, donation_ids, amounts):
+        """
+        Reserve a batch of donations holding every fund lock, in match_order
+        With every lock held the unlocked batch path of FundMatcher is safe to use. A
+        batch holding the id of a reservation in progress lets go and waits for it first.
+        """
+
+        while True:
+            with self._all_funds_locked(), self._state_lock:
+                claim = next((self._claims[donation_id] for donation_id in donation_ids
+                              if donation_id in self._claims), None) if self._claims else None
+                if claim is None:
+                    return super()._reserve_columns(donation_ids, amounts)
+            claim.wait()
+
+    def collect_donation(self, donation_id):
+        with self._state_lock:
+            super().collect_donation(donation_id)
+
+    def expire_donation(self, donation_id):
+        """
+        Expire a donation and return its matched funds
+        The donation is marked as Expired under the state lock first, so only one
+        caller can claim the refund. The funds are then credited holding their locks.
+        """
+
+        with self._state_lock:
+            if donation_id not in self.allocation_state:
+                self._check_not_archived(donation_id)
+                raise BadRequestException("Invalid donation_id %s" % donation_id)
+
+            row = self.allocation_state.row(donation_id)
+
+            if not self.allocation_state.status(row) == RESERVED:
+                raise BadRequestException("Invalid collection request. Allocation is not reserved")
+
+            matches = self.allocation_state.matches(row)
+            self.allocation_state.set_status(row, EXPIRED, datetime.now())
+
+        match_fund_ids = sorted(set(match_fund_id for match_fund_id, _ in matches), key=self._lock_rank)
+        with self._funds_locked(match_fund_ids):
+            for match_fund_id, amount in matches:
+                self._credit_fund(self.match_funds[match_fund_id], amount)
+        self._backfill_locked()
+
+    def collect_donations(self, donation_ids, atomic=True):
+        with self._state_lock:
+            return super().collect_donations(donation_ids, atomic)
+
+    def expire_donations(self, donation_ids, atomic=True):
+        """
+        Expire many donations and return their matched funds
+        As with expire_donation, the donations are claimed under the state lock and the
+        summed refunds are credited afterwards, holding the locks of the funds concerned.
+        """
+
+        donation_ids = list(donation_ids)
+
+        with self._state_lock:
+            rows, outcomes = self._validate_reserved(donation_ids, EXPIRED, atomic)
+            refunds = self._refunds(rows)
+            now = datetime.now()
+            for row in rows:
+                self.allocation_state.set_status(row, EXPIRED, now)
+
+        with self._funds_locked(sorted(refunds, key=self._lock_rank)):
+            for match_fund_id, amount in refunds.items():
+                self._credit_fund(self.match_funds[match_fund_id], amount)
+        self._backfill_locked()
+
+        return outcomes
+
+    def add_match_fund(self, match_fund):
+        self._fund_locks.setdefault(match_fund.match_fund_id, threading.Lock())
+        with self._index_lock:
+            super().add_match_fund(match_fund)
+        self._backfill_locked()
+
+    def top_up(self, match_fund_id, amount):
+        self._registered_fund(match_fund_id)
+        with self._fund_locks[match_fund_id]:
+            super().top_up(match_fund_id, amount)
+        self._backfill_locked()
+
+    def retire_match_fund(self, match_fund_id):
+        self._registered_fund(match_fund_id)
+        with self._fund_locks[match_fund_id], self._index_lock:
+            return super().retire_match_fund(match_fund_id)
+
+    def reorder_match_fund(self, match_fund_id, match_order):
+        self._registered_fund(match_fund_id)
+        with self._fund_locks[match_fund_id], self._index_lock:
+            super().reorder_match_fund(match_fund_id, match_order)
+
+    def archive_settled(self, min_age):
+        with self._state_lock:
+            return super().archive_settled(min_age)
+
+    def get_allocation(self, donation_id):
+        with self._state_lock:
+            return super().get_allocation(donation_id)
+
+    def get_fund_summary(self, match_fund_id):
+        with self._state_lock:
+            return super().get_fund_summary(match_fund_id)
+
+    def get_summary(self):
+        with self._state_lock:
+            return super().get_summary()
+
+    def list_match_fund_allocations(self, limit=None, after_donation_id=None, status=None):
+        with self._state_lock:
+            return super().list_match_fund_allocations(limit, after_donation_id, status)
+
+    def quote(self, amount, breakdown=False):
+        """
+        Quote a donation amount, see FundMatcher.quote
+        Balances are read without their fund locks, so a quote may be a draw behind.
+        """
+
+        with self._index_lock:
+            return super().quote(amount, breakdown)
+
+    def enable_backfill(self):
+        with self._all_funds_locked(), self._state_lock:
+            super().enable_backfill()
+            super()._funds_released()
+
+    def _funds_released(self):
+        # the base class backfills from inside a release, holding only some of the locks;
+        # here it is done by _backfill_locked once the release is done
+        pass
+
+    def _backfill_locked(self):
+        """
+        Backfill queued donations holding every fund lock, as a batch reservation does
+        """
+
+        if not self._backfill_queue:
+            return
+        with self._all_funds_locked(), self._state_lock:
+            super()._funds_released()
+
+    def _match_amount_hand_over_hand(self, donation_balance):
+        """
+        Draw a donation amount from the active match funds, taking their locks hand over hand
+        """
+
+        matches = []
+        fund_key = None
+        held_lock = None
+        held_rank = None
+
+        try:
+            while donation_balance != 0:
+                with self._index_lock:
+                    ix = 0 if fund_key is None else bisect_right(self._active_funds, fund_key)
+                    if ix == len(self._active_funds):
+                        break
+                    fund_key = self._active_funds[ix]
+
+                fund_lock = self._fund_locks[fund_key[2]]
+                if held_lock is not None and fund_key[1] < held_rank:
+                    # a fund added or reordered ahead of its rank; never wait out of rank order
+                    held_lock.release()
+                    held_lock = None
+                fund_lock.acquire()
+                if held_lock is not None:
+                    held_lock.release()
+                held_lock = fund_lock
+                held_rank = fund_key[1]
+
+                # the fund may have been reordered before its lock was taken; with the lock held its key is current
+                fund_key = self._fund_keys[fund_key[2]]
+                match_fund = self.match_funds[fund_key[2]]
+                if match_fund.total_amount == 0 or fund_key[2] in self._retired:
+                    # drained or retired by another thread since the index was read
+                    continue
+
+                allocated_amount, donation_balance = self._draw_from_fund(match_fund, donation_balance)
+                matches.append((match_fund.match_fund_id, allocated_amount))
+                self._balance_changed(match_fund.match_fund_id)
+
+                if match_fund.total_amount == 0:
+                    self._deactivate_fund(fund_key)
+        finally:
+            if held_lock is not None:
+                held_lock.release()
+
+        return matches, donation_balance
+
+    def _deactivate_fund(self, fund_key):
+        with self._index_lock:
+            ix = bisect_left(self._active_funds, fund_key)
+            if ix < len(self._active_funds) and self._active_funds[ix] == fund_key:
+                del self._active_funds[ix]
+
+    def _credit_fund(self, match_fund, amount):
+        was_exhausted = match_fund.total_amount == 0
+        match_fund.total_amount += amount
+        self._balance_changed(match_fund.match_fund_id)
+
+        if was_exhausted and match_fund.total_amount != 0 and match_fund.match_fund_id not in self._retired:
+            with self._index_lock:
+                insort(self._active_funds, self._fund_keys[match_fund.match_fund_id])
+
+    def _funds_locked(self, match_fund_ids):
+        """
+        Context manager holding the locks of the given funds, taken in match_order
+        """
+
+        stack = ExitStack()
+        for match_fund_id in match_fund_ids:
+            stack.enter_context(self._fund_locks[match_fund_id])
+        return stack
+
+    def _all_funds_locked(self):
+        """
+        Context manager holding every fund lock, in rank order, then the index lock
+        The funds are listed before their locks are taken, and a fund added meanwhile
+        would be left unlocked; the index lock, under which funds are added, cannot be held
+        while waiting for fund locks, so once it is taken the list is checked against the
+        registry, and the locks taken again if it has grown.
+        """
+
+        while True:
+            match_fund_ids = sorted(list(self._fund_keys), key=self._lock_rank)
+            stack = self._funds_locked(match_fund_ids)
+            stack.enter_context(self._index_lock)
+            if len(self._fund_keys) == len(match_fund_ids):
+                return stack
+            stack.close()
+
+    def _lock_rank(self, match_fund_id):
+        # registration position, which reordering leaves alone
+        return self._fund_keys[match_fund_id][1]
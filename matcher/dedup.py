@@ -0,0 +1,46 @@
+from matcher.exceptions import BadRequestException
+import math
+
+class BloomFilter(object):
+    """
+    Set of keys in fixed memory that may answer yes for a key never added, never no for one that was
+    Sized for capacity keys at error_rate false positives; past capacity the rate climbs.
+    Keys are hashed with Python's hash(), which is salted per process, so a filter is
+    rebuilt rather than saved.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity <= 0:
+            raise BadRequestException("Bloom filter capacity must be positive, %s" % capacity)
+        if not 0 < error_rate < 1:
+            raise BadRequestException("Bloom filter error rate must be between 0 and 1, %s" % error_rate)
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, key):
+        h1, h2 = self._hashes(key)
+        for ix in range(self.num_hashes):
+            bit = (h1 + ix * h2) % self.num_bits
+            self._bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        # most keys never added are ruled out by the first bit or two
+        h1, h2 = self._hashes(key)
+        for ix in range(self.num_hashes):
+            bit = (h1 + ix * h2) % self.num_bits
+            if not self._bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def _hashes(self, key):
+        # two hashes stand in for num_hashes hash functions; the second is odd, so the bits probed differ
+        return hash(key), hash((key, self.num_bits)) | 1
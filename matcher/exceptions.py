@@ -1,2 +1,8 @@
 class BadRequestException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class ConflictException(BadRequestException):
+    """
+    Raised when a change cannot be applied because the state it was based on has moved on
+    """
+    pass
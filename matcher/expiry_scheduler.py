@@ -0,0 +1,176 @@
+from matcher.allocation import RESERVED
+from matcher.allocation_state import to_timestamp, from_timestamp
+from matcher.exceptions import BadRequestException
+from datetime import datetime, timedelta
+import asyncio
+import heapq
+import threading
+
+DEFAULT_INTERVAL = 1.0
+
+class ExpiryScheduler(object):
+    """
+    Front-end to a FundMatcher that expires reservations left uncollected for longer than a TTL
+    Reservations made through the scheduler are pushed onto a min-heap keyed by their
+    deadline, created_time + ttl; reservations already in the matcher when the scheduler
+    is created, eg after recovery, are pushed from their created_time. expire_due() pops
+    the overdue reservations and expires them with one expire_donations call, so its cost
+    is in proportion to the number popped, never to the size of the allocation state.
+    Collected or already expired donations are dropped from the heap as they come up.
+    A reservation already in the heap is not pushed again, so retries of a reservation
+    leave the heap as it was.
+    Every other attribute passes through to the matcher.
+    Running expiry from a background thread needs a thread safe matcher, such as
+    ConcurrentFundMatcher; the asyncio task runs on the event loop of the caller.
+    """
+
+    def __init__(self, fund_matcher, ttl):
+        if not isinstance(ttl, timedelta):
+            ttl = timedelta(seconds=ttl)
+        if ttl <= timedelta(0):
+            raise BadRequestException("Reservation TTL must be positive, %s" % ttl)
+
+        self.fund_matcher = fund_matcher
+        self.ttl = ttl
+        self._ttl_microseconds = ttl // timedelta(microseconds=1)
+
+        # (deadline, created timestamp, sequence, donation_id); the sequence keeps the
+        # heap from ever comparing donation ids of different types
+        self._heap = []
+        self._sequence = 0
+        # created timestamp of the newest heap entry of each donation id
+        self._tracked = {}
+        self._lock = threading.Lock()
+
+        self._stopping = None
+        self._thread = None
+
+        state = fund_matcher.allocation_state
+        for row in state.iter_rows(reserved_only=True):
+            self._push(state.donation_id(row), state.created_timestamp(row))
+
+    def __getattr__(self, name):
+        return getattr(self.fund_matcher, name)
+
+    def __len__(self):
+        """
+        Number of reservations waiting in the heap, including ones since collected
+        """
+
+        return len(self._heap)
+
+    def reserve_funds(self, donation):
+        allocation_state_doc = self.fund_matcher.reserve_funds(donation)
+        # a retry of a donation since settled, or archived, has nothing left to expire
+        if allocation_state_doc['overall_status'] == RESERVED:
+            self.track(donation.donation_id)
+        return allocation_state_doc
+
+    def reserve_funds_batch(self, donations):
+        return self._track_batch(self.fund_matcher.reserve_funds_batch(donations))
+
+    def reserve_columns(self, donation_ids, amounts):
+        return self._track_batch(self.fund_matcher.reserve_columns(donation_ids, amounts))
+
+    def _track_batch(self, allocation_state_docs):
+        state = self.fund_matcher.allocation_state
+        with self._lock:
+            for allocation_state_doc in allocation_state_docs:
+                if allocation_state_doc['overall_status'] == RESERVED:
+                    row = allocation_state_doc.row
+                    self._push(state.donation_id(row), state.created_timestamp(row))
+
+        return allocation_state_docs
+
+    def track(self, donation_id):
+        """
+        Schedule the expiry of a reservation made directly on the matcher
+        """
+
+        state = self.fund_matcher.allocation_state
+        if donation_id not in state:
+            raise BadRequestException("Invalid donation_id %s" % donation_id)
+
+        with self._lock:
+            self._push(donation_id, state.created_timestamp(state.row(donation_id)))
+
+    def next_due(self):
+        """
+        Deadline of the earliest reservation in the heap, or None if it is empty
+        """
+
+        with self._lock:
+            return from_timestamp(self._heap[0][0]) if self._heap else None
+
+    def expire_due(self, now=None):
+        """
+        Expire every reservation whose deadline is at or before now
+        Returns the donation ids expired
+        """
+
+        now = to_timestamp(now if now is not None else datetime.now())
+        state = self.fund_matcher.allocation_state
+
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, created_timestamp, _, donation_id = heapq.heappop(self._heap)
+                if self._tracked.get(donation_id) == created_timestamp:
+                    del self._tracked[donation_id]
+
+                # skip donations since settled, and ids since reserved again, which have their own entry
+                if donation_id not in state:
+                    continue
+                row = state.row(donation_id)
+                if state.created_timestamp(row) != created_timestamp or state.status(row) != RESERVED:
+                    continue
+                due.append(donation_id)
+
+        if not due:
+            return []
+
+        # a donation collected in the meantime is simply not expired
+        outcomes = self.fund_matcher.expire_donations(due, atomic=False)
+        return [donation_id for donation_id, outcome in zip(due, outcomes) if not isinstance(outcome, BadRequestException)]
+
+    def start(self, interval=DEFAULT_INTERVAL):
+        """
+        Run expire_due every interval seconds on a background thread, until stop()
+        """
+
+        if self._thread is not None:
+            raise BadRequestException("Expiry scheduler is already running")
+
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run_thread, args=(interval, self._stopping), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    async def run(self, interval=DEFAULT_INTERVAL):
+        """
+        Run expire_due every interval seconds, for use as an asyncio task
+        Cancel the task to stop it.
+        """
+
+        while True:
+            self.expire_due()
+            await asyncio.sleep(interval)
+
+    def _run_thread(self, interval, stopping):
+        while not stopping.wait(interval):
+            self.expire_due()
+
+    def _push(self, donation_id, created_timestamp):
+        # called holding the lock, or before the scheduler is shared
+        if self._tracked.get(donation_id) == created_timestamp:
+            return
+        self._tracked[donation_id] = created_timestamp
+        self._sequence += 1
+        heapq.heappush(self._heap, (created_timestamp + self._ttl_microseconds, created_timestamp, self._sequence, donation_id))
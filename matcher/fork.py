@@ -0,0 +1,303 @@
+from bisect import insort
+from collections import ChainMap
+from itertools import groupby
+from matcher.allocation import RESERVED, COLLECTED, EXPIRED
+from matcher.allocation_state import AllocationState
+from matcher.capacity_index import CapacityIndex
+from matcher.exceptions import BadRequestException, ConflictException
+from matcher.fund_matcher import FundMatcher, _discard
+from operator import itemgetter
+import copy
+import heapq
+
+# Operations recorded by a fork, replayed on its parent by commit()
+RESERVE = "reserve"
+COLLECT = "collect"
+EXPIRE = "expire"
+TOP_UP = "top_up"
+
+class ForkedFundMatcher(FundMatcher):
+    """
+    Copy-on-write what-if view of a FundMatcher, for previewing operations before making them
+    Creating a fork copies nothing. Fund balances are read through to the parent until
+    the fork changes one, when that fund alone is copied; the fork's reservations go
+    into an allocation state of its own, and settling one of the parent's reservations
+    only records its new status. A fork therefore costs memory in proportion to what it
+    changes, and any number of forks can share one parent, or fork a fork.
+    Reservations, collections, expiries and top ups can be made on a fork; the fund
+    registry is otherwise shared with the parent and cannot be changed from it. A fork
+    will not reserve a donation id already reserved in its parent, even as a retry.
+    allocation_state, the listings and the fund summaries cover the fork's own
+    reservations; changes() sets out everything the fork did.
+    commit() replays the fork's operations on the parent, provided the parent has not
+    changed since the fork was made; discard() drops the fork. A fork of a matcher in
+    concurrent use previews a moving target: reads are not locked against the parent.
+    """
+
+    def __init__(self, parent):
+        # the registry is shared with the parent, so FundMatcher.__init__ is not called
+        self._parent = parent
+        self._base_version = parent._state_version()
+        self._fund_keys = parent._fund_keys
+        self._fund_order = parent._fund_order
+        self._retired = parent._retired
+
+        # the arithmetic is the parent's, whether float or exact
+        self._draw_from_fund = parent._draw_from_fund
+        self._amount = parent._amount
+        self._fund_capacity = parent._fund_capacity
+        self._capacity_slack = parent._capacity_slack
+
+        # copies of the funds changed by the fork, in front of the parent's
+        self._funds = {}
+        self.match_funds = ChainMap(self._funds, parent.match_funds)
+        # sorted keys of funds run dry in the parent that the fork put back into matching
+        self._reactivated = []
+        # new statuses of the parent's donations settled by the fork
+        self._statuses = {}
+
+        self._operations = []
+        self._closed = False
+
+        self.allocation_state = AllocationState(amount_typecode=parent.allocation_state.amount_typecode)
+
+    def changes(self):
+        """
+        What the fork did, against its parent
+        Returns a dict of the fund balances it changed, as match_fund_id: (parent balance,
+        fork balance), the donation ids it reserved and the statuses of the parent's
+        donations it settled
+        """
+
+        return {
+            'funds': {match_fund_id: (self._parent.match_funds[match_fund_id].total_amount, match_fund.total_amount)
+                      for match_fund_id, match_fund in self._funds.items()},
+            'reserved': list(self.allocation_state),
+            'settled': dict(self._statuses)
+        }
+
+    def commit(self):
+        """
+        Apply the fork's operations to the parent, in order, and close the fork
+        Raises ConflictException, leaving the parent untouched, if the parent has changed
+        since the fork was made; the preview no longer holds and should be made again.
+        """
+
+        self._check_open()
+        if self._parent._state_version() != self._base_version:
+            raise ConflictException("The matcher has changed since the fork was made")
+
+        # runs of reservations and of collections are applied with one call each
+        for operation, run in groupby(self._operations, key=itemgetter(0)):
+            run = [arguments[1:] for arguments in run]
+            if operation == RESERVE:
+                donation_ids, amounts = zip(*run)
+                self._parent.reserve_columns(list(donation_ids), list(amounts))
+            elif operation == COLLECT:
+                self._parent.collect_donations([donation_id for donation_id, in run])
+            elif operation == EXPIRE:
+                for donation_id, in run:
+                    self._parent.expire_donation(donation_id)
+            else:
+                for match_fund_id, amount in run:
+                    self._parent.top_up(match_fund_id, amount)
+
+        self._close()
+
+    def discard(self):
+        """
+        Drop the fork without touching the parent
+        """
+
+        self._close()
+
+    def top_up(self, match_fund_id, amount):
+        self._check_open()
+        self._registered_fund(match_fund_id)
+
+        if amount <= 0:
+            raise BadRequestException("Top up amount must be positive, %s" % amount)
+        if match_fund_id in self._retired:
+            raise BadRequestException("Match fund %s is retired" % match_fund_id)
+
+        self._credit_fund(self.match_funds[match_fund_id], self._amount(amount))
+        self._operations.append((TOP_UP, match_fund_id, amount))
+
+    def add_match_fund(self, match_fund):
+        raise BadRequestException("Match funds cannot be added on a fork")
+
+    def retire_match_fund(self, match_fund_id):
+        raise BadRequestException("Match funds cannot be retired on a fork")
+
+    def reorder_match_fund(self, match_fund_id, match_order):
+        raise BadRequestException("Match funds cannot be reordered on a fork")
+
+    def archive_settled(self, min_age):
+        raise BadRequestException("Donations cannot be archived on a fork")
+
+    def _reserve(self, donation_id, amount, now):
+        self._check_open()
+        if donation_id in self.allocation_state:
+            return self._reserved_before(donation_id, self._amount(amount))
+        if self._parent.donation_status(donation_id) is not None:
+            raise BadRequestException("Duplicate donation id %s" % donation_id)
+
+        allocation_state_doc = super()._reserve(donation_id, self._amount(amount), now)
+        self._operations.append((RESERVE, donation_id, amount))
+        return allocation_state_doc
+
+    def _reserve_batch(self, donation_ids, amounts, now):
+        # the batch path works on the active fund index, which a fork does not have
+        amounts = list(amounts)
+        first_seen = {}
+        for donation_id, amount in zip(donation_ids, amounts):
+            if self._parent.donation_status(donation_id) is not None:
+                raise BadRequestException("Duplicate donation id %s" % donation_id)
+            if donation_id in self.allocation_state:
+                self._reserved_before(donation_id, self._amount(amount))
+            elif self._amount(first_seen.setdefault(donation_id, amount)) != self._amount(amount):
+                raise BadRequestException("Donation id %s was already reserved for a different amount, %s" % (
+                    donation_id, first_seen[donation_id]))
+
+        return [self._reserve(donation_id, amount, now) for donation_id, amount in zip(donation_ids, amounts)]
+
+    def _match_amount(self, donation_balance):
+        matches = []
+        for fund_key in self._iter_active_fund_keys():
+            match_fund = self._fund_copy(fund_key[2])
+            allocated_amount, donation_balance = self._draw_from_fund(match_fund, donation_balance)
+            matches.append((match_fund.match_fund_id, allocated_amount))
+
+            if match_fund.total_amount == 0:
+                _discard(self._reactivated, fund_key)
+
+            if donation_balance == 0:
+                break
+
+        return matches, donation_balance
+
+    def _collect(self, donation_id, now):
+        self._check_open()
+        if donation_id in self.allocation_state:
+            super()._collect(donation_id, now)
+        else:
+            self._settle_parent_donation(donation_id, COLLECTED)
+        self._operations.append((COLLECT, donation_id))
+
+    def _expire(self, donation_id, now):
+        self._check_open()
+        if donation_id in self.allocation_state:
+            super()._expire(donation_id, now)
+        else:
+            self._settle_parent_donation(donation_id, EXPIRED)
+        self._operations.append((EXPIRE, donation_id))
+
+    def _collect_many(self, donation_ids, now, atomic):
+        return self._settle_many(donation_ids, now, atomic, COLLECTED, self._collect)
+
+    def _expire_many(self, donation_ids, now, atomic):
+        return self._settle_many(donation_ids, now, atomic, EXPIRED, self._expire)
+
+    def _settle_many(self, donation_ids, now, atomic, status, settle):
+        """
+        Validate many donations as FundMatcher._validate_reserved does, then settle them one by one
+        """
+
+        outcomes = []
+        seen = set()
+        for donation_id in donation_ids:
+            if self.donation_status(donation_id) is None:
+                outcomes.append(BadRequestException("Invalid donation id %s" % donation_id))
+            elif donation_id in seen:
+                outcomes.append(BadRequestException("Duplicate donation id %s" % donation_id))
+            elif self.donation_status(donation_id) != RESERVED:
+                outcomes.append(BadRequestException("Invalid collection request. Allocation is not reserved"))
+            else:
+                outcomes.append(status)
+            seen.add(donation_id)
+
+        if atomic and any(outcome is not status for outcome in outcomes):
+            not_applied = BadRequestException("Not applied, another donation id in the request was rejected")
+            return [not_applied if outcome is status else outcome for outcome in outcomes]
+
+        for donation_id, outcome in zip(donation_ids, outcomes):
+            if outcome is status:
+                settle(donation_id, now)
+        return outcomes
+
+    def _settle_parent_donation(self, donation_id, status):
+        current = self.donation_status(donation_id)
+        if current is None:
+            raise BadRequestException("Invalid donation id %s" % donation_id)
+        if current != RESERVED:
+            raise BadRequestException("Invalid collection request. Allocation is not reserved")
+
+        if status == EXPIRED:
+            for match_fund_id, amount in self._parent._donation_matches(donation_id):
+                self._credit_fund(self.match_funds[match_fund_id], amount)
+        self._statuses[donation_id] = status
+
+    def _credit_fund(self, match_fund, amount):
+        match_fund = self._fund_copy(match_fund.match_fund_id)
+
+        was_exhausted = match_fund.total_amount == 0
+        match_fund.total_amount += amount
+
+        if was_exhausted and match_fund.total_amount != 0 and match_fund.match_fund_id not in self._retired:
+            fund_key = self._fund_keys[match_fund.match_fund_id]
+            _discard(self._reactivated, fund_key)
+            insort(self._reactivated, fund_key)
+
+    def _fund_copy(self, match_fund_id):
+        """
+        The fork's own copy of a match fund, made the first time the fork changes it
+        """
+
+        match_fund = self._funds.get(match_fund_id)
+        if match_fund is None:
+            match_fund = self._funds[match_fund_id] = copy.copy(self._parent.match_funds[match_fund_id])
+        return match_fund
+
+    def _state_version(self):
+        return len(self._operations), self._closed
+
+    def _fresh_capacity_index(self):
+        # the parent's balances change unseen by the fork, so the index is built afresh for each quote
+        return CapacityIndex(self)
+
+    def _iter_active_fund_keys(self):
+        """
+        The parent's active funds merged with the ones the fork put back, less those it ran dry
+        A fund run dry by the fork is passed over by each later reservation, so a fork
+        that empties many funds pays for skipping them.
+        """
+
+        previous = None
+        for fund_key in heapq.merge(self._parent._iter_active_fund_keys(), list(self._reactivated)):
+            if fund_key == previous:
+                continue
+            previous = fund_key
+            if self.match_funds[fund_key[2]].total_amount != 0:
+                yield fund_key
+
+    def donation_status(self, donation_id):
+        if donation_id in self.allocation_state:
+            return super().donation_status(donation_id)
+        if donation_id in self._statuses:
+            return self._statuses[donation_id]
+        return self._parent.donation_status(donation_id)
+
+    def _donation_matches(self, donation_id):
+        if donation_id in self.allocation_state:
+            return super()._donation_matches(donation_id)
+        return self._parent._donation_matches(donation_id)
+
+    def _check_open(self):
+        if self._closed:
+            raise BadRequestException("The fork has been committed or discarded")
+
+    def _close(self):
+        self._closed = True
+        self._funds.clear()
+        self._statuses.clear()
+        self._operations = []
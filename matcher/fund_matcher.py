@@ -1,7 +1,16 @@
-from collections import OrderedDict
-from matcher.allocation import Allocation
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from heapq import merge
+from itertools import islice
+from matcher.allocation import RESERVED, COLLECTED, EXPIRED
+from matcher.allocation_state import AllocationState, to_timestamp
+from matcher.capacity_index import CapacityIndex
 from matcher.exceptions import BadRequestException
+from matcher.validation import validate_donations, ERROR_MESSAGES
 from datetime import datetime
+from operator import itemgetter
+import copy
+import numpy as np
 
 MAX_RESERVED_AMOUNT = 25000.00
 MIN_RESERVED_AMOUNT = 5.00
@@ -12,13 +21,21 @@ MIN_MATCHED_AMOUNT = 5.00
 MIN_DONATION_AMOUNT = 5.00
 MAX_DONATION_AMOUNT = 25000.00
 
-# Valid statuses
-RESERVED = "Reserved"
-COLLECTED = "Collected"
-EXPIRED = "Expired"
-
 class FundMatcher(object):
 
+    # dtype of the amount arrays used by the batch path
+    AMOUNT_DTYPE = np.float64
+
+    # cold store that archive_settled moves settled donations to (see matcher.archive);
+    # with none, every donation stays in the allocation state
+    _archive = None
+
+    # Fenwick index of fund capacity behind quote(), built by the first quote
+    _capacity_index = None
+
+    # donation ids of reserved donations left partly unmatched, oldest first; see enable_backfill
+    _backfill_queue = None
+
     def __init__(self, match_funds):
         """
         Core algorithm to match donation to matchfunds
@@ -28,11 +45,169 @@ class FundMatcher(object):
         match_funds.sort(reverse=False, key=lambda x: x.match_order)
         self.match_funds = OrderedDict([(mf.match_fund_id, mf) for mf in match_funds])
 
-        self.allocation_state = {}
+        # Ordered index of the funds that still have a balance, keyed by
+        # (match_order, registration position, match_fund_id). Exhausted funds
+        # are dropped from the front as they run dry and re-inserted on refund,
+        # so a reservation only visits the funds it actually draws from.
+        self._fund_keys = {}
+        self._active_funds = []
+        for ix, mf in enumerate(match_funds):
+            self._fund_keys[mf.match_fund_id] = (mf.match_order, ix, mf.match_fund_id)
+            if mf.total_amount != 0:
+                self._active_funds.append(self._fund_keys[mf.match_fund_id])
+
+        # Every registered fund, in the same key order, and the ones retired from matching
+        self._fund_order = [self._fund_keys[mf.match_fund_id] for mf in match_funds]
+        self._next_position = len(match_funds)
+        self._retired = set()
+        # bumped by every change to the fund registry; see _state_version
+        self._registry_version = 0
+
+        self.allocation_state = AllocationState()
+
+    @property
+    def archive(self):
+        return self._archive
+
+    @archive.setter
+    def archive(self, archive):
+        # reservations are numbered on from the archive's, so that listings never interleave
+        # a new matcher's donations with ones archived by an earlier one
+        state = self.allocation_state
+        if archive is not None:
+            state.next_sequence = max(state.next_sequence, archive.next_sequence())
+        self._archive = archive
 
     def get_match_funds_as_list(self):
 
-        return list(self.match_funds.values())
+        return [self.match_funds[key[2]] for key in self._fund_order]
+
+    def donation_status(self, donation_id):
+        """
+        Overall status of a donation, archived or not, or None if there is no such donation
+        """
+
+        if donation_id not in self.allocation_state:
+            return self.archive.status(donation_id) if self.archive is not None else None
+        return self.allocation_state.status(self.allocation_state.row(donation_id))
+
+    def add_match_fund(self, match_fund):
+        """
+        Register a new match fund mid-campaign
+        It is matched from the next reservation on, in its match_order; among funds of the
+        same match_order it comes after the ones registered before it.
+        """
+
+        if match_fund.match_fund_id in self.match_funds:
+            raise BadRequestException("Match fund %s already exists" % match_fund.match_fund_id)
+
+        fund_key = (match_fund.match_order, self._next_position, match_fund.match_fund_id)
+        self._next_position += 1
+        self._registry_version += 1
+
+        self.match_funds[match_fund.match_fund_id] = match_fund
+        self._fund_keys[match_fund.match_fund_id] = fund_key
+        insort(self._fund_order, fund_key)
+        if match_fund.total_amount != 0:
+            insort(self._active_funds, fund_key)
+            self._funds_released()
+
+    def top_up(self, match_fund_id, amount):
+        """
+        Add to the balance of a match fund, putting it back into matching if it had run dry
+        """
+
+        match_fund = self._registered_fund(match_fund_id)
+
+        if amount <= 0:
+            raise BadRequestException("Top up amount must be positive, %s" % amount)
+        if match_fund_id in self._retired:
+            raise BadRequestException("Match fund %s is retired" % match_fund_id)
+
+        self._registry_version += 1
+        self._credit_fund(match_fund, amount)
+        self._funds_released()
+
+    def retire_match_fund(self, match_fund_id):
+        """
+        Take a match fund out of matching
+        Reservations already matched against it are untouched and can still be collected.
+        The fund stays registered so that expiring one of them credits it back, but it is
+        never drawn from again.
+        Returns the balance the fund held when it was retired, which is set to zero
+        """
+
+        match_fund = self._registered_fund(match_fund_id)
+
+        if match_fund_id in self._retired:
+            raise BadRequestException("Match fund %s is already retired" % match_fund_id)
+
+        self._registry_version += 1
+        self._mark_retired(match_fund_id)
+
+        balance, match_fund.total_amount = match_fund.total_amount, type(match_fund.total_amount)(0)
+        return balance
+
+    def reorder_match_fund(self, match_fund_id, match_order):
+        """
+        Move a match fund to a new match_order, keeping its place among funds of that order
+        """
+
+        match_fund = self._registered_fund(match_fund_id)
+
+        old_key = self._fund_keys[match_fund_id]
+        new_key = (match_order,) + old_key[1:]
+
+        if _discard(self._active_funds, old_key):
+            insort(self._active_funds, new_key)
+        _discard(self._fund_order, old_key)
+        insort(self._fund_order, new_key)
+
+        self._fund_keys[match_fund_id] = new_key
+        self._registry_version += 1
+        match_fund.match_order = match_order
+
+    def is_retired(self, match_fund_id):
+
+        return match_fund_id in self._retired
+
+    def _mark_retired(self, match_fund_id):
+
+        self._retired.add(match_fund_id)
+        _discard(self._active_funds, self._fund_keys[match_fund_id])
+
+    def _registered_fund(self, match_fund_id):
+
+        if match_fund_id not in self.match_funds:
+            raise BadRequestException("Invalid match_fund_id %s" % match_fund_id)
+
+        return self.match_funds[match_fund_id]
+
+    # Read by ForkedFundMatcher, which overrides them to read through to its parent
+
+    def _state_version(self):
+        """
+        Changes whenever a reservation, settlement or fund registry change is made
+        """
+
+        return self.allocation_state.version, self._registry_version
+
+    def _iter_active_fund_keys(self):
+
+        return iter(self._active_funds)
+
+    def _donation_matches(self, donation_id):
+
+        if donation_id not in self.allocation_state:
+            return self.archive.matches(donation_id)
+        return self.allocation_state.matches(self.allocation_state.row(donation_id))
+
+    def _amount(self, amount):
+        """
+        An amount in the units the matcher does its arithmetic in
+        """
+
+        return amount
 
     def reserve_funds(self, donation):
         """
@@ -40,47 +215,230 @@ class FundMatcher(object):
         Depending on the funds availale in the match_fund, the donation is either fully,
         partially matched. or not matched at all.
         The match_fund_state is updated with the result.
-        Assuming that donation id of a donation is unique
+        Reserving is idempotent per donation id: a retry of a donation already in the
+        allocation state returns its original result and leaves the balances alone, and
+        a retry with a different amount is rejected. Every donation id is kept, settled
+        and archived ones included, so retries are answered however late they come; the
+        memory this takes is bounded by moving settled donations out with archive_settled.
+        Returns the allocation state of the donation
         """
-        donation_balance = donation.amount
+        return self._reserve(donation.donation_id, donation.amount, datetime.now())
 
-        allocations = []
-        for match_fund in self.match_funds.values():
-            matching_amount_required = donation_balance * (match_fund.matching_ratio_as_float_multiplier)
+    def reserve_funds_batch(self, donations):
+        """
+        Reserve a sequence of Donation objects against match funds, in order
+        The result is identical to calling reserve_funds for each donation in turn,
+        retries included, but all reservations share a single timestamp.
+        Returns the allocation state of each donation, in the order given
+        """
+        donations = list(donations)
+        return self._reserve_columns([donation.donation_id for donation in donations],
+                                     [donation.amount for donation in donations])
 
-            if match_fund.total_amount == 0:
-                # fund is exhausted - move on to next match_fund
-                continue
+    def reserve_columns(self, donation_ids, amounts):
+        """
+        Reserve a column of donation ids against a column of amounts, as reserve_funds_batch
+        does for Donation objects, without building one per donation. The amounts are
+        checked all at once with validate_donations; rows should be filtered with its
+        mask first, as any invalid amount rejects the whole call.
+        Returns the allocation state of each donation, in the order given
+        """
 
-            if match_fund.total_amount >= matching_amount_required:
-                # full match
-                allocation = Allocation(match_fund.match_fund_id, matching_amount_required, RESERVED)
-                allocations.append(allocation)
-                donation_balance = 0
-                match_fund.total_amount -= matching_amount_required
-                break
+        amounts, valid, codes = validate_donations(amounts)
+        if not valid.all():
+            ix = int(np.flatnonzero(~valid)[0])
+            raise BadRequestException("%s, donation_id %s" % (ERROR_MESSAGES[codes[ix]], list(donation_ids)[ix]))
+        if len(donation_ids) != len(amounts):
+            raise BadRequestException("Donation id and amount columns differ in length")
+
+        return self._reserve_columns(list(donation_ids), amounts)
+
+    def _reserve_columns(self, donation_ids, amounts):
+        """
+        Reserve columns of donation ids and valid amounts, all at the same time
+        The one place batches of reservations enter; locked and logged matchers override it.
+        """
+
+        return self._reserve_batch(donation_ids, amounts, datetime.now())
+
+    def _reserve(self, donation_id, amount, now):
+        """
+        Reserve a donation amount at the given time
+        Returns the allocation state of the donation
+        """
+
+        allocation_state_doc = self._reserved_before(donation_id, amount)
+        if allocation_state_doc is not None:
+            return allocation_state_doc
+
+        matches, donation_balance = self._match_amount(amount)
+
+        row = self.allocation_state.add(donation_id, amount, donation_balance, matches, now)
+        self._queue_backfill(donation_id, donation_balance)
+        return self.allocation_state.record(row)
 
+    def _reserved_before(self, donation_id, amount):
+        """
+        Allocation state of a donation reserved before, archived or not, or None for a new donation id
+        Raises BadRequestException if the retry is for a different amount
+        """
+
+        if donation_id in self.allocation_state:
+            allocation_state_doc = self.allocation_state[donation_id]
+        elif self.archive is not None:
+            allocation_state_doc = self.archive.record(donation_id)
+            if allocation_state_doc is None:
+                return None
+        else:
+            return None
+
+        original_donation = allocation_state_doc['original_donation']
+        if original_donation != amount:
+            raise BadRequestException("Donation id %s was already reserved for a different amount, %s" % (
+                donation_id, original_donation))
+        return allocation_state_doc
+
+    def _reserve_batch(self, donation_ids, amounts, now):
+        """
+        Reserve a column of donation ids and a column of amounts, all at the given time
+        Returns the allocation state of each donation
+        """
+
+        amounts = np.asarray(amounts, dtype=self.AMOUNT_DTYPE)
+
+        # retries, of donations reserved before or earlier in the batch, are checked before anything changes
+        first_seen = {}
+        replayed = {}
+        for ix, donation_id in enumerate(donation_ids):
+            if donation_id in first_seen:
+                if amounts[ix] != amounts[first_seen[donation_id]]:
+                    raise BadRequestException("Donation id %s was already reserved for a different amount, %s" % (
+                        donation_id, amounts[first_seen[donation_id]]))
             else:
-                # partial match
-                matched_allocated_amount = matching_amount_required - match_fund.total_amount
-                allocation = Allocation(match_fund.match_fund_id, match_fund.total_amount, RESERVED)
-                allocations.append(allocation)
-                donation_balance -= (matching_amount_required - matched_allocated_amount) / match_fund.matching_ratio_as_float_multiplier
-                match_fund.total_amount = 0
-            
+                allocation_state_doc = self._reserved_before(donation_id, amounts[ix].item())
+                if allocation_state_doc is not None:
+                    replayed[donation_id] = allocation_state_doc
+                else:
+                    first_seen[donation_id] = ix
+
+        if len(first_seen) == len(donation_ids):
+            new_donations = list(range(len(donation_ids)))
+        else:
+            new_donations = list(first_seen.values())
+
+        results = self._match_batch(amounts[new_donations])
+
+        for ix, amount, (matches, donation_balance) in zip(new_donations, amounts[new_donations].tolist(), results):
+            self.allocation_state.add(donation_ids[ix], amount, donation_balance, matches, now)
+            self._queue_backfill(donation_ids[ix], donation_balance)
+
+        return [replayed[donation_id] if donation_id in replayed else self.allocation_state[donation_id]
+                for donation_id in donation_ids]
+
+    def _match_amount(self, donation_balance):
+        """
+        Draw a donation amount from the active match funds, in match_order
+        Match fund balances are updated as they are drawn.
+        Returns a list of (match_fund_id, allocated amount) and the unmatched balance
+        """
+
+        matches = []
+        exhausted = 0
+        for fund_key in self._active_funds:
+            match_fund = self.match_funds[fund_key[2]]
+            allocated_amount, donation_balance = self._draw_from_fund(match_fund, donation_balance)
+            matches.append((match_fund.match_fund_id, allocated_amount))
+            self._balance_changed(match_fund.match_fund_id)
+
+            if match_fund.total_amount == 0:
+                exhausted += 1
+
             if donation_balance == 0:
                 # donation has been matched completely - break from for
                 break
 
-        allocation_state_doc = {
-            'allocations': allocations,
-            'created_time': datetime.now(),
-            'updated_time': datetime.now(),
-            'original_donation': donation.amount,
-            'donation_balance_unmatched': donation_balance,
-            'overall_status': RESERVED
-        }
-        self.allocation_state[donation.donation_id] = allocation_state_doc
+        # funds are drawn in order, so the exhausted ones are a prefix of the index
+        del self._active_funds[:exhausted]
+
+        return matches, donation_balance
+
+    def _draw_from_fund(self, match_fund, donation_balance):
+        """
+        Match as much of the donation balance as a single match fund allows
+        The match fund balance is reduced by the allocated amount.
+        Returns the allocated amount and the donation balance left to match
+        """
+
+        matching_amount_required = donation_balance * (match_fund.matching_ratio_as_float_multiplier)
+
+        if match_fund.total_amount >= matching_amount_required:
+            # full match
+            match_fund.total_amount -= matching_amount_required
+            return matching_amount_required, 0
+
+        # partial match
+        allocated_amount = match_fund.total_amount
+        matched_allocated_amount = matching_amount_required - allocated_amount
+        donation_balance -= (matching_amount_required - matched_allocated_amount) / match_fund.matching_ratio_as_float_multiplier
+        match_fund.total_amount = 0
+        return allocated_amount, donation_balance
+
+    def _required_matches(self, match_fund, amounts):
+        """
+        Vectorised matching_amount_required of _draw_from_fund, for an array of amounts
+        """
+
+        return amounts * match_fund.matching_ratio_as_float_multiplier
+
+    def _match_batch(self, amounts):
+        """
+        Vectorised equivalent of calling _match_amount for each amount in turn
+        Runs of donations that are fully matched by the front fund are settled in one
+        step: the front fund balance after each donation is a running subtraction of the
+        required matches, and the first donation that would empty the fund is found with
+        a search over cumulative donation amounts. That donation is passed to _match_amount,
+        which makes the result identical to the donation-by-donation path.
+        Returns a list of (matches, unmatched balance), one per amount
+        """
+
+        results = []
+        count = len(amounts)
+        cumulative_amounts = np.cumsum(amounts)
+        ix = 0
+
+        while ix < count:
+            if not self._active_funds:
+                # all funds are exhausted - nothing left to match
+                results.extend(([], amount) for amount in amounts[ix:].tolist())
+                break
+
+            match_fund = self.match_funds[self._active_funds[0][2]]
+            ratio = match_fund.matching_ratio_as_float_multiplier
+            total_amount = match_fund.total_amount
+
+            # estimate how many donations the front fund can absorb, plus the one that empties it
+            consumed = cumulative_amounts[ix - 1] if ix else 0.0
+            window_end = int(np.searchsorted(cumulative_amounts, consumed + total_amount / ratio, side='right')) + 1
+            window_end = min(max(window_end, ix + 1), count)
+
+            required = self._required_matches(match_fund, amounts[ix:window_end])
+            balances = np.subtract.accumulate(np.concatenate(([total_amount], required)))[1:]
+            exhausting = np.flatnonzero(balances <= 0)
+            full_matches = int(exhausting[0]) if len(exhausting) else len(required)
+
+            if full_matches:
+                match_fund_id = match_fund.match_fund_id
+                results.extend(([(match_fund_id, amount)], 0) for amount in required[:full_matches].tolist())
+                match_fund.total_amount = balances[full_matches - 1].item()
+                self._balance_changed(match_fund_id)
+                ix += full_matches
+
+            if full_matches < len(required):
+                # this donation empties the front fund and may spill into the next ones
+                results.append(self._match_amount(amounts[ix].item()))
+                ix += 1
+
+        return results
 
     def collect_donation(self, donation_id):
         """
@@ -89,23 +447,23 @@ class FundMatcher(object):
         Throws errors if the allocation status is not Reserved
         """
 
+        self._collect(donation_id, datetime.now())
+
+    def _collect(self, donation_id, now):
+
         # Is donation_id valid?
         if not donation_id in self.allocation_state:
+            self._check_not_archived(donation_id)
             raise BadRequestException("Invalid donation id %s" % donation_id)
 
-        allocations = self.allocation_state[donation_id]['allocations']
+        row = self.allocation_state.row(donation_id)
 
         # Ensure that only allocation status of RESERVED are COLLECTED
-        for allocation in allocations:
-            if not allocation.status == RESERVED:
-                raise BadRequestException("Invalid collection request. Allocation is not reserved")
-            else:
-                allocation.status = COLLECTED
+        if not self.allocation_state.status(row) == RESERVED:
+            raise BadRequestException("Invalid collection request. Allocation is not reserved")
+
+        self.allocation_state.set_status(row, COLLECTED, now)
 
-        self.allocation_state[donation_id]['allocations'] = allocations
-        self.allocation_state[donation_id]['updated_time'] = datetime.now()
-        self.allocation_state[donation_id]['overall_status'] = COLLECTED
-    
     def expire_donation(self, donation_id):
         """
         Expire a donation
@@ -116,40 +474,461 @@ class FundMatcher(object):
         not new donations.
         """
 
+        self._expire(donation_id, datetime.now())
+
+    def _expire(self, donation_id, now):
+
         if donation_id not in self.allocation_state:
+            self._check_not_archived(donation_id)
             raise BadRequestException("Invalid donation_id %s" % donation_id)
 
-        allocations = self.allocation_state[donation_id]['allocations']
+        row = self.allocation_state.row(donation_id)
+
+        if not self.allocation_state.status(row) == RESERVED:
+            raise BadRequestException("Invalid collection request. Allocation is not reserved")
+
+        for match_fund_id, amount in self.allocation_state.matches(row):
+            self._credit_fund(self.match_funds[match_fund_id], amount)
+
+        self.allocation_state.set_status(row, EXPIRED, now)
+        self._funds_released()
+
+    def collect_donations(self, donation_ids, atomic=True):
+        """
+        Collect many Reserved donations in one pass, with one shared timestamp
+        Every donation id is validated before anything changes. With atomic set, one
+        invalid id means nothing is collected; otherwise the valid ones are.
+        Returns one outcome per donation id, in order: COLLECTED when it was collected,
+        or the BadRequestException explaining why it was not
+        """
+
+        return self._collect_many(list(donation_ids), datetime.now(), atomic)
+
+    def _collect_many(self, donation_ids, now, atomic):
+
+        rows, outcomes = self._validate_reserved(donation_ids, COLLECTED, atomic)
+
+        for row in rows:
+            self.allocation_state.set_status(row, COLLECTED, now)
+
+        return outcomes
+
+    def expire_donations(self, donation_ids, atomic=True):
+        """
+        Expire many Reserved donations in one pass, with one shared timestamp
+        Validation and outcomes are as for collect_donations. The matched amounts are
+        summed per match fund and each fund is credited once, so with float amounts a
+        fund balance can differ in the last digits from expiring one donation at a time.
+        """
+
+        return self._expire_many(list(donation_ids), datetime.now(), atomic)
+
+    def _expire_many(self, donation_ids, now, atomic):
+
+        rows, outcomes = self._validate_reserved(donation_ids, EXPIRED, atomic)
+
+        refunds = self._refunds(rows)
+        for row in rows:
+            self.allocation_state.set_status(row, EXPIRED, now)
+
+        for match_fund_id, amount in refunds.items():
+            self._credit_fund(self.match_funds[match_fund_id], amount)
+        if refunds:
+            self._funds_released()
+
+        return outcomes
+
+    def _validate_reserved(self, donation_ids, status, atomic):
+        """
+        Check a sequence of donation ids are all Reserved, and each appears once
+        Returns the rows to move to status and the outcome for each donation id
+        """
 
-        for allocation in allocations:
-            if not allocation.status == RESERVED:
-                raise BadRequestException("Invalid collection request. Allocation is not reserved")
+        rows = []
+        outcomes = []
+        seen = set()
+        rejected = False
+
+        for donation_id in donation_ids:
+            if donation_id not in self.allocation_state and self._archived(donation_id):
+                outcome = BadRequestException("Invalid collection request. Allocation is not reserved")
+            elif donation_id not in self.allocation_state:
+                outcome = BadRequestException("Invalid donation id %s" % donation_id)
+            elif donation_id in seen:
+                outcome = BadRequestException("Duplicate donation id %s" % donation_id)
             else:
-                allocation.status = EXPIRED
-                allocation_match_fund = self.match_funds[allocation.match_fund_id]
-                allocation_match_fund.total_amount += allocation.match_fund_allocation
-                self.match_funds[allocation.match_fund_id] = allocation_match_fund
+                row = self.allocation_state.row(donation_id)
+                if not self.allocation_state.status(row) == RESERVED:
+                    outcome = BadRequestException("Invalid collection request. Allocation is not reserved")
+                else:
+                    seen.add(donation_id)
+                    rows.append(row)
+                    outcome = status
+
+            rejected = rejected or outcome is not status
+            outcomes.append(outcome)
+
+        if atomic and rejected:
+            not_applied = BadRequestException("Not applied, another donation id in the request was rejected")
+            return [], [not_applied if outcome is status else outcome for outcome in outcomes]
+
+        return rows, outcomes
+
+    def _archived(self, donation_id):
+
+        return self.archive is not None and donation_id in self.archive
 
-        self.allocation_state[donation_id]['allocations'] = allocations
-        self.allocation_state[donation_id]['updated_time'] = datetime.now()
-        self.allocation_state[donation_id]['overall_status'] = EXPIRED
+    def _check_not_archived(self, donation_id):
+        """
+        Archived donations were all settled, so a request to settle one is refused as for any settled donation
+        """
+
+        if self._archived(donation_id):
+            raise BadRequestException("Invalid collection request. Allocation is not reserved")
+
+    def archive_settled(self, min_age):
+        """
+        Move the donations collected or expired at least min_age ago into the archive
+        The allocation state is rebuilt without them, so it only holds what is still
+        reserved or recently settled, and a long campaign's memory and scans stay in
+        proportion to that. Archived donations are still found by reservation retries,
+        collect and expire requests, get_allocation and the listings; the fund summaries
+        keep counting them. Allocation records read before archiving are views over the
+        old state and should be read afresh.
+        Settled donations are found from an index in the order they were settled, in
+        time in proportion to the number archived, and a run with nothing to archive costs
+        next to nothing. The allocation state is then rebuilt from the donations kept, in
+        time in proportion to them (see benchmarks.bench_compaction), so runs should be
+        spaced to archive a good share of the state each time rather than a few donations.
+        Returns the number of donations archived
+        """
+
+        if self.archive is None:
+            raise BadRequestException("Archiving settled donations needs an archive")
+
+        return self._archive_settled(self.archive, to_timestamp(datetime.now() - min_age))
+
+    def _archive_settled(self, archive, before_timestamp):
+
+        rows = list(self.allocation_state.iter_settled_rows(before_timestamp))
+        if rows:
+            archive.add(self.allocation_state, rows)
+            self.allocation_state = self.allocation_state.without(rows)
+        return len(rows)
+
+    def _refunds(self, rows):
+        """
+        Matched amounts of the given donations, summed per match fund
+        """
+
+        refunds = {}
+        for row in rows:
+            for match_fund_id, amount in self.allocation_state.matches(row):
+                refunds[match_fund_id] = refunds.get(match_fund_id, 0) + amount
+        return refunds
+
+    def _credit_fund(self, match_fund, amount):
+        """
+        Return an amount to a match fund
+        A fund that had run dry is put back into the active fund index
+        """
+
+        was_exhausted = match_fund.total_amount == 0
+        match_fund.total_amount += amount
+        self._balance_changed(match_fund.match_fund_id)
+
+        if was_exhausted and match_fund.total_amount != 0 and match_fund.match_fund_id not in self._retired:
+            insort(self._active_funds, self._fund_keys[match_fund.match_fund_id])
+
+    def enable_backfill(self):
+        """
+        From now on, match released funds against the reserved donations left partly unmatched
+        A donation reserved while the funds were running dry keeps the unmatched part of
+        its balance. With backfill, every release of capacity, by expiring donations,
+        topping up or adding a fund, is drawn in match_order against those donations,
+        oldest first, until either the funds or the donations run out. The allocations
+        drawn are appended to the donation's own, as Reserved, and its
+        donation_balance_unmatched goes down; the listings, fund summaries and expiry
+        see them as any other. Collected and expired donations are never backfilled.
+        Each release costs time in proportion to the donations it backfills.
+        Donations already reserved are queued when backfill is enabled, and matched
+        straight away against any capacity already free.
+        """
+
+        if self._backfill_queue is not None:
+            return
+
+        self._backfill_queue = deque()
+        state = self.allocation_state
+        for row in state.iter_rows(reserved_only=True):
+            self._queue_backfill(state.donation_id(row), state.unmatched(row))
+        self._funds_released()
 
-    def list_match_fund_allocations(self):
+    def _queue_backfill(self, donation_id, donation_balance):
+        # reservations arrive in order, so the queue is kept in arrival order by appending
+        if donation_balance != 0 and self._backfill_queue is not None:
+            self._backfill_queue.append(donation_id)
+
+    def _funds_released(self):
+        """
+        Backfill queued donations from capacity just released
+        Donations collected, expired or fully matched since they were queued are dropped
+        as they reach the front. The donation the funds run dry on stays at the front,
+        with the rest of its balance.
+        """
+
+        queue = self._backfill_queue
+        state = self.allocation_state
+        while queue:
+            donation_id = queue[0]
+            row = state.row(donation_id) if donation_id in state else None
+            if row is None or state.status(row) != RESERVED or state.unmatched(row) == 0:
+                queue.popleft()
+                continue
+
+            matches, donation_balance = self._match_amount(state.unmatched(row))
+            if not matches:
+                return
+            state.backfill(row, matches, donation_balance)
+            if donation_balance != 0:
+                return
+            queue.popleft()
+
+    def quote(self, amount, breakdown=False):
+        """
+        What reserving a donation amount would match right now, without changing anything
+        The totals are read from a Fenwick index of fund capacity in O(log n) of the
+        number of funds; the index is kept up to date as balances change, and rebuilt
+        after a change to the fund registry, top ups included. With float amounts they
+        can differ from what reserve_funds would draw in the last digits. In minor units
+        the last few funds are drawn from copies, as reserve_funds would, so the totals
+        are exact.
+        With breakdown set, the allocation of each fund is worked out as reserve_funds
+        would, at a cost of one step per fund drawn, and the totals are theirs.
+        Returns the donation amount, the total matched, the unmatched balance and, with
+        breakdown, the allocations, in the units the matcher reserves in
+        """
+
+        if amount <= 0:
+            raise BadRequestException("Quote amount must be positive, %s" % amount)
+        amount = self._amount(amount)
+
+        if breakdown:
+            allocations, donation_balance = self._quote_allocations(amount)
+            return {
+                'original_donation': amount,
+                'match_fund_allocation': sum(allocation['match_fund_allocation'] for allocation in allocations),
+                'donation_balance_unmatched': donation_balance,
+                'allocations': allocations
+            }
+
+        index = self._fresh_capacity_index()
+        # funds the donation is more than index.slack beyond the capacity of are certain to be drawn dry
+        target = max(amount - index.slack, 1) if index.slack else amount
+        position, covered = index.capacities.search(target)
+        matched = index.balances.prefix_sum(position)
+        donation_balance = amount - covered
+        while position < len(index.fund_ids) and donation_balance != 0:
+            # the donation ends in this fund, or within index.slack of it; draw from copies until it does
+            match_fund = copy.copy(self.match_funds[index.fund_ids[position]])
+            allocated_amount, donation_balance = self._draw_from_fund(match_fund, donation_balance)
+            matched += allocated_amount
+            if not index.slack:
+                break
+            # on to the next fund with a balance
+            position, _ = index.capacities.search(index.capacities.prefix_sum(position + 1) + 1)
+
+        return {
+            'original_donation': amount,
+            'match_fund_allocation': matched,
+            'donation_balance_unmatched': donation_balance
+        }
+
+    def _quote_allocations(self, donation_balance):
+        """
+        Draw a donation amount from copies of the active funds, as _match_amount would
+        Returns the allocations and the unmatched balance
+        """
+
+        allocations = []
+        for fund_key in self._iter_active_fund_keys():
+            match_fund = copy.copy(self.match_funds[fund_key[2]])
+            if match_fund.total_amount == 0:
+                continue
+            allocated_amount, donation_balance = self._draw_from_fund(match_fund, donation_balance)
+            allocations.append({'match_fund_id': match_fund.match_fund_id, 'match_fund_allocation': allocated_amount})
+            if donation_balance == 0:
+                break
+
+        return allocations, donation_balance
+
+    def _fresh_capacity_index(self):
+        """
+        The capacity index, brought up to date with the balances changed since it was last read
+        """
+
+        index = self._capacity_index
+        if index is None or index.registry_version != self._registry_version:
+            index = self._capacity_index = CapacityIndex(self, self._registry_version)
+        else:
+            index.refresh(self)
+        return index
+
+    def _fund_capacity(self, match_fund):
+        """
+        The donation amount that drawing a fund dry would cover
+        """
+
+        return match_fund.total_amount / match_fund.matching_ratio_as_float_multiplier
+
+    def _capacity_slack(self, match_fund):
+        """
+        How far beyond a fund's capacity a donation amount can be and still end in the fund
+        """
+
+        return 0
+
+    def _balance_changed(self, match_fund_id):
+        # called after the balance is written; see CapacityIndex.refresh
+        if self._capacity_index is not None:
+            self._capacity_index.changed.add(match_fund_id)
+
+    def get_fund_summary(self, match_fund_id):
+        """
+        Summary of one match fund: the amount still available to match, and the amount
+        and number of its allocations that are reserved, collected and expired
+        Expired allocations have been credited back, so available + reserved + collected
+        is everything the fund has been given, less what retiring it handed back.
+        Read from running totals, without visiting any donation.
+        """
+
+        match_fund = self._registered_fund(match_fund_id)
+        totals, counts = self.allocation_state.fund_totals(match_fund_id)
+
+        return {
+            'match_fund_id': match_fund_id,
+            'available': match_fund.total_amount,
+            'reserved': totals[RESERVED],
+            'collected': totals[COLLECTED],
+            'expired': totals[EXPIRED],
+            'reserved_allocations': counts[RESERVED],
+            'collected_allocations': counts[COLLECTED],
+            'expired_allocations': counts[EXPIRED],
+            'retired': match_fund_id in self._retired
+        }
+
+    def get_summary(self):
+        """
+        Summary of every match fund, in match_order, and their totals
+        """
+
+        funds = [self.get_fund_summary(key[2]) for key in self._fund_order]
+
+        summary = {key: sum(fund[key] for fund in funds)
+                   for key in ('available', 'reserved', 'collected', 'expired',
+                               'reserved_allocations', 'collected_allocations', 'expired_allocations')}
+        summary['funds'] = funds
+        return summary
+
+    def get_allocation(self, donation_id):
+        """
+        Allocation state of one donation, whether held in memory or archived
+        """
+
+        if donation_id in self.allocation_state:
+            return self.allocation_state[donation_id]
+        allocation_state_doc = self.archive.record(donation_id) if self.archive is not None else None
+        if allocation_state_doc is None:
+            raise BadRequestException("Invalid donation id %s" % donation_id)
+        return allocation_state_doc
+
+    def iter_fund_allocations(self, match_fund_id, status=None):
+        """
+        Generator over the allocations made from a match fund, in the order they were made
+        Yields the donation id, amount and status of each; status filters on one status.
+        Archived allocations come first, in the order they were archived.
+        """
+
+        self._registered_fund(match_fund_id)
+
+        if status is not None and status not in (RESERVED, COLLECTED, EXPIRED):
+            raise BadRequestException("Invalid status filter %s" % status)
+
+        if self.archive is not None and status != RESERVED:
+            for donation_id, amount, allocation_status in self.archive.iter_fund_allocations(match_fund_id):
+                if status is None or allocation_status == status:
+                    yield {
+                        'donation_id': donation_id,
+                        'match_fund_allocation': amount,
+                        'status': allocation_status
+                    }
+
+        state = self.allocation_state
+        for index in state.iter_fund_allocation_indexes(match_fund_id):
+            allocation_status = state.allocation_status(index)
+            if status is None or allocation_status == status:
+                yield {
+                    'donation_id': state.donation_id(state.allocation_row(index)),
+                    'match_fund_allocation': state.allocation_amount(index),
+                    'status': allocation_status
+                }
+
+    def list_match_fund_allocations(self, limit=None, after_donation_id=None, status=None):
         """
         Only list RESERVED or COLLECTED allocations
+        Pages through the allocations: limit caps the number returned and after_donation_id
+        is the last donation id of the previous page. status=RESERVED lists only reserved donations.
         Returns the allocations
         """
 
-        all_allocations = []
+        return list(islice(self.iter_match_fund_allocations(after_donation_id, status), limit))
 
-        for donation_id in self.allocation_state.keys():
-            if self.allocation_state[donation_id]['overall_status'] != EXPIRED:
-                output_doc = {
-                    'donation_id': donation_id,
-                    **self.allocation_state[donation_id]
-                }
-                allocations = [a.to_dict() for a in self.allocation_state[donation_id]['allocations']]
-                output_doc['allocations'] = allocations
-                all_allocations.append(output_doc)
+    def iter_match_fund_allocations(self, after_donation_id=None, status=None):
+        """
+        Generator over RESERVED or COLLECTED allocations, in the order donations were reserved
+        Expired donations are never visited, so each page costs time in proportion to its size.
+        Archived collected donations are merged in by reservation sequence, so a cursor
+        holds its place while donations are archived between pages.
+        """
+
+        if status not in (None, RESERVED):
+            raise BadRequestException("Invalid status filter %s" % status)
+
+        state = self.allocation_state
+        after_row = -1
+        after_key = None
+        if after_donation_id is not None and after_donation_id in state:
+            after_row = state.row(after_donation_id)
+            # an archived copy of the cursor, after a crash mid-archive, sorts at or before it
+            after_key = (state.sequence(after_row), float('inf'))
+        elif after_donation_id is not None:
+            after_key = self.archive.listing_key(after_donation_id) if self.archive is not None else None
+            if after_key is None:
+                raise BadRequestException("Invalid donation_id %s" % after_donation_id)
+            after_row = state.last_row_at(after_key[0])
+
+        live = ((state.sequence(row), state.to_dict(row))
+                for row in state.iter_rows(after_row, reserved_only=status == RESERVED))
+        if self.archive is None or status is not None:
+            for _, allocation_state_doc in live:
+                yield allocation_state_doc
+            return
+
+        # a donation both archived and in memory, after a crash mid-archive, is listed once
+        archived = ((sequence, allocation_state_doc)
+                    for sequence, allocation_state_doc in self.archive.iter_dicts(after_key, COLLECTED)
+                    if allocation_state_doc['donation_id'] not in state)
+        for _, allocation_state_doc in merge(archived, live, key=itemgetter(0)):
+            yield allocation_state_doc
+
+def _discard(sorted_keys, key):
+    """
+    Remove a key from a sorted list of keys, if present
+    Returns whether it was there
+    """
 
-        return all_allocations
\ No newline at end of file
+    ix = bisect_left(sorted_keys, key)
+    if ix < len(sorted_keys) and sorted_keys[ix] == key:
+        del sorted_keys[ix]
+        return True
+    return False
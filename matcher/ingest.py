@@ -0,0 +1,296 @@
+from matcher.exceptions import BadRequestException
+from matcher.validation import validate_donations, match_funds_from_columns, ERROR_MESSAGES
+from datetime import datetime
+from itertools import islice
+import csv
+import json
+import numpy as np
+import time
+
+# File formats
+CSV = "csv"
+NDJSON = "ndjson"
+
+FORMATS = (CSV, NDJSON)
+
+EXTENSIONS = {".csv": CSV, ".ndjson": NDJSON, ".jsonl": NDJSON, ".json": NDJSON}
+
+DEFAULT_CHUNK_SIZE = 10000
+
+ALLOCATION_COLUMNS = ("donation_id", "original_donation", "donation_balance_unmatched", "match_fund_id",
+                      "match_fund_allocation", "status", "created_time")
+REJECT_COLUMNS = ("line", "donation_id", "amount", "error")
+
+def file_format(path, default=None):
+    """
+    Format of a file from its extension, or default if the extension is not known
+    """
+
+    for extension, format in EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return format
+    if default is None:
+        raise BadRequestException("Cannot tell the format of %s, expected one of %s" % (path, ", ".join(EXTENSIONS)))
+    return default
+
+def open_records(path):
+    """
+    Open a CSV or NDJSON file for iter_records
+    Bytes that are not UTF-8 are kept as escapes, so that iter_records rejects the lines
+    holding them rather than the whole file failing to read.
+    """
+
+    return open(path, newline="", errors="surrogateescape")
+
+def iter_records(f, format):
+    """
+    Generator over (line number, record) pairs of an open CSV or NDJSON file
+    CSV records are dicts keyed by the header row. A line that cannot be parsed, or holds
+    bytes that are not UTF-8 (see open_records), is yielded as a BadRequestException in
+    place of its record.
+    """
+
+    if format == CSV:
+        reader = csv.DictReader(f)
+        while True:
+            try:
+                record = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                # the reader does not count the line it failed on
+                yield reader.line_num + 1, BadRequestException("Invalid CSV, %s" % str(e))
+                continue
+            if not _decodable(*record.values()):
+                record = BadRequestException("Invalid UTF-8 in line %s" % reader.line_num)
+            yield reader.line_num, record
+    elif format == NDJSON:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if not _decodable(line):
+                yield line_number, BadRequestException("Invalid UTF-8 in line %s" % line_number)
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, BadRequestException("Invalid JSON, %s" % str(e))
+                continue
+            if not isinstance(record, dict):
+                record = BadRequestException("Expected a JSON object, got %s" % line.strip())
+            yield line_number, record
+    else:
+        raise BadRequestException("Unknown file format %s" % format)
+
+def read_match_funds(path, format=None):
+    """
+    Read every match fund in a funds file
+    match_ratio is a [lhs, rhs] list in NDJSON, or "lhs:rhs" in CSV, and defaults to 1:1.
+    The fields are checked as columns by match_funds_from_columns, as the matcher's own
+    validation does. Unlike donations, a bad fund is an error: matching against a partial
+    set of funds would allocate the donations differently.
+    """
+
+    format = format or file_format(path)
+    line_numbers = []
+    records = []
+    with open_records(path) as f:
+        for line_number, record in iter_records(f, format):
+            if isinstance(record, BadRequestException):
+                raise BadRequestException("%s line %s: %s" % (path, line_number, record))
+            if record.get("match_fund_id") in (None, ""):
+                raise BadRequestException("%s line %s: Missing match_fund_id" % (path, line_number))
+            line_numbers.append(line_number)
+            records.append(record)
+
+    match_funds, valid, codes = match_funds_from_columns(
+        [record["match_fund_id"] for record in records],
+        [record.get("total_amount") for record in records],
+        [record.get("match_order") for record in records],
+        [record.get("match_ratio") or [1, 1] for record in records])
+
+    for line_number, record, ok, code in zip(line_numbers, records, valid.tolist(), codes.tolist()):
+        if not ok:
+            raise BadRequestException("%s line %s: Invalid match fund %s, %s" % (
+                path, line_number, record["match_fund_id"], ERROR_MESSAGES[code]))
+    return match_funds
+
+class IngestStats(object):
+    """
+    Counts of an ingestion run, updated after every chunk
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.reserved = 0
+        self.rejected = 0
+        self.chunks = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'reserved': self.reserved,
+            'rejected': self.rejected,
+            'chunks': self.chunks,
+            'elapsed': self.elapsed,
+            'rows_per_sec': self.rows_per_sec
+        }
+
+class AllocationWriter(object):
+    """
+    Writes reserved donations to a CSV or NDJSON stream
+    CSV has one line per allocation, and one line with no fund for a donation left
+    unmatched; NDJSON has one object per donation, as listed by the matcher.
+    """
+
+    def __init__(self, f, format):
+        self.format = format
+        self._f = f
+        if format == CSV:
+            self._writer = csv.writer(f)
+            self._writer.writerow(ALLOCATION_COLUMNS)
+        elif format != NDJSON:
+            raise BadRequestException("Unknown file format %s" % format)
+
+    def write(self, allocation_state_doc):
+        """
+        Write one donation, as a dict from AllocationState.to_dict
+        """
+
+        if self.format == NDJSON:
+            self._f.write(json.dumps(allocation_state_doc, default=_to_json) + "\n")
+            return
+
+        common = (allocation_state_doc['donation_id'], allocation_state_doc['original_donation'],
+                  allocation_state_doc['donation_balance_unmatched'])
+        created_time = allocation_state_doc['created_time'].isoformat()
+        allocations = allocation_state_doc['allocations']
+        if not allocations:
+            self._writer.writerow(common + ("", "", allocation_state_doc['overall_status'], created_time))
+        for allocation in allocations:
+            self._writer.writerow(common + (allocation['match_fund_id'], allocation['match_fund_allocation'],
+                                            allocation['status'], created_time))
+
+class RejectWriter(object):
+    """
+    Writes rejected donation rows to a CSV stream, with the line and reason
+    """
+
+    def __init__(self, f):
+        self._writer = csv.writer(f)
+        self._writer.writerow(REJECT_COLUMNS)
+
+    def write(self, line_number, record, error):
+        if not isinstance(record, dict):
+            record = {}
+        self._writer.writerow((line_number, record.get("donation_id", ""), record.get("amount", ""), str(error)))
+
+def ingest(fund_matcher, records, allocation_writer=None, reject_writer=None, chunk_size=DEFAULT_CHUNK_SIZE,
+           progress=None):
+    """
+    Reserve a stream of (line number, record) donation pairs, chunk_size at a time
+    Each chunk's amounts are validated as one column; the valid donations are reserved
+    with one reserve_columns call, without a Donation per row, and written out before the next chunk is read, so the
+    pipeline holds at most one chunk whatever the size of the input. The matcher's own
+    allocation state still grows by one compact row per donation reserved.
+    Rows that fail validation, or repeat a donation id already reserved, are written to
+    the reject writer and the run carries on. progress, if given, is called with the
+    IngestStats after each chunk.
+    Returns the IngestStats
+    """
+
+    if chunk_size < 1:
+        raise BadRequestException("Chunk size must be positive, %s" % chunk_size)
+
+    stats = IngestStats()
+    records = iter(records)
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+
+        donation_ids, amounts, rejects = _validate_chunk(chunk, fund_matcher)
+
+        stats.rejected += len(rejects)
+        if reject_writer is not None:
+            for line_number, record, error in rejects:
+                reject_writer.write(line_number, record, error)
+
+        if donation_ids:
+            allocation_state_docs = fund_matcher.reserve_columns(donation_ids, amounts)
+            if allocation_writer is not None:
+                state = fund_matcher.allocation_state
+                for allocation_state_doc in allocation_state_docs:
+                    allocation_writer.write(state.to_dict(allocation_state_doc.row))
+
+        stats.rows += len(chunk)
+        stats.reserved += len(donation_ids)
+        stats.chunks += 1
+        stats.elapsed = time.perf_counter() - stats.started
+        if progress is not None:
+            progress(stats)
+
+    stats.elapsed = time.perf_counter() - stats.started
+    return stats
+
+def _validate_chunk(chunk, fund_matcher):
+    """
+    Split a chunk of (line number, record) pairs into the donations to reserve and the rejects
+    Amounts are validated as one column with validate_donations.
+    Returns the donation ids and amounts to reserve, and a list of (line number, record, error)
+    """
+
+    rejects = []
+    rows = []
+    for line_number, record in chunk:
+        if isinstance(record, BadRequestException):
+            rejects.append((line_number, record, record))
+        elif record.get("donation_id") in (None, ""):
+            rejects.append((line_number, record, BadRequestException("Missing donation_id")))
+        elif not isinstance(record["donation_id"], (str, int)):
+            rejects.append((line_number, record, BadRequestException("Invalid donation_id %s" % record["donation_id"])))
+        else:
+            rows.append((line_number, record))
+
+    amounts, valid, codes = validate_donations([record.get("amount") for _, record in rows])
+
+    donation_ids = []
+    seen = set()
+    reserve = np.zeros(len(rows), dtype=bool)
+    for ix, ((line_number, record), ok, code) in enumerate(zip(rows, valid.tolist(), codes.tolist())):
+        donation_id = record["donation_id"]
+        if not ok:
+            error = BadRequestException("%s, %s" % (ERROR_MESSAGES[code], record.get("amount")))
+        elif donation_id in seen or fund_matcher.donation_status(donation_id) is not None:
+            error = BadRequestException("Duplicate donation id %s" % donation_id)
+        else:
+            seen.add(donation_id)
+            donation_ids.append(donation_id)
+            reserve[ix] = True
+            continue
+        rejects.append((line_number, record, error))
+
+    rejects.sort(key=lambda reject: reject[0])
+    return donation_ids, amounts[reserve], rejects
+
+def _decodable(*values):
+    # escaped bytes (see open_records) are lone surrogates, which cannot be encoded back
+    try:
+        for value in values:
+            if isinstance(value, str):
+                value.encode()
+    except UnicodeEncodeError:
+        return False
+    return True
+
+def _to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serialisable" % (value,))
@@ -0,0 +1,293 @@
+from bisect import bisect_left
+from matcher.exceptions import BadRequestException
+import threading
+import time
+
+# Operations
+RESERVE = "reserve_funds"
+RESERVE_BATCH = "reserve_funds_batch"
+COLLECT = "collect_donation"
+EXPIRE = "expire_donation"
+COLLECT_MANY = "collect_donations"
+EXPIRE_MANY = "expire_donations"
+LIST = "list_match_fund_allocations"
+
+OPERATIONS = (RESERVE, RESERVE_BATCH, COLLECT, EXPIRE, COLLECT_MANY, EXPIRE_MANY, LIST)
+
+# Events pushed to listeners, as listener(event, value, labels)
+LATENCY = "latency"                 # seconds an operation took, labelled with the operation
+REJECTED = "rejected"               # 1 per BadRequestException raised or returned, labelled with the operation and message
+FUNDS_SCANNED = "funds_scanned"     # funds drawn from by one reservation
+MATCH = "match"                     # 1 per reservation, labelled with its outcome
+FUND_EXHAUSTED = "fund_exhausted"   # 1 per fund a reservation drained, labelled with the fund
+
+# Reservation outcomes
+FULL = "full"
+PARTIAL = "partial"
+UNMATCHED = "unmatched"
+
+# Histogram bucket upper bounds: 1us doubling up to about 8s, and funds scanned 1 doubling up to 1024
+LATENCY_BOUNDS = tuple(1e-6 * 2 ** n for n in range(24))
+FUNDS_SCANNED_BOUNDS = (0,) + tuple(2 ** n for n in range(11))
+
+class Histogram(object):
+    """
+    Fixed bucket histogram
+    Each bucket counts the values up to its upper bound; values beyond the last bound
+    go into an overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def record(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile, or the maximum if it overflowed
+        """
+
+        if not self.count:
+            return None
+
+        rank = max(1, p * self.count / 100)
+        seen = 0
+        for ix, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return self.bounds[ix] if ix < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.bounds + (None,), self.buckets))
+        }
+
+class Metrics(object):
+    """
+    Metrics of a FundMatcher, read with snapshot() or pushed to listeners as they happen
+    Recording can be switched on and off at runtime with enabled; while disabled an
+    InstrumentedFundMatcher calls straight through, at the cost of one attribute check.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._listeners = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._latencies = {operation: Histogram(LATENCY_BOUNDS) for operation in OPERATIONS}
+            self._rejected = {operation: 0 for operation in OPERATIONS}
+            self._funds_scanned = Histogram(FUNDS_SCANNED_BOUNDS)
+            self._matches = {FULL: 0, PARTIAL: 0, UNMATCHED: 0}
+            self._fund_exhaustions = {}
+
+    def add_listener(self, listener):
+        """
+        Push every event to listener(event, value, labels) as it is recorded
+        Listeners are called on the thread of the operation, so should be quick.
+        """
+
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def record_latency(self, operation, seconds):
+        with self._lock:
+            self._latencies[operation].record(seconds)
+        if self._listeners:
+            self._push(LATENCY, seconds, {'operation': operation})
+
+    def record_rejected(self, operation, exception):
+        with self._lock:
+            self._rejected[operation] += 1
+        if self._listeners:
+            self._push(REJECTED, 1, {'operation': operation, 'message': str(exception)})
+
+    def record_reservation(self, matches, donation_balance_unmatched, exhausted_fund_ids):
+        if donation_balance_unmatched == 0:
+            outcome = FULL
+        elif matches:
+            outcome = PARTIAL
+        else:
+            outcome = UNMATCHED
+
+        with self._lock:
+            self._funds_scanned.record(len(matches))
+            self._matches[outcome] += 1
+            for match_fund_id in exhausted_fund_ids:
+                self._fund_exhaustions[match_fund_id] = self._fund_exhaustions.get(match_fund_id, 0) + 1
+
+        if self._listeners:
+            self._push(FUNDS_SCANNED, len(matches), {})
+            self._push(MATCH, 1, {'outcome': outcome})
+            for match_fund_id in exhausted_fund_ids:
+                self._push(FUND_EXHAUSTED, 1, {'match_fund_id': match_fund_id})
+
+    def snapshot(self):
+        """
+        Point in time copy of every metric, as plain dicts
+        """
+
+        with self._lock:
+            return {
+                'operations': {
+                    operation: {'latency': self._latencies[operation].to_dict(), 'rejected': self._rejected[operation]}
+                    for operation in OPERATIONS
+                },
+                'funds_scanned': self._funds_scanned.to_dict(),
+                'matches': dict(self._matches),
+                'fund_exhaustions': sum(self._fund_exhaustions.values()),
+                'fund_exhaustions_by_fund': dict(self._fund_exhaustions),
+                'rejected': sum(self._rejected.values())
+            }
+
+    def _push(self, event, value, labels):
+        for listener in self._listeners:
+            listener(event, value, labels)
+
+class InstrumentedFundMatcher(object):
+    """
+    Front-end to a FundMatcher that records Metrics around every operation
+    Works with any matcher, locked or durable ones included, and passes every other
+    attribute through. The number of funds scanned, the match outcome and the funds a
+    reservation drained are read back from the allocation state after it returns, so
+    the matcher's own hot path is untouched. Under concurrent reservations a drained fund
+    may be put down to the wrong one of two racing reservations; the counts still add up.
+    Retries of a reservation are timed but not counted again.
+    A matcher that is not wrapped at all pays nothing.
+    """
+
+    def __init__(self, fund_matcher, metrics=None):
+        self.fund_matcher = fund_matcher
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def __getattr__(self, name):
+        return getattr(self.fund_matcher, name)
+
+    def reserve_funds(self, donation):
+        if not self.metrics.enabled:
+            return self.fund_matcher.reserve_funds(donation)
+
+        replayed = self.fund_matcher.donation_status(donation.donation_id) is not None
+        result = self._timed(RESERVE, self.fund_matcher.reserve_funds, donation)
+        if replayed:
+            return result
+
+        state = self.fund_matcher.allocation_state
+        row = state.row(donation.donation_id)
+        matches = state.matches(row)
+        match_funds = self.fund_matcher.match_funds
+        self.metrics.record_reservation(matches, state.field(row, 'donation_balance_unmatched'),
+                                        [match_fund_id for match_fund_id, _ in matches
+                                         if match_funds[match_fund_id].total_amount == 0])
+        return result
+
+    def reserve_funds_batch(self, donations):
+        if not self.metrics.enabled:
+            return self.fund_matcher.reserve_funds_batch(donations)
+
+        donation_ids = [donation.donation_id for donation in donations]
+        new_donation_ids = self._new_donation_ids(donation_ids)
+        allocation_state_docs = self._timed(RESERVE_BATCH, self.fund_matcher.reserve_funds_batch, donations)
+        self._record_batch(donation_ids, allocation_state_docs, new_donation_ids)
+        return allocation_state_docs
+
+    def reserve_columns(self, donation_ids, amounts):
+        if not self.metrics.enabled:
+            return self.fund_matcher.reserve_columns(donation_ids, amounts)
+
+        new_donation_ids = self._new_donation_ids(donation_ids)
+        allocation_state_docs = self._timed(RESERVE_BATCH, self.fund_matcher.reserve_columns, donation_ids, amounts)
+        self._record_batch(donation_ids, allocation_state_docs, new_donation_ids)
+        return allocation_state_docs
+
+    def collect_donation(self, donation_id):
+        if not self.metrics.enabled:
+            return self.fund_matcher.collect_donation(donation_id)
+        return self._timed(COLLECT, self.fund_matcher.collect_donation, donation_id)
+
+    def expire_donation(self, donation_id):
+        if not self.metrics.enabled:
+            return self.fund_matcher.expire_donation(donation_id)
+        return self._timed(EXPIRE, self.fund_matcher.expire_donation, donation_id)
+
+    def collect_donations(self, donation_ids, atomic=True):
+        if not self.metrics.enabled:
+            return self.fund_matcher.collect_donations(donation_ids, atomic)
+        return self._timed_many(COLLECT_MANY, self.fund_matcher.collect_donations, donation_ids, atomic)
+
+    def expire_donations(self, donation_ids, atomic=True):
+        if not self.metrics.enabled:
+            return self.fund_matcher.expire_donations(donation_ids, atomic)
+        return self._timed_many(EXPIRE_MANY, self.fund_matcher.expire_donations, donation_ids, atomic)
+
+    def list_match_fund_allocations(self, limit=None, after_donation_id=None, status=None):
+        if not self.metrics.enabled:
+            return self.fund_matcher.list_match_fund_allocations(limit, after_donation_id, status)
+        return self._timed(LIST, self.fund_matcher.list_match_fund_allocations, limit, after_donation_id, status)
+
+    def _timed(self, operation, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        except BadRequestException as e:
+            self.metrics.record_rejected(operation, e)
+            raise
+        finally:
+            self.metrics.record_latency(operation, time.perf_counter() - start)
+
+    def _timed_many(self, operation, method, donation_ids, atomic):
+        # bulk methods return their rejections rather than raising them
+        outcomes = self._timed(operation, method, donation_ids, atomic)
+        for outcome in outcomes:
+            if isinstance(outcome, BadRequestException):
+                self.metrics.record_rejected(operation, outcome)
+        return outcomes
+
+    def _new_donation_ids(self, donation_ids):
+        return set(donation_id for donation_id in donation_ids if self.fund_matcher.donation_status(donation_id) is None)
+
+    def _record_batch(self, donation_ids, allocation_state_docs, new_donation_ids):
+        """
+        Record the outcome of the reservations made by one batch, from their rows
+        Only the first reservation of each of new_donation_ids is recorded; the rest are retries.
+        """
+
+        state = self.fund_matcher.allocation_state
+        rows = []
+        for donation_id, allocation_state_doc in zip(donation_ids, allocation_state_docs):
+            if donation_id in new_donation_ids:
+                new_donation_ids.discard(donation_id)
+                rows.append(allocation_state_doc.row)
+        match_funds = self.fund_matcher.match_funds
+        reservations = [(state.matches(row), state.field(row, 'donation_balance_unmatched')) for row in rows]
+
+        # A fund left empty was drained by the last of these reservations to draw from it
+        drained = set()
+        exhausted_fund_ids = []
+        for matches, _ in reversed(reservations):
+            exhausted_fund_ids.append([match_fund_id for match_fund_id, _ in matches
+                                       if match_fund_id not in drained and match_funds[match_fund_id].total_amount == 0])
+            drained.update(match_fund_id for match_fund_id, _ in matches)
+
+        for (matches, donation_balance_unmatched), fund_ids in zip(reservations, reversed(exhausted_fund_ids)):
+            self.metrics.record_reservation(matches, donation_balance_unmatched, fund_ids)
@@ -0,0 +1,164 @@
+from decimal import Decimal, ROUND_DOWN, ROUND_UP, ROUND_HALF_EVEN, ROUND_HALF_UP
+from fractions import Fraction
+from matcher.allocation_state import AllocationState, MINOR_UNIT_AMOUNTS
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import numpy as np
+
+# minor units per major unit, eg pence per pound
+DEFAULT_MINOR_UNITS = 100
+
+# Rounding rules of the exact money engine
+# Converting an amount in major units (eg 12.345) to minor units
+AMOUNT_ROUNDING = ROUND_HALF_EVEN
+# The match a fund owes a donation balance: rounded down, so a fund never pays more than its ratio
+MATCH_ROUNDING = ROUND_DOWN
+# The share of a donation covered by a partial match: rounded up, so the unmatched
+# balance is never overstated against the money the fund actually paid
+COVERED_ROUNDING = ROUND_UP
+
+ROUNDING_MODES = (ROUND_DOWN, ROUND_UP, ROUND_HALF_EVEN, ROUND_HALF_UP)
+
+def to_minor_units(amount, minor_units=DEFAULT_MINOR_UNITS, rounding=AMOUNT_ROUNDING):
+    """
+    Convert an amount in major units to an integer number of minor units
+    Floats are converted through their shortest decimal representation, so 0.125 is
+    exactly twelve and a half pence and rounds to 12 under ROUND_HALF_EVEN.
+    """
+
+    try:
+        amount = Decimal(str(amount))
+    except ArithmeticError as e:
+        raise BadRequestException("Amount cannot be expressed in minor units, with error %s" % str(e))
+
+    return int((amount * minor_units).quantize(Decimal(1), rounding=rounding))
+
+def from_minor_units(amount, minor_units=DEFAULT_MINOR_UNITS):
+    """
+    Convert an integer number of minor units to an exact Decimal in major units
+    """
+
+    return Decimal(amount) / minor_units
+
+def ratio_as_fraction(match_ratio):
+    """
+    Exact rational multiplier of a [lhs, rhs] match ratio
+    """
+
+    lhs, rhs = match_ratio
+    return Fraction(str(lhs)) / Fraction(str(rhs))
+
+def divide(numerator, denominator, rounding):
+    """
+    Integer division of non-negative integers, rounded as given
+    """
+
+    quotient, remainder = divmod(numerator, denominator)
+
+    if rounding == ROUND_DOWN or remainder == 0:
+        return quotient
+    if rounding == ROUND_UP:
+        return quotient + 1
+    if rounding == ROUND_HALF_UP:
+        return quotient + (2 * remainder >= denominator)
+    if rounding == ROUND_HALF_EVEN:
+        return quotient + (2 * remainder > denominator or (2 * remainder == denominator and quotient % 2 == 1))
+
+    raise BadRequestException("Unsupported rounding mode %s" % rounding)
+
+def divide_array(numerators, denominator, rounding):
+    """
+    Vectorised divide, over an int64 array of numerators
+    """
+
+    quotients, remainders = np.divmod(numerators, denominator)
+
+    if rounding == ROUND_DOWN:
+        return quotients
+    if rounding == ROUND_UP:
+        return quotients + (remainders > 0)
+    if rounding == ROUND_HALF_UP:
+        return quotients + (2 * remainders >= denominator)
+    if rounding == ROUND_HALF_EVEN:
+        return quotients + ((2 * remainders > denominator) | ((2 * remainders == denominator) & (quotients % 2 == 1)))
+
+    raise BadRequestException("Unsupported rounding mode %s" % rounding)
+
+class ExactFundMatcher(FundMatcher):
+    """
+    FundMatcher doing all arithmetic in integer minor units with exact rational ratios
+    Match funds are copied with total_amount converted to minor units, and donation
+    amounts are converted as they are reserved, both with AMOUNT_ROUNDING. From there on
+    every balance, allocation and unmatched amount is an int number of minor units, so
+    the sum of a fund's allocations and its balance always equals its starting amount
+    and the == 0 exhaustion checks are exact. The batch path uses int64 arrays.
+    """
+
+    AMOUNT_DTYPE = np.int64
+
+    def __init__(self, match_funds, minor_units=DEFAULT_MINOR_UNITS):
+        self.minor_units = minor_units
+
+        super().__init__([self._exact_fund(mf) for mf in match_funds])
+
+        self.allocation_state = AllocationState(amount_typecode=MINOR_UNIT_AMOUNTS)
+
+    def add_match_fund(self, match_fund):
+        super().add_match_fund(self._exact_fund(match_fund))
+
+    def top_up(self, match_fund_id, amount):
+        super().top_up(match_fund_id, self._amount(amount))
+
+    def _amount(self, amount):
+        return to_minor_units(amount, self.minor_units)
+
+    def _exact_fund(self, match_fund):
+        """
+        Copy of a match fund with its total_amount in minor units and an exact ratio
+        """
+
+        if match_fund.total_amount < 0:
+            raise BadRequestException("Total amount cannot be negative, %s" % match_fund.total_amount)
+
+        exact_fund = MatchFund(match_fund.match_fund_id, 0, match_fund.match_order, match_fund.matching_ratio)
+        exact_fund.total_amount = to_minor_units(match_fund.total_amount, self.minor_units)
+        exact_fund.matching_ratio_as_fraction = ratio_as_fraction(match_fund.matching_ratio)
+        return exact_fund
+
+    def _reserve(self, donation_id, amount, now):
+        return super()._reserve(donation_id, self._amount(amount), now)
+
+    def _reserve_batch(self, donation_ids, amounts, now):
+        amounts = [self._amount(amount) for amount in amounts]
+        return super()._reserve_batch(donation_ids, amounts, now)
+
+    def _draw_from_fund(self, match_fund, donation_balance):
+        ratio = match_fund.matching_ratio_as_fraction
+        matching_amount_required = divide(donation_balance * ratio.numerator, ratio.denominator, MATCH_ROUNDING)
+
+        if match_fund.total_amount >= matching_amount_required:
+            # full match
+            match_fund.total_amount -= matching_amount_required
+            return matching_amount_required, 0
+
+        # partial match - the fund pays what it has left
+        allocated_amount = match_fund.total_amount
+        covered = divide(allocated_amount * ratio.denominator, ratio.numerator, COVERED_ROUNDING)
+        match_fund.total_amount = 0
+        return allocated_amount, donation_balance - min(covered, donation_balance)
+
+    def _fund_capacity(self, match_fund):
+        # the share of a donation a partial match covers, as _draw_from_fund rounds it
+        ratio = match_fund.matching_ratio_as_fraction
+        return divide(match_fund.total_amount * ratio.denominator, ratio.numerator, COVERED_ROUNDING)
+
+    def _capacity_slack(self, match_fund):
+        # a ratio below 1:1 rounds the match down, so a donation up to den/num - 1 past
+        # the covered amount is still matched in full by the balance
+        ratio = match_fund.matching_ratio_as_fraction
+        return max(divide(ratio.denominator, ratio.numerator, COVERED_ROUNDING) - 1, 0)
+
+    def _required_matches(self, match_fund, amounts):
+        ratio = match_fund.matching_ratio_as_fraction
+        return divide_array(amounts * ratio.numerator, ratio.denominator, MATCH_ROUNDING)
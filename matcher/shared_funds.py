@@ -0,0 +1,197 @@
+from matcher.capacity_index import CapacityIndex
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from array import array
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+import os
+import sys
+
+# fund count and front, the position of the first fund in match_order that may have a balance
+HEADER_FIELDS = 2
+
+class SharedFundTable(object):
+    """
+    Match fund balances and ratios in a shared memory block, for matchers in many processes
+    The funds are laid out in match_order, as FundMatcher would draw from them, with one
+    cross-process lock over the whole table. Only the balances ever change, and only
+    under the lock. The fund ids, orders and ratios are fixed when the table is made.
+    A table is handed to worker processes as a multiprocessing.Process argument, which
+    attaches them to the same block and lock; the process that made it closes and
+    unlinks it once the workers are done.
+    """
+
+    def __init__(self, match_funds):
+        match_funds = sorted(match_funds, key=lambda mf: mf.match_order)
+        if len({mf.match_fund_id for mf in match_funds}) != len(match_funds):
+            raise BadRequestException("Match fund ids must be unique")
+
+        self.funds = [(mf.match_fund_id, mf.match_order, list(mf.matching_ratio)) for mf in match_funds]
+        self.lock = multiprocessing.Lock()
+        self._owner = True
+
+        count = len(match_funds)
+        self._memory = shared_memory.SharedMemory(create=True, size=8 * (HEADER_FIELDS + 2 * max(count, 1)))
+        self._map()
+        self._header[:] = array('q', (count, 0))
+        self.balances[:] = array('d', [mf.total_amount for mf in match_funds])
+        self.multipliers[:] = array('d', [mf.matching_ratio_as_float_multiplier for mf in match_funds])
+
+    @property
+    def front(self):
+        return self._header[1]
+
+    @front.setter
+    def front(self, position):
+        self._header[1] = position
+
+    def close(self):
+        """
+        Detach this process from the table, and free the block if this process made it
+        """
+
+        for view in (self._header, self.balances, self.multipliers):
+            view.release()
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+    def __getstate__(self):
+        return {'name': self._memory.name, 'funds': self.funds, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.funds = state['funds']
+        self.lock = state['lock']
+        self._owner = False
+        # the block belongs to the process that made it; tracked by this process's resource
+        # tracker too, it would be unlinked when this process exits, from under the others
+        if sys.version_info >= (3, 13):
+            self._memory = shared_memory.SharedMemory(name=state['name'], track=False)
+        else:
+            self._memory = shared_memory.SharedMemory(name=state['name'])
+            if os.name == "posix":
+                # the tracker holds POSIX names with the leading slash that name drops
+                resource_tracker.unregister("/" + self._memory.name, "shared_memory")
+        self._map()
+
+    def _map(self):
+        # memoryviews rather than numpy arrays: their items are read as Python floats, several times faster
+        count = len(self.funds)
+        buffer = self._memory.buf
+        self._header = buffer[:8 * HEADER_FIELDS].cast('q')
+        self.balances = buffer[8 * HEADER_FIELDS:8 * (HEADER_FIELDS + count)].cast('d')
+        self.multipliers = buffer[8 * (HEADER_FIELDS + count):8 * (HEADER_FIELDS + 2 * count)].cast('d')
+
+class SharedMatchFund(MatchFund):
+    """
+    Match fund whose balance and ratio are read from, and written to, a SharedFundTable
+    """
+
+    def __init__(self, table, position):
+        match_fund_id, match_order, matching_ratio = table.funds[position]
+        self.match_fund_id = match_fund_id
+        self.match_order = match_order
+        self.matching_ratio = matching_ratio
+        self._table = table
+        self._position = position
+
+    @property
+    def total_amount(self):
+        return self._table.balances[self._position]
+
+    @total_amount.setter
+    def total_amount(self, amount):
+        self._table.balances[self._position] = amount
+
+    @property
+    def matching_ratio_as_float_multiplier(self):
+        return self._table.multipliers[self._position]
+
+    def __copy__(self):
+        # a copy is detached from the table, so drawing from it, as a quote does, leaves the table alone
+        return MatchFund(self.match_fund_id, self.total_amount, self.match_order, self.matching_ratio)
+
+class SharedFundMatcher(FundMatcher):
+    """
+    FundMatcher that reserves against the balances of a SharedFundTable
+    Any number of processes, each with a SharedFundMatcher over the same table, can
+    reserve against the same funds. Each reservation draws from the funds in match_order
+    holding the table lock, so no fund is over-allocated and every reservation sees the
+    draws of the ones before it, in whichever process. Only the matching itself is done
+    under the lock: each process keeps its own allocation state, and recording a
+    reservation in it is done in parallel.
+    The allocation state, the listings and the reserved, collected and expired fund
+    totals therefore cover one process's donations; retries of a donation id are only
+    recognised by the process that reserved it, so a donation should always be routed to
+    the same process. Balances read outside the lock, as by get_summary, may be a draw
+    behind.
+    Funds can be topped up; the registry is otherwise fixed by the table.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        super().__init__([SharedMatchFund(table, position) for position in range(len(table.funds))])
+
+    def add_match_fund(self, match_fund):
+        raise BadRequestException("Match funds cannot be added to a shared fund table")
+
+    def retire_match_fund(self, match_fund_id):
+        raise BadRequestException("Match funds cannot be retired from a shared fund table")
+
+    def reorder_match_fund(self, match_fund_id, match_order):
+        raise BadRequestException("Match funds cannot be reordered in a shared fund table")
+
+    def quote(self, amount, breakdown=False):
+        with self.table.lock:
+            return super().quote(amount, breakdown)
+
+    def _fresh_capacity_index(self):
+        # other processes change the balances unseen, so the index is built afresh for each quote
+        return CapacityIndex(self)
+
+    def _iter_active_fund_keys(self):
+        for fund_key in self._fund_order[self.table.front:]:
+            if self.match_funds[fund_key[2]].total_amount != 0:
+                yield fund_key
+
+    def _match_amount(self, donation_balance):
+        with self.table.lock:
+            return self._match_locked(donation_balance)
+
+    def _match_batch(self, amounts):
+        with self.table.lock:
+            return [self._match_locked(amount) for amount in amounts.tolist()]
+
+    def _match_locked(self, donation_balance):
+        """
+        Draw a donation amount from the funds in match_order, from the table's front on
+        Funds run dry past the front are passed over, each costing a balance check.
+        """
+
+        table = self.table
+        matches = []
+        position = table.front
+        while position < len(self._fund_order):
+            match_fund = self.match_funds[self._fund_order[position][2]]
+            position += 1
+            if match_fund.total_amount == 0:
+                continue
+
+            allocated_amount, donation_balance = self._draw_from_fund(match_fund, donation_balance)
+            matches.append((match_fund.match_fund_id, allocated_amount))
+            if donation_balance == 0:
+                break
+
+        front = table.front
+        while front < len(self._fund_order) and table.balances[front] == 0:
+            front += 1
+        table.front = front
+
+        return matches, donation_balance
+
+    def _credit_fund(self, match_fund, amount):
+        with self.table.lock:
+            match_fund.total_amount += amount
+            if match_fund._position < self.table.front:
+                self.table.front = match_fund._position
@@ -0,0 +1,275 @@
+from array import array
+from matcher.allocation_state import AllocationState, column_typecodes
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+import json
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'FMSNAP01'
+
+# magic, then the offset and length of the JSON metadata at the end of the file
+HEADER = struct.Struct('<8sQQ')
+
+ALIGNMENT = 8
+
+def write_snapshot(fund_matcher, path, **metadata):
+    """
+    Write match fund balances and the allocation state of a matcher to a binary snapshot
+    Columns are written as raw arrays, followed by the donation ids and a hash table
+    from donation id to row, so that open_snapshot can serve straight from the file.
+    Fund balances are written in major units, as a matcher is made with them, and the
+    allocation state in the matcher's own units.
+    Extra keyword arguments are stored in the snapshot metadata.
+    The snapshot is written to a temporary file and moved into place.
+    """
+
+    state = fund_matcher.allocation_state
+    row_count = len(state._donation_ids)
+
+    encoded_ids = [_encode_id(state._donation_ids[row]) for row in range(row_count)]
+    id_offsets = array('q', [0])
+    for encoded_id in encoded_ids:
+        id_offsets.append(id_offsets[-1] + len(encoded_id))
+
+    current = array('b', bytes(row_count))
+    row_table = array('q', bytes(8 * _table_size(len(state))))
+    mask = len(row_table) - 1
+    for donation_id in state:
+        row = state.row(donation_id)
+        current[row] = 1
+        slot = zlib.crc32(encoded_ids[row]) & mask
+        while row_table[slot]:
+            slot = (slot + 1) & mask
+        row_table[slot] = row + 1
+
+    sections = [(name, getattr(state, name).tobytes()) for name, _ in column_typecodes(state.amount_typecode)]
+    sections += [
+        ('_donation_id_offsets', id_offsets.tobytes()),
+        ('_donation_id_blob', b''.join(encoded_ids)),
+        ('_current', current.tobytes()),
+        ('_row_table', row_table.tobytes())
+    ]
+
+    # 1 in the matcher's own units
+    scale = fund_matcher._amount(1)
+    metadata.update({
+        'funds': [[mf.match_fund_id, mf.total_amount / scale, mf.match_order, list(mf.matching_ratio)]
+                  for mf in fund_matcher.get_match_funds_as_list()],
+        'fund_ids': list(state._fund_ids),
+        'retired_fund_ids': [mf.match_fund_id for mf in fund_matcher.get_match_funds_as_list()
+                             if fund_matcher.is_retired(mf.match_fund_id)],
+        'amount_typecode': state.amount_typecode,
+        'row_count': row_count,
+        'allocation_count': len(state._allocation_amount),
+        'current_count': len(state),
+        'next_sequence': state.next_sequence,
+        'sections': {}
+    })
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(bytes(HEADER.size))
+        for name, data in sections:
+            offset = _pad(f)
+            f.write(data)
+            metadata['sections'][name] = [offset, len(data)]
+
+        metadata_offset = _pad(f)
+        metadata_bytes = json.dumps(metadata).encode()
+        f.write(metadata_bytes)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, metadata_offset, len(metadata_bytes)))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporary_path, path)
+
+def read_snapshot(path):
+    """
+    Memory-map a snapshot
+    The file is mapped copy-on-write: columns are views over the mapping, pages are
+    only read in when a row is touched, and changes stay private to this process.
+    Rows added after opening are appended to ordinary arrays.
+    Returns the match funds, the allocation state and the snapshot metadata
+    """
+
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    magic, metadata_offset, metadata_length = HEADER.unpack_from(mapping)
+    if magic != MAGIC:
+        raise BadRequestException("%s is not a fund matcher snapshot" % path)
+
+    metadata = json.loads(mapping[metadata_offset:metadata_offset + metadata_length])
+    view = memoryview(mapping)
+
+    def section(name, typecode='B'):
+        offset, length = metadata['sections'][name]
+        return view[offset:offset + length].cast(typecode)
+
+    amount_typecode = metadata['amount_typecode']
+    columns = {name: SegmentedColumn(section(name, typecode), typecode)
+               for name, typecode in column_typecodes(amount_typecode)}
+    donation_ids = SnapshotDonationIds(section('_donation_id_blob'), section('_donation_id_offsets', 'q'))
+    rows = SnapshotRows(donation_ids, section('_row_table', 'q'), section('_current', 'b'), metadata['current_count'])
+
+    allocation_state = AllocationState(columns, donation_ids, rows, metadata['fund_ids'], amount_typecode,
+                                       metadata['next_sequence'])
+    match_funds = [MatchFund(*fund_data) for fund_data in metadata['funds']]
+
+    return match_funds, allocation_state, metadata
+
+def open_snapshot(path, matcher_class=FundMatcher):
+    """
+    Open a snapshot as a matcher that is ready to serve straight away
+    """
+
+    match_funds, allocation_state, metadata = read_snapshot(path)
+
+    fund_matcher = matcher_class(match_funds)
+    fund_matcher.allocation_state = allocation_state
+    for match_fund_id in metadata.get('retired_fund_ids', []):
+        fund_matcher._mark_retired(match_fund_id)
+
+    return fund_matcher
+
+class SegmentedColumn(object):
+    """
+    Column made of a fixed view over a snapshot followed by an array of new rows
+    """
+
+    __slots__ = ('_base', '_base_length', '_tail')
+
+    def __init__(self, base, typecode):
+        self._base = base
+        self._base_length = len(base)
+        self._tail = array(typecode)
+
+    def __len__(self):
+        return self._base_length + len(self._tail)
+
+    def __getitem__(self, ix):
+        if ix < self._base_length:
+            return self._base[ix]
+        return self._tail[ix - self._base_length]
+
+    def __setitem__(self, ix, value):
+        if ix < self._base_length:
+            self._base[ix] = value
+        else:
+            self._tail[ix - self._base_length] = value
+
+    def append(self, value):
+        self._tail.append(value)
+
+    def tobytes(self):
+        return self._base.tobytes() + self._tail.tobytes()
+
+class SnapshotDonationIds(object):
+    """
+    List of donation ids by row, decoded from the snapshot only when read
+    """
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+        self._base_length = len(offsets) - 1
+        self._tail = []
+
+    def __len__(self):
+        return self._base_length + len(self._tail)
+
+    def __getitem__(self, row):
+        if row < self._base_length:
+            return json.loads(bytes(self.encoded(row)))
+        return self._tail[row - self._base_length]
+
+    def append(self, donation_id):
+        self._tail.append(donation_id)
+
+    def encoded(self, row):
+        return self._blob[self._offsets[row]:self._offsets[row + 1]]
+
+class SnapshotRows(object):
+    """
+    Donation id to row mapping, backed by the snapshot's open addressing hash table
+    Donation ids added after opening, including ones that replace a snapshot row, are
+    held in an ordinary dict that is consulted first.
+    """
+
+    def __init__(self, donation_ids, row_table, current, current_count):
+        self._donation_ids = donation_ids
+        self._row_table = row_table
+        self._mask = len(row_table) - 1
+        self._current = current
+        self._current_count = current_count
+        self._overlay = {}
+        self._replaced = set()
+
+    def get(self, donation_id, default=None):
+        row = self._overlay.get(donation_id)
+        if row is not None:
+            return row
+        return self._snapshot_row(donation_id, default)
+
+    def __getitem__(self, donation_id):
+        row = self.get(donation_id)
+        if row is None:
+            raise KeyError(donation_id)
+        return row
+
+    def __setitem__(self, donation_id, row):
+        if donation_id not in self._overlay and self._snapshot_row(donation_id) is not None:
+            self._replaced.add(donation_id)
+        self._overlay[donation_id] = row
+
+    def __contains__(self, donation_id):
+        return self.get(donation_id) is not None
+
+    def __len__(self):
+        return self._current_count - len(self._replaced) + len(self._overlay)
+
+    def __iter__(self):
+        # like a dict, a replaced donation id keeps its original position
+        for row in range(len(self._current)):
+            if self._current[row]:
+                yield self._donation_ids[row]
+        for donation_id in self._overlay:
+            if donation_id not in self._replaced:
+                yield donation_id
+
+    def _snapshot_row(self, donation_id, default=None):
+        try:
+            encoded_id = _encode_id(donation_id)
+        except TypeError:
+            return default
+
+        slot = zlib.crc32(encoded_id) & self._mask
+        while True:
+            entry = self._row_table[slot]
+            if entry == 0:
+                return default
+            if self._donation_ids.encoded(entry - 1) == encoded_id:
+                return entry - 1
+            slot = (slot + 1) & self._mask
+
+def _encode_id(donation_id):
+    return json.dumps(donation_id).encode()
+
+def _table_size(count):
+    # a power of two, at most half full
+    size = 8
+    while size < 2 * count:
+        size *= 2
+    return size
+
+def _pad(f):
+    offset = f.tell()
+    padding = -offset % ALIGNMENT
+    f.write(bytes(padding))
+    return offset + padding
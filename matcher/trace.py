@@ -0,0 +1,287 @@
+"""
+Record the operations made on a matcher to a trace file, and replay them
+
+    python -m matcher.trace trace.bin --matcher exact --speed 1 --profile cprofile
+
+A trace holds the match funds a matcher was made with, then every reserve_funds,
+collect_donation and expire_donation call, with when it was made, how long it took
+and whether it was rejected, then the state the matcher was left in.
+"""
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.exceptions import BadRequestException
+from matcher.donation import Donation
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from matcher.money import ExactFundMatcher
+from matcher.write_ahead_log import encode_record, read_records
+import argparse
+import cProfile
+import hashlib
+import io
+import json
+import pstats
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+# Record types
+FUNDS = 1
+RESERVE = 2
+COLLECT = 3
+EXPIRE = 4
+STATE = 5
+
+# seconds since recording started, seconds the call took and whether it was rejected, then the donation amount
+CALL = struct.Struct('<ddB')
+RESERVE_CALL = struct.Struct('<ddBd')
+
+# Profilers
+CPROFILE = "cprofile"
+TRACEMALLOC = "tracemalloc"
+
+PROFILERS = (CPROFILE, TRACEMALLOC)
+
+CALL_NAMES = {RESERVE: "reserve_funds", COLLECT: "collect_donation", EXPIRE: "expire_donation"}
+
+DEFAULT_TOLERANCE = 1e-6
+
+# Matchers the command line can replay against
+MATCHERS = {
+    'float': FundMatcher,
+    'exact': ExactFundMatcher,
+    'concurrent': ConcurrentFundMatcher
+}
+
+def trace_state(fund_matcher):
+    """
+    State of a matcher as a trace records it: the fund balances and the total unmatched, in
+    major units, and a digest of every donation id with its status
+    """
+
+    # 1 in the matcher's units, so that float and minor unit matchers can be compared
+    scale = fund_matcher._amount(1)
+    state = fund_matcher.allocation_state
+
+    digest = hashlib.sha1()
+    for donation_id in state:
+        digest.update(json.dumps([donation_id, state.status(state.row(donation_id))]).encode())
+
+    return {
+        'balances': {mf.match_fund_id: float(mf.total_amount) / scale for mf in fund_matcher.get_match_funds_as_list()},
+        'unmatched': float(sum(state.unmatched(row) for row in state.iter_rows())) / scale,
+        'donations': len(state),
+        'digest': digest.hexdigest()
+    }
+
+def compare_states(expected, actual, tolerance=DEFAULT_TOLERANCE):
+    """
+    Differences between two trace states, as a list of messages
+    """
+
+    differences = []
+    if expected['digest'] != actual['digest'] or expected['donations'] != actual['donations']:
+        differences.append("Donation statuses differ, %s donations recorded and %s replayed" % (
+            expected['donations'], actual['donations']))
+    for match_fund_id, balance in expected['balances'].items():
+        replayed = actual['balances'].get(match_fund_id)
+        if replayed is None or abs(replayed - balance) > tolerance:
+            differences.append("Match fund %s balance %s recorded and %s replayed" % (match_fund_id, balance, replayed))
+    if abs(expected['unmatched'] - actual['unmatched']) > tolerance * max(expected['donations'], 1):
+        differences.append("Unmatched total %s recorded and %s replayed" % (expected['unmatched'], actual['unmatched']))
+    return differences
+
+class RecordingFundMatcher(object):
+    """
+    Front-end to a new matcher that records its reservations, collections and expiries to a trace file
+    Recording is opt-in: a matcher that is not wrapped pays nothing. The match funds are
+    recorded when the matcher is wrapped, so it must not have reserved anything yet;
+    close() records the state the matcher was left in and closes the file. Every other
+    attribute is passed through, unrecorded, so a matcher changed in any other way will
+    not replay to the state it was left in. Calls from many threads are recorded in the
+    order they return, which under contention need not be the order they were applied in.
+    """
+
+    def __init__(self, fund_matcher, path):
+        if len(fund_matcher.allocation_state):
+            raise BadRequestException("A trace must start from a matcher with no reservations")
+
+        self.fund_matcher = fund_matcher
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+
+        scale = fund_matcher._amount(1)
+        self._file.write(encode_record(FUNDS, json.dumps([
+            [mf.match_fund_id, float(mf.total_amount) / scale, mf.match_order, list(mf.matching_ratio)]
+            for mf in fund_matcher.get_match_funds_as_list()
+        ]).encode()))
+        self._started = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self.fund_matcher, name)
+
+    def reserve_funds(self, donation):
+        return self._timed(RESERVE, self.fund_matcher.reserve_funds, donation, donation.donation_id, donation.amount)
+
+    def collect_donation(self, donation_id):
+        self._timed(COLLECT, self.fund_matcher.collect_donation, donation_id, donation_id)
+
+    def expire_donation(self, donation_id):
+        self._timed(EXPIRE, self.fund_matcher.expire_donation, donation_id, donation_id)
+
+    def close(self):
+        with self._lock:
+            self._file.write(encode_record(STATE, json.dumps(trace_state(self.fund_matcher)).encode()))
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _timed(self, record_type, method, argument, donation_id, amount=None):
+        start = time.perf_counter()
+        rejected = 0
+        try:
+            return method(argument)
+        except BadRequestException:
+            rejected = 1
+            raise
+        finally:
+            at, duration = start - self._started, time.perf_counter() - start
+            call = CALL.pack(at, duration, rejected) if amount is None else RESERVE_CALL.pack(at, duration, rejected, amount)
+            with self._lock:
+                self._file.write(encode_record(record_type, call + json.dumps(donation_id).encode()))
+
+def read_trace(path):
+    """
+    Read a trace file
+    Returns the match funds, a list of (record type, seconds since recording started,
+    seconds taken, rejected, donation id, amount or None) and the recorded state, or
+    None for a trace cut off before it was closed
+    """
+
+    records, _ = read_records(path)
+    if not records or records[0][0] != FUNDS:
+        raise BadRequestException("Trace %s does not start with match funds" % path)
+
+    match_funds = [MatchFund(*fund_data) for fund_data in json.loads(records[0][1])]
+    calls = []
+    state = None
+    for record_type, payload in records[1:]:
+        if record_type == RESERVE:
+            at, duration, rejected, amount = RESERVE_CALL.unpack_from(payload)
+            calls.append((RESERVE, at, duration, bool(rejected), json.loads(payload[RESERVE_CALL.size:]), amount))
+        elif record_type in (COLLECT, EXPIRE):
+            at, duration, rejected = CALL.unpack_from(payload)
+            calls.append((record_type, at, duration, bool(rejected), json.loads(payload[CALL.size:]), None))
+        elif record_type == STATE:
+            state = json.loads(payload)
+        else:
+            raise BadRequestException("Unknown trace record type %s" % record_type)
+
+    return match_funds, calls, state
+
+def replay(path, matcher_factory=FundMatcher, speed=None, profile=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Replay a trace against a new matcher, made by calling matcher_factory with the match funds
+    With speed None the calls are made back to back; otherwise each waits for its
+    recorded time divided by speed, so speed 1 keeps the original pace. A call is
+    expected to be rejected if, and only if, it was when recorded. The state the matcher
+    is left in is compared with the recorded one, balances to within tolerance, in major
+    units. profile is cprofile or tracemalloc, to report on the replay.
+    Returns a dict of the replay: the calls made, seconds taken and recorded, the
+    matcher, the mismatches found and the profile report, if any
+    """
+
+    if profile is not None and profile not in PROFILERS:
+        raise BadRequestException("Invalid profiler %s" % profile)
+
+    match_funds, calls, recorded_state = read_trace(path)
+    fund_matcher = matcher_factory(match_funds)
+    methods = {COLLECT: fund_matcher.collect_donation, EXPIRE: fund_matcher.expire_donation}
+
+    mismatches = []
+    profiler = cProfile.Profile() if profile == CPROFILE else None
+    if profile == TRACEMALLOC:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+
+    started = time.perf_counter()
+    for ix, (record_type, at, _, rejected, donation_id, amount) in enumerate(calls):
+        if speed is not None:
+            wait = started + at / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        try:
+            if record_type == RESERVE:
+                fund_matcher.reserve_funds(Donation(donation_id, amount))
+            else:
+                methods[record_type](donation_id)
+            replayed_rejected = False
+        except BadRequestException:
+            replayed_rejected = True
+        if replayed_rejected != rejected:
+            mismatches.append("Call %d, %s of %s, was %s when recorded" % (
+                ix, CALL_NAMES[record_type], donation_id, "rejected" if rejected else "accepted"))
+    elapsed = time.perf_counter() - started
+
+    if profiler is not None:
+        profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(25)
+        profile_report = report.getvalue()
+    elif profile == TRACEMALLOC:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profile_report = "peak %.1f KiB\n" % (peak / 1024) + \
+            "\n".join(str(statistic) for statistic in snapshot.statistics("lineno")[:25])
+    else:
+        profile_report = None
+
+    if recorded_state is None:
+        mismatches.append("Trace was not closed, so has no recorded state")
+    else:
+        mismatches.extend(compare_states(recorded_state, trace_state(fund_matcher), tolerance))
+
+    return {
+        'calls': len(calls),
+        'elapsed': elapsed,
+        'recorded_elapsed': calls[-1][1] + calls[-1][2] if calls else 0.0,
+        'fund_matcher': fund_matcher,
+        'mismatches': mismatches,
+        'profile': profile_report
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m matcher.trace", description="Replay a trace against a matcher")
+    parser.add_argument("trace", help="trace file")
+    parser.add_argument("--matcher", choices=sorted(MATCHERS), default="float")
+    parser.add_argument("--speed", type=float, help="replay at this multiple of the original pace, rather than flat out")
+    parser.add_argument("--profile", choices=PROFILERS)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="largest difference in a fund balance to accept, in major units")
+    args = parser.parse_args(argv)
+
+    try:
+        result = replay(args.trace, MATCHERS[args.matcher], args.speed, args.profile, args.tolerance)
+    except (BadRequestException, OSError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 2
+
+    if result['profile'] is not None:
+        print(result['profile'])
+    for mismatch in result['mismatches']:
+        print("mismatch: %s" % mismatch)
+    print("%d calls in %.3fs, recorded in %.3fs, %s" % (
+        result['calls'], result['elapsed'], result['recorded_elapsed'],
+        "state matches" if not result['mismatches'] else "%d mismatches" % len(result['mismatches'])))
+    return 1 if result['mismatches'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
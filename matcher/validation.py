@@ -0,0 +1,189 @@
+from matcher.donation import MIN_DONATION, MAX_DONATION
+from matcher.exceptions import BadRequestException
+from matcher.match_fund import MatchFund
+import numpy as np
+
+# Per-row error codes of the batch validators; VALID rows have none
+VALID = 0
+INVALID_AMOUNT = 1          # not a number, or not finite
+AMOUNT_TOO_SMALL = 2
+AMOUNT_TOO_HIGH = 3
+NEGATIVE_TOTAL_AMOUNT = 4
+INVALID_MATCH_ORDER = 5
+INVALID_MATCH_RATIO = 6     # not a pair of positive numbers
+
+ERROR_MESSAGES = {
+    INVALID_AMOUNT: "Amount cannot be expressed as a float",
+    AMOUNT_TOO_SMALL: "Donation amount is too small",
+    AMOUNT_TOO_HIGH: "Donation amount is too high",
+    NEGATIVE_TOTAL_AMOUNT: "Total amount cannot be negative",
+    INVALID_MATCH_ORDER: "Match order must be an integer",
+    INVALID_MATCH_RATIO: "Match ratio must be a pair of positive numbers"
+}
+
+# Character classes of latin-1 code points, for reading text columns without a Python loop
+OTHER = 0
+DIGIT = 1
+POINT = 2
+SIGN = 3
+EXPONENT = 4
+BLANK = 5
+
+CHARACTER_CLASSES = np.zeros(256, dtype=np.int8)
+for _characters, _class in ((b'0123456789', DIGIT), (b'.', POINT), (b'+-', SIGN), (b'eE', EXPONENT), (b' \t\x00', BLANK)):
+    CHARACTER_CLASSES[np.frombuffer(_characters, dtype=np.uint8)] = _class
+
+POWERS_OF_TEN = 10.0 ** np.arange(16)
+
+def parse_floats(values):
+    """
+    Column of values as a float64 array, with NaN where a value is not a finite number
+    Numeric columns are converted in one step. Text columns are read off their code
+    points, one column of characters at a time across every row, so plain decimals
+    never go through float() and bad rows raise no exceptions; only rarer forms such
+    as exponents are handed to float() one by one.
+    """
+
+    values = np.asarray(values)
+
+    if values.dtype.kind in 'fiu':
+        floats = values.astype(np.float64)
+    elif values.dtype.kind == 'O':
+        # mixed columns, eg numbers and None from NDJSON: numbers are taken as they are
+        floats = np.full(len(values), np.nan)
+        numeric = np.fromiter((isinstance(value, (int, float)) and not isinstance(value, bool) for value in values),
+                              dtype=bool, count=len(values))
+        floats[numeric] = values[numeric].astype(np.float64)
+        text = np.fromiter((isinstance(value, str) for value in values), dtype=bool, count=len(values))
+        if text.any():
+            floats[text] = parse_floats(values[text].astype(str))
+    else:
+        floats = _parse_text(values.astype(str))
+
+    floats[~np.isfinite(floats)] = np.nan
+    return floats
+
+def _parse_text(values):
+    floats = np.full(len(values), np.nan)
+    width = values.itemsize // 4
+    if not width:
+        return floats
+
+    # character classes of the code points, with anything outside latin-1 folded onto one no number has
+    characters = np.minimum(np.ascontiguousarray(values).view(np.uint32).reshape(len(values), width), 255)
+    classes = CHARACTER_CLASSES[characters]
+
+    # read plain decimals, [sign] digits [. digits], one column at a time across every row
+    mantissa = np.zeros(len(values), dtype=np.int64)
+    decimals = np.zeros(len(values), dtype=np.int64)
+    digit_count = np.zeros(len(values), dtype=np.int64)
+    started = np.zeros(len(values), dtype=bool)
+    ended = np.zeros(len(values), dtype=bool)
+    pointed = np.zeros(len(values), dtype=bool)
+    negative = np.zeros(len(values), dtype=bool)
+    malformed = np.zeros(len(values), dtype=bool)
+    other = np.zeros(len(values), dtype=bool)
+    exponent = np.zeros(len(values), dtype=bool)
+
+    for column in range(width):
+        column_class = classes[:, column]
+        blank = column_class == BLANK
+        digit = column_class == DIGIT
+        point = column_class == POINT
+        sign = column_class == SIGN
+
+        ended |= blank & started
+        malformed |= ~blank & ended
+        malformed |= (sign & started) | (point & pointed)
+        other |= column_class == OTHER
+        exponent |= column_class == EXPONENT
+
+        mantissa = np.where(digit, mantissa * 10 + (characters[:, column] - ord('0')), mantissa)
+        decimals += digit & pointed
+        digit_count += digit
+        negative |= sign & (characters[:, column] == ord('-'))
+        pointed |= point
+        started |= ~blank
+
+    # up to 15 digits the mantissa and the power of ten are exact, so dividing rounds once, as float() does
+    numeric = ~other & (digit_count > 0)
+    plain = numeric & ~malformed & ~exponent & (digit_count <= 15)
+    plain_floats = mantissa[plain] / POWERS_OF_TEN[decimals[plain]]
+    plain_floats[negative[plain]] *= -1
+    floats[plain] = plain_floats
+
+    # anything else made of the right characters, such as exponents, goes through float()
+    rest = numeric & ~plain
+    if rest.any():
+        floats[rest] = [_float_or_nan(value) for value in values[rest].tolist()]
+    return floats
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+def validate_donations(amounts):
+    """
+    Validate a column of donation amounts at once, as Donation does one at a time
+    Returns the amounts as a float64 array, a mask of the valid rows and an int8 array
+    of per-row error codes
+    """
+
+    amounts = parse_floats(amounts)
+
+    codes = np.zeros(len(amounts), dtype=np.int8)
+    codes[amounts > MAX_DONATION] = AMOUNT_TOO_HIGH
+    codes[amounts < MIN_DONATION] = AMOUNT_TOO_SMALL
+    codes[np.isnan(amounts)] = INVALID_AMOUNT
+
+    return amounts, codes == VALID, codes
+
+def validate_match_funds(total_amounts, match_orders, match_ratios):
+    """
+    Validate columns of match fund fields at once
+    match_ratios is a column of [lhs, rhs] pairs or of "lhs:rhs" strings.
+    Returns the total amounts, match orders and (n, 2) ratios as arrays, a mask of the
+    valid rows and an int8 array of per-row error codes
+    """
+
+    total_amounts = parse_floats(total_amounts)
+    orders = parse_floats(match_orders)
+
+    # funds are few, so ratios are split into pairs row by row; the sides are parsed as columns
+    pairs = [ratio.split(':') if isinstance(ratio, str) else ratio for ratio in match_ratios]
+    well_formed = np.fromiter((np.ndim(pair) == 1 and len(pair) == 2 for pair in pairs), dtype=bool, count=len(pairs))
+    ratios = np.full((len(pairs), 2), np.nan)
+    if well_formed.any():
+        sides = np.asarray([pair for pair, ok in zip(pairs, well_formed) if ok], dtype=object)
+        ratios[well_formed] = np.column_stack([parse_floats(sides[:, 0]), parse_floats(sides[:, 1])])
+
+    if not len(total_amounts) == len(orders) == len(ratios):
+        raise BadRequestException("Match fund columns differ in length")
+
+    codes = np.zeros(len(total_amounts), dtype=np.int8)
+    codes[~(ratios > 0).all(axis=1)] = INVALID_MATCH_RATIO
+    codes[np.isnan(orders) | (orders != np.floor(orders))] = INVALID_MATCH_ORDER
+    codes[total_amounts < 0] = NEGATIVE_TOTAL_AMOUNT
+    codes[np.isnan(total_amounts)] = INVALID_AMOUNT
+
+    return total_amounts, orders, ratios, codes == VALID, codes
+
+def match_funds_from_columns(match_fund_ids, total_amounts, match_orders, match_ratios):
+    """
+    MatchFunds of the valid rows of match fund columns
+    Funds are few, so unlike donations each valid one is built as a MatchFund for the matcher.
+    Returns the match funds, the mask of valid rows and the per-row error codes
+    """
+
+    total_amounts, orders, ratios, valid, codes = validate_match_funds(total_amounts, match_orders, match_ratios)
+
+    match_funds = [MatchFund(match_fund_id, total_amount, int(order), [_as_number(lhs), _as_number(rhs)])
+                   for match_fund_id, total_amount, order, (lhs, rhs)
+                   in zip(np.asarray(match_fund_ids, dtype=object)[valid].tolist(), total_amounts[valid].tolist(),
+                          orders[valid].tolist(), ratios[valid].tolist())]
+    return match_funds, valid, codes
+
+def _as_number(value):
+    return int(value) if value.is_integer() else value
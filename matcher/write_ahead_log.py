@@ -0,0 +1,465 @@
+from matcher.allocation import COLLECTED, EXPIRED
+from matcher.allocation_state import to_timestamp, from_timestamp
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import FundMatcher
+from matcher.match_fund import MatchFund
+from matcher.snapshot import read_snapshot, write_snapshot
+from datetime import datetime
+import json
+import os
+import struct
+import threading
+import zlib
+
+# Durability levels
+SYNC = "sync"    # write and fsync every operation before it returns
+GROUP = "group"  # operations wait for an fsync that is shared by every operation queued with them
+ASYNC = "async"  # operations return once buffered; a background thread fsyncs every flush_interval
+
+DURABILITY_LEVELS = (SYNC, GROUP, ASYNC)
+
+DEFAULT_FLUSH_INTERVAL = 0.01
+
+# Record types
+FUNDS = 1
+RESERVE = 2
+COLLECT = 3
+EXPIRE = 4
+CHECKPOINT = 5
+COLLECT_MANY = 6
+EXPIRE_MANY = 7
+ADD_FUND = 8
+TOP_UP = 9
+RETIRE_FUND = 10
+REORDER_FUND = 11
+ARCHIVE = 12
+START_SEQUENCE = 13
+
+# length and crc32 of the payload, then the record type
+RECORD_HEADER = struct.Struct('<IIB')
+TIMESTAMP = struct.Struct('<q')
+TIMESTAMP_AMOUNT = struct.Struct('<qd')
+SEQUENCE = struct.Struct('<q')
+
+def encode_record(record_type, payload):
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload), record_type) + payload
+
+def encode_funds(match_funds):
+    return encode_record(FUNDS, json.dumps([
+        [mf.match_fund_id, mf.total_amount, mf.match_order, list(mf.matching_ratio)] for mf in match_funds
+    ]).encode())
+
+def encode_fund_change(record_type, *arguments):
+    return encode_record(record_type, json.dumps(arguments).encode())
+
+def encode_checkpoint(generation):
+    return encode_record(CHECKPOINT, json.dumps({'generation': generation}).encode())
+
+def encode_reserve(donation_id, amount, now):
+    return encode_record(RESERVE, TIMESTAMP_AMOUNT.pack(to_timestamp(now), amount) + json.dumps(donation_id).encode())
+
+def encode_status(record_type, donation_id, now):
+    return encode_record(record_type, TIMESTAMP.pack(to_timestamp(now)) + json.dumps(donation_id).encode())
+
+def encode_statuses(record_type, donation_ids, now):
+    return encode_record(record_type, TIMESTAMP.pack(to_timestamp(now)) + json.dumps(donation_ids).encode())
+
+def read_records(path):
+    """
+    Read the records of a log, stopping at the first torn or corrupt record
+    Returns a list of (record type, payload) and the length of the valid prefix of the file
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    records = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc, record_type = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        records.append((record_type, payload))
+        offset = start + length
+
+    return records, offset
+
+class WriteAheadLog(object):
+    """
+    Append-only log file with a choice of durability level
+    append() buffers an encoded record and returns its log sequence number; commit()
+    returns once that record is durable, as far as the durability level promises.
+    With GROUP durability, the first committer to find no flush in progress becomes the
+    leader: it writes and fsyncs everything buffered so far, for every waiting committer,
+    while records appended in the meantime queue up for the next flush.
+    """
+
+    def __init__(self, path, durability=GROUP, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        if durability not in DURABILITY_LEVELS:
+            raise BadRequestException("Invalid durability level %s" % durability)
+
+        self.path = path
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.fsync_count = 0
+
+        self._file = open(path, 'ab')
+        self._buffer = bytearray()
+        self._appended_lsn = 0
+        self._durable_lsn = 0
+        self._flushing = False
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._flusher = None
+        if durability == ASYNC:
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+
+    def append(self, data):
+        with self._condition:
+            self._buffer += data
+            self._appended_lsn += 1
+            lsn = self._appended_lsn
+
+            if self.durability == SYNC:
+                self._write(self._take_buffer())
+                self._durable_lsn = lsn
+
+        return lsn
+
+    def commit(self, lsn):
+        if self.durability != GROUP:
+            return
+
+        with self._condition:
+            while self._durable_lsn < lsn:
+                if self._flushing:
+                    self._condition.wait()
+                    continue
+                self._flush_locked()
+
+    def flush(self):
+        """
+        Write and fsync everything appended so far
+        """
+
+        with self._condition:
+            while self._flushing:
+                self._condition.wait()
+            self._flush_locked()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self._file.close()
+
+    def _flush_locked(self):
+        # called holding the condition; releases it for the duration of the write
+        if not self._buffer:
+            self._durable_lsn = self._appended_lsn
+            return
+
+        self._flushing = True
+        target_lsn = self._appended_lsn
+        data = self._take_buffer()
+
+        self._condition.release()
+        try:
+            self._write(data)
+        finally:
+            self._condition.acquire()
+            self._flushing = False
+
+        self._durable_lsn = max(self._durable_lsn, target_lsn)
+        self._condition.notify_all()
+
+    def _take_buffer(self):
+        data, self._buffer = self._buffer, bytearray()
+        return data
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.fsync_count += 1
+
+    def _flush_periodically(self):
+        while not self._closed:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed, timeout=self.flush_interval)
+                if not self._flushing:
+                    self._flush_locked()
+
+class DurableFundMatcher(FundMatcher):
+    """
+    FundMatcher that records every reservation, collection and expiry in a write-ahead log
+    When the log already holds records, the match funds are read from its first record
+    and every operation is replayed, with its original timestamp, to rebuild the match
+    fund balances and allocation state exactly. A torn record at the end of the log,
+    left by a crash mid-write, is cut off. Otherwise match_funds starts a new log.
+    With a snapshot_path, checkpoint() writes a snapshot and starts the log afresh, so
+    recovery opens the snapshot and only replays the operations since the checkpoint.
+    Snapshots and logs carry a generation number; a log left one generation behind by a
+    crash mid-checkpoint is already contained in the snapshot and is discarded.
+    Operations are applied and appended to the log under one lock, so the log order is
+    the order they were applied in, and wait for durability after letting go of it.
+    A matcher that archives settled donations is given its archive up front. Recovery
+    replays the log as it was written, before the donations were archived, and moves
+    them to the archive again at the same points. A new log over an archive that already
+    holds donations records the reservation sequence it starts from, after theirs.
+    With backfill, see FundMatcher.enable_backfill, the backfilled allocations follow
+    from the logged operations and are not logged themselves; a log must be recovered
+    with the backfill setting it was written with.
+    """
+
+    def __init__(self, path, match_funds=None, durability=GROUP, flush_interval=DEFAULT_FLUSH_INTERVAL, snapshot_path=None,
+                 archive=None, backfill=False):
+        records, valid_length = read_records(path) if os.path.exists(path) else ([], 0)
+
+        self.snapshot_path = snapshot_path
+        self.generation = 0
+
+        log_generation = None
+        if records:
+            record_type, payload = records[0]
+            if record_type == FUNDS:
+                log_generation = 0
+            elif record_type == CHECKPOINT:
+                log_generation = json.loads(payload)['generation']
+            else:
+                raise BadRequestException("Write-ahead log %s does not start with match funds or a checkpoint" % path)
+
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            snapshot_funds, allocation_state, metadata = read_snapshot(snapshot_path)
+            super().__init__(snapshot_funds)
+            self.allocation_state = allocation_state
+            self.generation = metadata['generation']
+            for match_fund_id in metadata.get('retired_fund_ids', []):
+                self._mark_retired(match_fund_id)
+            if backfill:
+                self.enable_backfill()
+
+            if log_generation == self.generation:
+                self._replay(records[1:], archive)
+                _truncate(path, valid_length)
+            elif log_generation is None or log_generation == self.generation - 1:
+                # the checkpoint was written but the log was not restarted
+                _restart_log(path, encode_checkpoint(self.generation))
+            else:
+                raise BadRequestException("Write-ahead log %s does not follow snapshot %s" % (path, snapshot_path))
+        elif log_generation == 0:
+            super().__init__([MatchFund(*fund_data) for fund_data in json.loads(records[0][1])])
+            if backfill:
+                self.enable_backfill()
+            self._replay(records[1:], archive)
+
+            # drop a torn tail before appending to the log again
+            _truncate(path, valid_length)
+        elif log_generation is not None:
+            raise BadRequestException("Write-ahead log %s needs its snapshot to recover" % path)
+        else:
+            if match_funds is None:
+                raise BadRequestException("Match funds are required to start write-ahead log %s" % path)
+            super().__init__(match_funds)
+            if backfill:
+                self.enable_backfill()
+            first_records = encode_funds(self.get_match_funds_as_list())
+            if archive is not None:
+                # reservations are numbered on from the archive's, as it stands now (see FundMatcher.archive)
+                self.allocation_state.next_sequence = archive.next_sequence()
+                first_records += encode_record(START_SEQUENCE, SEQUENCE.pack(self.allocation_state.next_sequence))
+            _restart_log(path, first_records)
+
+        self.archive = archive
+        self.log = WriteAheadLog(path, durability, flush_interval)
+        self._lock = threading.Lock()
+
+    def checkpoint(self):
+        """
+        Write a snapshot of the matcher and restart the log from it
+        """
+
+        if self.snapshot_path is None:
+            raise BadRequestException("Checkpoints need a snapshot_path")
+
+        with self._lock:
+            self.log.close()
+            write_snapshot(self, self.snapshot_path, generation=self.generation + 1)
+            self.generation += 1
+            _restart_log(self.log.path, encode_checkpoint(self.generation))
+            self.log = WriteAheadLog(self.log.path, self.log.durability, self.log.flush_interval)
+
+    def reserve_funds(self, donation):
+        # a retry changes nothing, so only the first reservation of a donation id is logged
+        with self._lock:
+            now = datetime.now()
+            replayed = self.donation_status(donation.donation_id) is not None
+            allocation_state_doc = self._reserve(donation.donation_id, donation.amount, now)
+            if replayed:
+                return allocation_state_doc
+            log, lsn = self._append(encode_reserve(donation.donation_id, donation.amount, now))
+        log.commit(lsn)
+        return allocation_state_doc
+
+    def _reserve_columns(self, donation_ids, amounts):
+        with self._lock:
+            now = datetime.now()
+            records = []
+            seen = set()
+            for donation_id, amount in zip(donation_ids, amounts):
+                if donation_id not in seen and self.donation_status(donation_id) is None:
+                    records.append(encode_reserve(donation_id, amount, now))
+                seen.add(donation_id)
+            allocation_state_docs = self._reserve_batch(donation_ids, amounts, now)
+            log, lsn = self._append(b''.join(records))
+        log.commit(lsn)
+        return allocation_state_docs
+
+    def collect_donation(self, donation_id):
+        with self._lock:
+            now = datetime.now()
+            self._collect(donation_id, now)
+            log, lsn = self._append(encode_status(COLLECT, donation_id, now))
+        log.commit(lsn)
+
+    def expire_donation(self, donation_id):
+        with self._lock:
+            now = datetime.now()
+            self._expire(donation_id, now)
+            log, lsn = self._append(encode_status(EXPIRE, donation_id, now))
+        log.commit(lsn)
+
+    def collect_donations(self, donation_ids, atomic=True):
+        """
+        Collect many donations, logging the ones collected as a single record
+        """
+
+        return self._apply_many(COLLECT_MANY, self._collect_many, COLLECTED, list(donation_ids), atomic)
+
+    def expire_donations(self, donation_ids, atomic=True):
+        return self._apply_many(EXPIRE_MANY, self._expire_many, EXPIRED, list(donation_ids), atomic)
+
+    def _apply_many(self, record_type, apply_many, status, donation_ids, atomic):
+        with self._lock:
+            now = datetime.now()
+            outcomes = apply_many(donation_ids, now, atomic)
+            applied = [donation_id for donation_id, outcome in zip(donation_ids, outcomes) if outcome is status]
+            if not applied:
+                return outcomes
+            log, lsn = self._append(encode_statuses(record_type, applied, now))
+        log.commit(lsn)
+        return outcomes
+
+    def add_match_fund(self, match_fund):
+        with self._lock:
+            # taken first: with backfill, the fund is drawn from as it is added
+            record = encode_fund_change(ADD_FUND, match_fund.match_fund_id, match_fund.total_amount,
+                                        match_fund.match_order, list(match_fund.matching_ratio))
+            super().add_match_fund(match_fund)
+            log, lsn = self._append(record)
+        log.commit(lsn)
+
+    def top_up(self, match_fund_id, amount):
+        with self._lock:
+            super().top_up(match_fund_id, amount)
+            log, lsn = self._append(encode_fund_change(TOP_UP, match_fund_id, amount))
+        log.commit(lsn)
+
+    def retire_match_fund(self, match_fund_id):
+        with self._lock:
+            balance = super().retire_match_fund(match_fund_id)
+            log, lsn = self._append(encode_fund_change(RETIRE_FUND, match_fund_id))
+        log.commit(lsn)
+        return balance
+
+    def reorder_match_fund(self, match_fund_id, match_order):
+        with self._lock:
+            super().reorder_match_fund(match_fund_id, match_order)
+            log, lsn = self._append(encode_fund_change(REORDER_FUND, match_fund_id, match_order))
+        log.commit(lsn)
+
+    def archive_settled(self, min_age):
+        """
+        Archive settled donations, logging the cut-off so that recovery archives the same ones
+        The archive is written before the log record; a crash in between leaves the
+        donations in both, which is harmless, until the next archive_settled.
+        """
+
+        if self.archive is None:
+            raise BadRequestException("Archiving settled donations needs an archive")
+
+        with self._lock:
+            before_timestamp = to_timestamp(datetime.now() - min_age)
+            archived = self._archive_settled(self.archive, before_timestamp)
+            log, lsn = self._append(encode_record(ARCHIVE, TIMESTAMP.pack(before_timestamp)))
+        log.commit(lsn)
+        return archived
+
+    def close(self):
+        self.log.close()
+
+    def _append(self, data):
+        # called holding the lock; the commit must go to this same log, which a checkpoint may replace meanwhile
+        log = self.log
+        return log, log.append(data)
+
+    def _replay(self, records, archive=None):
+        # the archive is left out until the end, so that donations archived later are found in memory
+        for record_type, payload in records:
+            if record_type == RESERVE:
+                timestamp, amount = TIMESTAMP_AMOUNT.unpack_from(payload)
+                donation_id = json.loads(payload[TIMESTAMP_AMOUNT.size:])
+                self._reserve(donation_id, amount, from_timestamp(timestamp))
+            elif record_type in (COLLECT, EXPIRE):
+                timestamp, = TIMESTAMP.unpack_from(payload)
+                donation_id = json.loads(payload[TIMESTAMP.size:])
+                if record_type == COLLECT:
+                    self._collect(donation_id, from_timestamp(timestamp))
+                else:
+                    self._expire(donation_id, from_timestamp(timestamp))
+            elif record_type in (COLLECT_MANY, EXPIRE_MANY):
+                timestamp, = TIMESTAMP.unpack_from(payload)
+                donation_ids = json.loads(payload[TIMESTAMP.size:])
+                if record_type == COLLECT_MANY:
+                    self._collect_many(donation_ids, from_timestamp(timestamp), True)
+                else:
+                    self._expire_many(donation_ids, from_timestamp(timestamp), True)
+            elif record_type == ADD_FUND:
+                FundMatcher.add_match_fund(self, MatchFund(*json.loads(payload)))
+            elif record_type == TOP_UP:
+                FundMatcher.top_up(self, *json.loads(payload))
+            elif record_type == RETIRE_FUND:
+                FundMatcher.retire_match_fund(self, *json.loads(payload))
+            elif record_type == REORDER_FUND:
+                FundMatcher.reorder_match_fund(self, *json.loads(payload))
+            elif record_type == START_SEQUENCE:
+                self.allocation_state.next_sequence, = SEQUENCE.unpack(payload)
+            elif record_type == ARCHIVE:
+                if archive is None:
+                    raise BadRequestException("Write-ahead log archives settled donations; recovery needs the archive")
+                self._archive_settled(archive, *TIMESTAMP.unpack(payload))
+            else:
+                raise BadRequestException("Unknown write-ahead log record type %s" % record_type)
+
+def _truncate(path, length):
+    with open(path, 'r+b') as f:
+        f.truncate(length)
+
+def _restart_log(path, first_records):
+    """
+    Atomically replace a log with one holding only its first records
+    """
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(first_records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
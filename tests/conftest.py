@@ -0,0 +1,75 @@
+from matcher.match_fund import MatchFund
+
+import pytest
+
+@pytest.fixture
+def simple_match_funds():
+    """
+    fixture simple fund array without ratios (as default)
+    """
+
+    example_funds_data = [[
+        "fund_1",  # id
+        100.00,  # amount
+        3,  # order
+    ], [
+        "fund_2",
+        100.00,
+        7
+    ], [
+        "fund_3",
+        100.00,
+        1,
+    ]
+    ]
+    return [MatchFund(*ef) for ef in example_funds_data]
+
+@pytest.fixture
+def match_funds_with_ratios():
+    """
+    fixture fund arrays with ratios
+    """
+
+    example_funds_data = [[
+        "fund_1",  # id
+        100.00,  # amount
+        3,  # order
+        [1, 1]  # ratio
+    ], [
+        "fund_2",
+        100.00,
+        7,
+        [2, 1]
+    ], [
+        "fund_3",
+        100.00,
+        1,
+        [1, 1]
+    ]
+    ]
+    return [MatchFund(*ef) for ef in example_funds_data]
+
+@pytest.fixture
+def more_match_funds_with_ratios():
+    """
+    additional fixture fund arrays with ratios
+    """
+
+    example_funds_data = [[
+        "fund_1",  # id
+        100.00,  # amount
+        3,  # order
+        [2, 1]  # ratio
+    ], [
+        "fund_2",
+        100.00,
+        7,
+        [3, 1]
+    ], [
+        "fund_3",
+        100.00,
+        1,
+        [2, 1]
+    ]
+    ]
+    return [MatchFund(*ef) for ef in example_funds_data]
@@ -0,0 +1,194 @@
+from matcher.allocation import Allocation, RESERVED, COLLECTED, EXPIRED
+from matcher.allocation_state import AllocationState, to_timestamp
+from datetime import datetime
+import pytest
+
+@pytest.fixture
+def allocation_state():
+    """
+    fixture allocation state with a fully matched, a partially matched and an unmatched donation
+    """
+
+    state = AllocationState()
+    created_time = datetime(2021, 3, 1, 12, 30, 15, 123456)
+
+    state.add("donation_1", 50.0, 0, [("fund_3", 50.0)], created_time)
+    state.add("donation_2", 250.0, 50.0, [("fund_1", 100.0), ("fund_2", 100.0)], created_time)
+    state.add("donation_3", 20.0, 20.0, [], created_time)
+
+    return state
+
+@pytest.mark.order(401)
+def test_allocation_state_records(allocation_state):
+    """
+    test records expose the allocation state keys
+    test timestamps round trip exactly
+    test allocations are Allocation views in the order they were made
+    """
+
+    assert len(allocation_state) == 3
+    assert list(allocation_state) == ["donation_1", "donation_2", "donation_3"]
+    assert "donation_2" in allocation_state
+    assert "donation_4" not in allocation_state
+
+    record = allocation_state["donation_2"]
+
+    assert record['original_donation'] == 250
+    assert record['donation_balance_unmatched'] == 50
+    assert record['overall_status'] == RESERVED
+    assert record['created_time'] == datetime(2021, 3, 1, 12, 30, 15, 123456)
+
+    allocations = record['allocations']
+
+    assert all(isinstance(a, Allocation) for a in allocations)
+    assert [a.to_dict() for a in allocations] == [
+        {"match_fund_id": "fund_1", "match_fund_allocation": 100, "status": RESERVED},
+        {"match_fund_id": "fund_2", "match_fund_allocation": 100, "status": RESERVED}
+    ]
+    assert allocation_state["donation_3"]['allocations'] == []
+
+@pytest.mark.order(402)
+def test_allocation_state_set_status(allocation_state):
+    """
+    test setting a donation status updates every allocation and the updated time
+    """
+
+    row = allocation_state.row("donation_2")
+    updated_time = datetime(2021, 3, 2, 9, 0, 0)
+
+    allocation_state.set_status(row, COLLECTED, updated_time)
+
+    record = allocation_state["donation_2"]
+
+    assert record['overall_status'] == COLLECTED
+    assert record['updated_time'] == updated_time
+    assert all(a.status == COLLECTED for a in record['allocations'])
+    assert allocation_state["donation_1"]['overall_status'] == RESERVED
+
+@pytest.mark.order(403)
+def test_allocation_view_writes_through(allocation_state):
+    """
+    test setting the status of an Allocation view updates the state
+    """
+
+    allocation = allocation_state["donation_1"]['allocations'][0]
+    allocation.status = EXPIRED
+
+    assert allocation_state["donation_1"]['allocations'][0].status == EXPIRED
+
+    with pytest.raises(AttributeError):
+        allocation.match_fund_allocation = 10
+
+@pytest.mark.order(404)
+def test_allocation_state_to_dict(allocation_state):
+    """
+    test to_dict returns the list_match_fund_allocations document of a donation
+    """
+
+    doc = allocation_state.to_dict(allocation_state.row("donation_1"))
+
+    assert doc == {
+        'donation_id': "donation_1",
+        'allocations': [{"match_fund_id": "fund_3", "match_fund_allocation": 50, "status": RESERVED}],
+        'created_time': datetime(2021, 3, 1, 12, 30, 15, 123456),
+        'updated_time': datetime(2021, 3, 1, 12, 30, 15, 123456),
+        'original_donation': 50,
+        'donation_balance_unmatched': 0,
+        'overall_status': RESERVED
+    }
+
+@pytest.mark.order(405)
+def test_allocation_state_iter_rows(allocation_state):
+    """
+    test expired rows leave the live index and non reserved rows leave the reserved index
+    test a new row joins both indexes
+    """
+
+    allocation_state.set_status(allocation_state.row("donation_1"), EXPIRED, datetime.now())
+    allocation_state.set_status(allocation_state.row("donation_2"), COLLECTED, datetime.now())
+
+    assert list(allocation_state.iter_rows()) == [1, 2]
+    assert list(allocation_state.iter_rows(reserved_only=True)) == [2]
+    assert list(allocation_state.iter_rows(after_row=1)) == [2]
+
+    allocation_state.add("donation_4", 30.0, 0, [("fund_1", 30.0)], datetime.now())
+
+    assert list(allocation_state.iter_rows()) == [1, 2, 3]
+    assert list(allocation_state.iter_rows(reserved_only=True)) == [2, 3]
+    assert len(allocation_state) == 4
+
+@pytest.mark.order(406)
+def test_allocation_state_fund_index(allocation_state):
+    """
+    test allocations are chained per fund, with the donation they belong to
+    test fund totals and counts follow status changes without a scan
+    """
+    allocation_state.add("donation_4", 30.0, 0, [("fund_1", 30.0)], datetime(2021, 3, 2))
+
+    indexes = list(allocation_state.iter_fund_allocation_indexes("fund_1"))
+    assert [allocation_state.donation_id(allocation_state.allocation_row(ix)) for ix in indexes] == ["donation_2", "donation_4"]
+    assert [allocation_state.allocation_amount(ix) for ix in indexes] == [100.0, 30.0]
+    assert list(allocation_state.iter_fund_allocation_indexes("no_such_fund")) == []
+
+    assert allocation_state.fund_totals("fund_1") == (
+        {RESERVED: 130.0, COLLECTED: 0, EXPIRED: 0}, {RESERVED: 2, COLLECTED: 0, EXPIRED: 0})
+
+    allocation_state.set_status(allocation_state.row("donation_2"), COLLECTED, datetime(2021, 3, 3))
+    allocation_state.set_status(allocation_state.row("donation_4"), EXPIRED, datetime(2021, 3, 3))
+
+    assert allocation_state.fund_totals("fund_1") == (
+        {RESERVED: 0, COLLECTED: 100.0, EXPIRED: 30.0}, {RESERVED: 0, COLLECTED: 1, EXPIRED: 1})
+    assert allocation_state.fund_totals("fund_2")[0][COLLECTED] == 100.0
+
+    allocation_state["donation_1"]['allocations'][0].status = COLLECTED
+    assert allocation_state.fund_totals("fund_3")[1] == {RESERVED: 0, COLLECTED: 1, EXPIRED: 0}
+    assert allocation_state.fund_totals("no_such_fund")[0] == {RESERVED: 0, COLLECTED: 0, EXPIRED: 0}
+
+@pytest.mark.order(407)
+def test_allocation_state_without(allocation_state):
+    """
+    test a state without some rows keeps the rest in order, with their statuses, indexes and fund chains
+    test the running fund totals still cover the rows left out
+    """
+    allocation_state.add("donation_4", 30.0, 0, [("fund_1", 30.0)], datetime(2021, 3, 2))
+    allocation_state.set_status(allocation_state.row("donation_1"), EXPIRED, datetime(2021, 3, 3))
+    allocation_state.set_status(allocation_state.row("donation_2"), COLLECTED, datetime(2021, 3, 3))
+    allocation_state.set_status(allocation_state.row("donation_3"), COLLECTED, datetime(2021, 3, 5))
+    totals = [allocation_state.fund_totals(match_fund_id) for match_fund_id in ("fund_1", "fund_2", "fund_3")]
+
+    settled = list(allocation_state.iter_settled_rows(to_timestamp(datetime(2021, 3, 4))))
+    assert [allocation_state.donation_id(row) for row in settled] == ["donation_1", "donation_2"]
+
+    state = allocation_state.without(settled)
+
+    assert list(state) == ["donation_3", "donation_4"]
+    assert state.version > allocation_state.version
+    for donation_id in state:
+        assert state.to_dict(state.row(donation_id)) == allocation_state.to_dict(allocation_state.row(donation_id))
+    assert list(state.iter_rows()) == [0, 1]
+    assert list(state.iter_rows(reserved_only=True)) == [1]
+    assert [state.donation_id(state.allocation_row(ix)) for ix in state.iter_fund_allocation_indexes("fund_1")] == \
+        ["donation_4"]
+    assert [state.fund_totals(match_fund_id) for match_fund_id in ("fund_1", "fund_2", "fund_3")] == totals
+
+@pytest.mark.order(408)
+def test_settled_rows_in_settle_order(allocation_state):
+    """
+    test settled rows come in the order they were settled, up to the timestamp, and only once settled
+    test the settled index carries over to a state without some rows
+    """
+    allocation_state.add("donation_4", 30.0, 0, [("fund_1", 30.0)], datetime(2021, 3, 2))
+    allocation_state.set_status(allocation_state.row("donation_3"), COLLECTED, datetime(2021, 3, 3))
+    allocation_state.set_status(allocation_state.row("donation_1"), EXPIRED, datetime(2021, 3, 4))
+    allocation_state.set_status(allocation_state.row("donation_4"), COLLECTED, datetime(2021, 3, 6))
+
+    def settled(state, before):
+        return [state.donation_id(row) for row in state.iter_settled_rows(to_timestamp(before))]
+
+    assert settled(allocation_state, datetime(2021, 3, 2)) == []
+    assert settled(allocation_state, datetime(2021, 3, 5)) == ["donation_3", "donation_1"]
+
+    state = allocation_state.without([allocation_state.row("donation_3")])
+    assert settled(state, datetime(2021, 3, 5)) == ["donation_1"]
+    state.set_status(state.row("donation_2"), COLLECTED, datetime(2021, 3, 5))
+    assert settled(state, datetime(2021, 3, 7)) == ["donation_1", "donation_2", "donation_4"]
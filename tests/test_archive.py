@@ -0,0 +1,213 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher
+from matcher.fund_matcher import RESERVED, COLLECTED, EXPIRED
+from matcher.archive import Archive
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.money import ExactFundMatcher
+from matcher.snapshot import write_snapshot, open_snapshot
+from matcher.write_ahead_log import DurableFundMatcher, SYNC
+from datetime import timedelta
+
+import random
+import pytest
+
+@pytest.fixture
+def deep_match_funds():
+    """
+    fixture fund arrays with ratios, deep enough not to run dry over a few rounds of donations
+    """
+
+    example_funds_data = [
+        ["fund_1", 400.00, 3, [1, 1]],
+        ["fund_2", 400.00, 7, [2, 1]],
+        ["fund_3", 400.00, 1, [1, 1]]
+    ]
+    return [MatchFund(*ef) for ef in example_funds_data]
+
+def run_operations(fund_matcher, prefix, seed):
+    rng = random.Random(seed)
+    for ix in range(30):
+        fund_matcher.reserve_funds(Donation("%s_%s" % (prefix, ix), round(rng.uniform(5, 30), 2)))
+    for ix in range(0, 30, 3):
+        fund_matcher.expire_donation("%s_%s" % (prefix, ix))
+    fund_matcher.collect_donations(["%s_%s" % (prefix, ix) for ix in range(1, 30, 3)])
+
+def fund_balances(fund_matcher):
+    return [(mf.match_fund_id, mf.total_amount) for mf in fund_matcher.get_match_funds_as_list()]
+
+def fund_allocations(fund_matcher):
+    return sorted((allocation['donation_id'], allocation['match_fund_allocation'], allocation['status'])
+                  for match_fund_id in fund_matcher.match_funds
+                  for allocation in fund_matcher.iter_fund_allocations(match_fund_id))
+
+@pytest.mark.order(1601)
+def test_archive_settled(deep_match_funds):
+    """
+    test archiving moves settled donations out of the allocation state, leaving summaries alone
+    test archived donations are still found by retries, settlements, lookups and listings
+    """
+    fund_matcher = FundMatcher(deep_match_funds)
+    fund_matcher.archive = Archive(":memory:")
+    run_operations(fund_matcher, "donation", 1)
+
+    summary = fund_matcher.get_summary()
+    listed = fund_matcher.list_match_fund_allocations()
+    allocations = fund_allocations(fund_matcher)
+    record = fund_matcher.allocation_state.to_dict(fund_matcher.allocation_state.row("donation_1"))
+
+    assert fund_matcher.archive_settled(timedelta(hours=1)) == 0
+    assert fund_matcher.archive_settled(timedelta(0)) == 20
+
+    assert len(fund_matcher.allocation_state) == 10
+    assert len(fund_matcher.archive) == 20
+    assert all(doc['overall_status'] == RESERVED for doc in fund_matcher.list_match_fund_allocations(status=RESERVED))
+    assert fund_matcher.get_summary() == summary
+    assert fund_allocations(fund_matcher) == allocations
+
+    # collected donations are listed, archived ones merged in the order they were reserved
+    assert fund_matcher.list_match_fund_allocations() == listed
+    page = fund_matcher.list_match_fund_allocations(limit=3, after_donation_id="donation_7")
+    assert [doc['donation_id'] for doc in page] == ["donation_8", "donation_10", "donation_11"]
+
+    archived = fund_matcher.get_allocation("donation_1")
+    assert {key: archived[key] for key in ('created_time', 'original_donation', 'overall_status')} == \
+        {key: record[key] for key in ('created_time', 'original_donation', 'overall_status')}
+    assert [allocation.to_dict() for allocation in archived['allocations']] == record['allocations']
+
+    balances = fund_balances(fund_matcher)
+    assert fund_matcher.reserve_funds(Donation("donation_1", record['original_donation']))['overall_status'] == COLLECTED
+    assert fund_matcher.reserve_funds_batch([Donation("donation_0", fund_matcher.get_allocation("donation_0")['original_donation']),
+                                             Donation("donation_1", record['original_donation'])])[0]['overall_status'] \
+        == EXPIRED
+    assert fund_balances(fund_matcher) == balances
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_funds(Donation("donation_1", record['original_donation'] + 1))
+
+    with pytest.raises(BadRequestException, match="not reserved"):
+        fund_matcher.collect_donation("donation_1")
+    with pytest.raises(BadRequestException, match="not reserved"):
+        fund_matcher.expire_donation("donation_0")
+    outcomes = fund_matcher.expire_donations(["donation_3", "donation_2"], atomic=False)
+    assert str(outcomes[0]) == "Invalid collection request. Allocation is not reserved"
+    assert outcomes[1] == EXPIRED
+    with pytest.raises(BadRequestException):
+        fund_matcher.get_allocation("donation_99")
+
+    # 42 and "42" stay apart
+    fund_matcher.reserve_funds(Donation(42, 10))
+    fund_matcher.collect_donation(42)
+    fund_matcher.archive_settled(timedelta(0))
+    assert 42 in fund_matcher.archive
+    assert "42" not in fund_matcher.archive
+
+@pytest.mark.order(1602)
+def test_archive_recovery(tmp_path, deep_match_funds):
+    """
+    test recovery from the log archives the same donations again, without copying them twice
+    test exact amounts survive the archive
+    """
+    path = str(tmp_path / "matcher.wal")
+    archive_path = str(tmp_path / "archive.db")
+
+    fund_matcher = DurableFundMatcher(path, deep_match_funds, durability=SYNC, archive=Archive(archive_path))
+    run_operations(fund_matcher, "donation", 2)
+    fund_matcher.archive_settled(timedelta(0))
+    run_operations(fund_matcher, "pledge", 3)
+    listed = fund_matcher.list_match_fund_allocations()
+    fund_matcher.close()
+    fund_matcher.archive.close()
+
+    with pytest.raises(BadRequestException):
+        DurableFundMatcher(path)
+
+    recovered = DurableFundMatcher(path, archive=Archive(archive_path))
+    assert fund_balances(recovered) == fund_balances(fund_matcher)
+    assert list(recovered.allocation_state) == list(fund_matcher.allocation_state)
+    assert len(recovered.archive) == 20
+    assert recovered.list_match_fund_allocations() == listed
+    assert recovered.get_summary() == fund_matcher.get_summary()
+    recovered.close()
+
+    exact = ExactFundMatcher(deep_match_funds)
+    exact.archive = Archive(":memory:")
+    exact.reserve_funds(Donation("donation_1", 10.01))
+    exact.collect_donation("donation_1")
+    exact.archive_settled(timedelta(0))
+    assert exact.get_allocation("donation_1")['original_donation'] == 1001
+    assert exact.reserve_funds(Donation("donation_1", 10.01))['overall_status'] == COLLECTED
+
+@pytest.mark.order(1603)
+def test_archive_between_pages(tmp_path, deep_match_funds):
+    """
+    test a cursor taken before archiving pages on in the order donations were reserved
+    test the order survives a snapshot of the compacted state
+    """
+    fund_matcher = FundMatcher(deep_match_funds)
+    fund_matcher.archive = Archive(":memory:")
+    for donation_id in ("a", "b", "c", "d"):
+        fund_matcher.reserve_funds(Donation(donation_id, 10))
+    fund_matcher.collect_donations(["a", "c"])
+
+    page = fund_matcher.list_match_fund_allocations(limit=2)
+    assert [doc['donation_id'] for doc in page] == ["a", "b"]
+
+    assert fund_matcher.archive_settled(timedelta(0)) == 2
+    page = fund_matcher.list_match_fund_allocations(limit=2, after_donation_id="b")
+    assert [doc['donation_id'] for doc in page] == ["c", "d"]
+    assert [doc['donation_id'] for doc in fund_matcher.list_match_fund_allocations()] == ["a", "b", "c", "d"]
+    assert [doc['donation_id'] for doc in fund_matcher.list_match_fund_allocations(after_donation_id="a")] == \
+        ["b", "c", "d"]
+    assert [doc['donation_id'] for doc in fund_matcher.list_match_fund_allocations(after_donation_id="c",
+                                                                                   status=RESERVED)] == ["d"]
+
+    # reservations after the compaction sort after the archived ones
+    fund_matcher.reserve_funds(Donation("e", 10))
+    fund_matcher.collect_donation("d")
+    fund_matcher.archive_settled(timedelta(0))
+    path = str(tmp_path / "matcher.snapshot")
+    write_snapshot(fund_matcher, path)
+    reopened = open_snapshot(path)
+    reopened.archive = fund_matcher.archive
+    reopened.reserve_funds(Donation("f", 10))
+    assert [doc['donation_id'] for doc in reopened.list_match_fund_allocations(after_donation_id="b")] == \
+        ["c", "d", "e", "f"]
+
+@pytest.mark.order(1604)
+def test_archive_reused_by_new_matcher(tmp_path, deep_match_funds):
+    """
+    test a new matcher over an archive on disk lists its donations after the archived ones, in every page
+    test a new write-ahead log over that archive recovers the same order
+    """
+    archive_path = str(tmp_path / "archive.db")
+    fund_matcher = FundMatcher(deep_match_funds)
+    fund_matcher.archive = Archive(archive_path)
+    for ix in range(3):
+        fund_matcher.reserve_funds(Donation("old%s" % ix, 10))
+    fund_matcher.collect_donations(["old0", "old1", "old2"])
+    fund_matcher.archive_settled(timedelta(0))
+    fund_matcher.archive.close()
+
+    expected = ["old0", "old1", "old2", "new0", "new1", "new2"]
+    plain = FundMatcher(deep_match_funds)
+    plain.archive = Archive(archive_path)
+    durable = DurableFundMatcher(str(tmp_path / "matcher.wal"), deep_match_funds, durability=SYNC,
+                                 archive=Archive(archive_path))
+    for reused in (plain, durable):
+        for ix in range(3):
+            reused.reserve_funds(Donation("new%s" % ix, 10))
+
+        assert [doc['donation_id'] for doc in reused.list_match_fund_allocations()] == expected
+        paged = []
+        page = reused.list_match_fund_allocations(limit=1)
+        while page:
+            paged.append(page[0]['donation_id'])
+            page = reused.list_match_fund_allocations(limit=1, after_donation_id=paged[-1])
+        assert paged == expected
+        reused.archive.close()
+
+    durable.close()
+    recovered = DurableFundMatcher(str(tmp_path / "matcher.wal"), archive=Archive(archive_path))
+    assert [doc['donation_id'] for doc in recovered.list_match_fund_allocations()] == expected
+    recovered.close()
+    recovered.archive.close()
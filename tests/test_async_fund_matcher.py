@@ -0,0 +1,129 @@
+from matcher.fund_matcher import FundMatcher
+from matcher.fund_matcher import RESERVED, COLLECTED, EXPIRED
+from matcher.async_fund_matcher import AsyncFundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+
+import asyncio
+import pytest
+
+@pytest.mark.order(601)
+def test_async_reserve_in_arrival_order(simple_match_funds):
+    """
+    test concurrent callers are matched in the order their requests arrived
+    test each caller gets back its own allocation state
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+
+    async def main():
+        async_matcher = AsyncFundMatcher(fund_matcher, max_batch_size=10, max_delay=0.01)
+        return await asyncio.gather(*[async_matcher.reserve(Donation("donation_%s" % ix, 60)) for ix in range(6)])
+
+    results = asyncio.run(main())
+
+    assert [r['allocations'][0].match_fund_id for r in results[:5]] == ["fund_3", "fund_3", "fund_1", "fund_1", "fund_2"]
+    assert results[5]['allocations'] == []
+    assert results[5]['donation_balance_unmatched'] == 60
+    assert fund_matcher.allocation_state["donation_0"]['overall_status'] == RESERVED
+
+@pytest.mark.order(602)
+def test_async_errors_go_to_their_caller(simple_match_funds):
+    """
+    test a bad request in a batch fails only its own caller
+    test collect and expire apply after the reservations queued before them
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+
+    async def main():
+        async_matcher = AsyncFundMatcher(fund_matcher, max_batch_size=100, max_delay=0.01)
+        return await asyncio.gather(
+            async_matcher.reserve(Donation("donation_1", 50)),
+            async_matcher.collect("donation_1"),
+            async_matcher.expire("donation_1"),
+            async_matcher.reserve(Donation("donation_2", 50)),
+            async_matcher.expire("donation_2"),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+
+    assert results[1] is None
+    assert isinstance(results[2], BadRequestException)
+    assert results[4] is None
+    assert fund_matcher.allocation_state["donation_1"]['overall_status'] == COLLECTED
+    assert fund_matcher.allocation_state["donation_2"]['overall_status'] == EXPIRED
+
+@pytest.mark.order(603)
+def test_async_batches_flush_at_size_limit(simple_match_funds):
+    """
+    test a full batch is applied without waiting for the delay
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+
+    async def main():
+        async_matcher = AsyncFundMatcher(fund_matcher, max_batch_size=2, max_delay=60)
+        return await asyncio.wait_for(asyncio.gather(
+            async_matcher.reserve(Donation("donation_1", 10)),
+            async_matcher.reserve(Donation("donation_2", 10))
+        ), timeout=5)
+
+    results = asyncio.run(main())
+
+    assert len(results) == 2
+    assert len(fund_matcher.allocation_state) == 2
+
+@pytest.mark.order(604)
+def test_async_bad_reservation_fails_only_its_caller(simple_match_funds):
+    """
+    test a bad retry in a run of reservations fails only its own caller
+    test the other reservations of the run are made, in arrival order
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    fund_matcher.reserve_funds(Donation("donation_0", 20))
+
+    async def main():
+        async_matcher = AsyncFundMatcher(fund_matcher, max_batch_size=100, max_delay=0.01)
+        return await asyncio.gather(
+            async_matcher.reserve(Donation("donation_1", 50)),
+            async_matcher.reserve(Donation("donation_0", 30)),
+            async_matcher.reserve(Donation("donation_2", 50)),
+            async_matcher.reserve(Donation("donation_0", 20)),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+
+    assert isinstance(results[1], BadRequestException)
+    assert [(a.match_fund_id, a.match_fund_allocation) for a in results[0]['allocations']] == [("fund_3", 50.0)]
+    assert [(a.match_fund_id, a.match_fund_allocation) for a in results[2]['allocations']] == \
+        [("fund_3", 30.0), ("fund_1", 20.0)]
+    assert results[3].row == fund_matcher.allocation_state.row("donation_0")
+
+@pytest.mark.order(605)
+def test_async_matcher_failure_resolves_every_caller(simple_match_funds):
+    """
+    test a failure other than a bad request goes to every caller of the failed call
+    test the requests queued behind it are still applied
+    """
+    class FailingBatchMatcher(FundMatcher):
+        def reserve_funds_batch(self, donations):
+            raise OSError("sync failed")
+
+    fund_matcher = FailingBatchMatcher(simple_match_funds)
+    fund_matcher.reserve_funds(Donation("donation_0", 20))
+
+    async def main():
+        async_matcher = AsyncFundMatcher(fund_matcher, max_batch_size=100, max_delay=0.01)
+        return await asyncio.wait_for(asyncio.gather(
+            async_matcher.reserve(Donation("donation_1", 50)),
+            async_matcher.reserve(Donation("donation_2", 50)),
+            async_matcher.collect("donation_0"),
+            async_matcher.collect("donation_9"),
+            return_exceptions=True
+        ), 5)
+
+    results = asyncio.run(main())
+
+    assert [type(result) for result in results] == [OSError, OSError, type(None), BadRequestException]
+    assert fund_matcher.allocation_state["donation_0"]['overall_status'] == COLLECTED
+    assert "donation_1" not in fund_matcher.allocation_state
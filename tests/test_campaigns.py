@@ -0,0 +1,145 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.campaigns import CampaignRegistry, CREATE, RESERVE, COLLECT, EXPIRE, SUMMARY
+
+import copy
+import os
+import pytest
+
+def campaign_funds(campaign_ix):
+    return [
+        MatchFund("fund_1", 100.00 + campaign_ix, 3, [1, 1]),
+        MatchFund("fund_2", 200.00, 7, [2, 1]),
+        MatchFund("fund_3", 50.00, 1, [1, 1])
+    ]
+
+@pytest.fixture
+def operations():
+    """
+    fixture operations over six campaigns, interleaved, including rejected ones
+    """
+
+    operations = [(CREATE, "campaign_%s" % ix, campaign_funds(ix)) for ix in range(6)]
+    for ix in range(30):
+        operations.append((RESERVE, "campaign_%s" % (ix % 6), Donation("donation_%s" % ix, 5 + ix)))
+    operations += [
+        (COLLECT, "campaign_0", "donation_0"),
+        (EXPIRE, "campaign_1", "donation_1"),
+        (COLLECT, "campaign_2", "donation_3"),
+        (RESERVE, "campaign_0", Donation("donation_0", 99)),
+        (RESERVE, "campaign_0", Donation("donation_6", 11)),
+        (RESERVE, "campaign_7", Donation("donation_0", 10)),
+        (EXPIRE, "campaign_1", "donation_1")
+    ]
+    return operations
+
+def expected_outcomes(operations):
+    fund_matchers = {}
+    outcomes = []
+    for operation, campaign_id, argument in copy.deepcopy(operations):
+        try:
+            if operation == CREATE:
+                fund_matchers[campaign_id] = FundMatcher(argument)
+                outcomes.append(None)
+                continue
+            if campaign_id not in fund_matchers:
+                raise BadRequestException("Invalid campaign id %s" % campaign_id)
+            fund_matcher = fund_matchers[campaign_id]
+            if operation == RESERVE:
+                doc = fund_matcher.reserve_funds(argument)
+                outcomes.append((argument.donation_id, [(a.match_fund_id, a.match_fund_allocation)
+                                                        for a in doc['allocations']]))
+            elif operation == COLLECT:
+                outcomes.append(fund_matcher.collect_donation(argument))
+            elif operation == EXPIRE:
+                outcomes.append(fund_matcher.expire_donation(argument))
+            else:
+                outcomes.append(fund_matcher.get_summary())
+        except BadRequestException as e:
+            outcomes.append(str(e))
+    return outcomes, fund_matchers
+
+def comparable(outcome):
+    if isinstance(outcome, BadRequestException):
+        return str(outcome)
+    if isinstance(outcome, dict) and 'allocations' in outcome:
+        return outcome['donation_id'], [(a['match_fund_id'], a['match_fund_allocation']) for a in outcome['allocations']]
+    return outcome
+
+@pytest.mark.order(1701)
+def test_registry_matches_in_process_matchers(tmp_path, operations):
+    """
+    test a batch over many campaigns and workers gives the outcomes of one FundMatcher per campaign
+    test a rejected operation gets its own exception and leaves the others applied
+    test campaigns evicted to disk are reloaded with their state
+    """
+    expected, fund_matchers = expected_outcomes(operations)
+    summaries = [(SUMMARY, "campaign_%s" % ix, None) for ix in range(6)]
+
+    with CampaignRegistry(str(tmp_path), workers=3, max_resident=1) as registry:
+        outcomes = registry.execute(operations)
+        assert [comparable(outcome) for outcome in outcomes] == expected
+        assert "already reserved for a different amount" in str(outcomes[-4])
+        assert str(outcomes[-2]) == "Invalid campaign id campaign_7"
+
+        # only one campaign per worker is resident; the rest were written out
+        assert len(os.listdir(str(tmp_path))) >= 3
+        assert registry.execute(summaries) == [fund_matchers["campaign_%s" % ix].get_summary() for ix in range(6)]
+
+        assert registry.reserve_funds("campaign_4", Donation("donation_4", 9))['original_donation'] == 9
+        with pytest.raises(BadRequestException):
+            registry.create_campaign("campaign_4", campaign_funds(4))
+        with pytest.raises(BadRequestException):
+            registry.collect_donation("campaign_4", "donation_5")
+        with pytest.raises(BadRequestException):
+            registry.execute([("retire", "campaign_4", "fund_1")])
+
+@pytest.mark.order(1702)
+def test_registry_reopens_campaigns(tmp_path, operations):
+    """
+    test closing a registry writes out every campaign, and a registry with other workers resumes them
+    """
+    expected, fund_matchers = expected_outcomes(operations)
+
+    with CampaignRegistry(str(tmp_path), workers=2) as registry:
+        registry.execute(operations)
+
+    with CampaignRegistry(str(tmp_path), workers=3) as registry:
+        assert registry.get_summary("campaign_2") == fund_matchers["campaign_2"].get_summary()
+        registry.collect_donation("campaign_5", "donation_5")
+        fund_matchers["campaign_5"].collect_donation("donation_5")
+
+        outcome = registry.reserve_funds("campaign_5", Donation("donation_30", 40))
+        doc = fund_matchers["campaign_5"].reserve_funds(Donation("donation_30", 40))
+        assert comparable(outcome) == ("donation_30", [(a.match_fund_id, a.match_fund_allocation)
+                                                       for a in doc['allocations']])
+
+    with CampaignRegistry(str(tmp_path), workers=1) as registry:
+        assert registry.get_summary("campaign_5") == fund_matchers["campaign_5"].get_summary()
+
+@pytest.mark.order(1703)
+def test_malformed_operations_leave_worker_running(tmp_path):
+    """
+    test a malformed operation gets back the exception it raised, and only that operation
+    test the worker carries on serving its campaigns afterwards
+    """
+    with CampaignRegistry(str(tmp_path), workers=1) as registry:
+        registry.create_campaign("campaign_0", campaign_funds(0))
+
+        outcomes = registry.execute([
+            (RESERVE, "campaign_0", "not a donation"),
+            (RESERVE, ["unhashable", "campaign"], Donation("donation_0", 10)),
+            (CREATE, "campaign_1", ["not a match fund"]),
+            (RESERVE, "campaign_0", Donation("donation_1", 10))
+        ])
+
+        assert isinstance(outcomes[0], AttributeError)
+        assert isinstance(outcomes[1], TypeError)
+        assert isinstance(outcomes[2], AttributeError)
+        assert comparable(outcomes[3]) == ("donation_1", [("fund_3", 10.0)])
+
+        with pytest.raises(AttributeError):
+            registry.reserve_funds("campaign_0", None)
+        assert registry.get_summary("campaign_0")['reserved'] == 10.0
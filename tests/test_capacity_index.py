@@ -0,0 +1,151 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher, RESERVED
+from matcher.capacity_index import FenwickTree
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.fork import ForkedFundMatcher
+from matcher.money import ExactFundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+
+import copy
+import random
+import pytest
+
+@pytest.fixture
+def mixed_match_funds():
+    """
+    fixture of funds with mixed ratios and shared match orders
+    """
+
+    rng = random.Random(4)
+    return [MatchFund("fund_%s" % ix, rng.choice([20.00, 50.00, 200.00]), rng.randint(0, 5), [rng.randint(1, 3), 1])
+            for ix in range(15)]
+
+def totals(doc):
+    return doc['original_donation'], sum(allocation.match_fund_allocation for allocation in doc['allocations']), \
+        doc['donation_balance_unmatched']
+
+def quoted(fund_matcher, amount, breakdown=False):
+    quote = fund_matcher.quote(amount, breakdown)
+    return quote['original_donation'], quote['match_fund_allocation'], quote['donation_balance_unmatched']
+
+@pytest.mark.order(1901)
+def test_fenwick_tree():
+    """
+    test prefix sums and searches against a plain list, through updates
+    """
+    rng = random.Random(1)
+    values = [rng.randint(0, 9) for _ in range(37)]
+    tree = FenwickTree(values)
+
+    for _ in range(200):
+        position = rng.randrange(len(values))
+        delta = rng.randint(-values[position], 9)
+        values[position] += delta
+        tree.add(position, delta)
+
+        count = rng.randint(0, len(values))
+        assert tree.prefix_sum(count) == sum(values[:count])
+
+        target = rng.randint(1, sum(values) + 5)
+        found, total = tree.search(target)
+        assert total == sum(values[:found]) < target
+        assert found == len(values) or sum(values[:found + 1]) >= target
+
+    assert FenwickTree([]).search(5) == (0, 0)
+
+@pytest.mark.order(1902)
+@pytest.mark.parametrize("matcher_class", [FundMatcher, ExactFundMatcher, ConcurrentFundMatcher])
+def test_quote_matches_reservation(mixed_match_funds, matcher_class):
+    """
+    test a quote gives what reserving the amount then would, through reservations, expiries,
+    top ups and registry changes, and changes nothing
+    test a quote with breakdown gives the allocations of the reservation
+    """
+    fund_matcher = matcher_class(mixed_match_funds)
+    rng = random.Random(6)
+
+    for ix in range(120):
+        amount = rng.choice([rng.uniform(5, 40), rng.uniform(100, 400)])
+        state_version = fund_matcher._state_version()
+        balances = [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()]
+
+        quote = quoted(fund_matcher, amount)
+        with_breakdown = fund_matcher.quote(amount, breakdown=True)
+        assert fund_matcher._state_version() == state_version
+        assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == balances
+
+        doc = fund_matcher.reserve_funds(Donation("donation_%s" % ix, amount))
+        assert quote == pytest.approx(totals(doc))
+        assert with_breakdown['allocations'] == [{'match_fund_id': allocation.match_fund_id,
+                                                  'match_fund_allocation': allocation.match_fund_allocation}
+                                                 for allocation in doc['allocations']]
+        assert with_breakdown['donation_balance_unmatched'] == doc['donation_balance_unmatched']
+
+        if ix % 3 == 0 and fund_matcher.donation_status("donation_%s" % (ix // 2)) == RESERVED:
+            fund_matcher.expire_donation("donation_%s" % (ix // 2))
+        if ix == 40:
+            fund_matcher.top_up("fund_2", 300)
+        if ix == 60:
+            fund_matcher.retire_match_fund("fund_4")
+        if ix == 80:
+            fund_matcher.add_match_fund(MatchFund("fund_new", 500.00, 0, [1, 2]))
+            fund_matcher.reorder_match_fund("fund_1", 9)
+
+    if matcher_class is ExactFundMatcher:
+        # minor unit arithmetic makes the quote exact
+        assert quoted(fund_matcher, 77.77) == totals(fund_matcher.reserve_funds(Donation("donation_last", 77.77)))
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.quote(0)
+
+@pytest.mark.order(1903)
+def test_quote_on_fork(mixed_match_funds):
+    """
+    test a fork quotes against its own balances, and sees its parent's changes
+    """
+    fund_matcher = FundMatcher(copy.deepcopy(mixed_match_funds))
+    expected = FundMatcher(copy.deepcopy(mixed_match_funds))
+    for target in (fund_matcher, expected):
+        target.reserve_funds(Donation("donation_0", 300))
+
+    fork = ForkedFundMatcher(fund_matcher)
+    fork.reserve_funds(Donation("pledge_0", 200))
+    expected.reserve_funds(Donation("pledge_0", 200))
+    assert quoted(fork, 150) == pytest.approx(quoted(expected, 150))
+
+    fund_matcher.expire_donation("donation_0")
+    expected.expire_donation("donation_0")
+    assert quoted(fork, 150) == pytest.approx(quoted(expected, 150))
+    assert quoted(fork, 150, breakdown=True) == quoted(expected, 150, breakdown=True)
+
+@pytest.mark.order(1904)
+def test_exact_quote_matches_reservation():
+    """
+    test exact quotes give what reserving the amount would, to the minor unit, with ratios that round
+    test a fork of an exact matcher quotes in minor units too
+    """
+    rng = random.Random(11)
+    ratios = [[1, 2], [1, 3], [3, 7], [2, 9], [1, 1], [2, 1], [7, 3]]
+    match_funds = [MatchFund("fund_%s" % ix, rng.choice([0.00, 0.03, 1.01, 3.00, 7.77]), rng.randint(0, 5),
+                             rng.choice(ratios))
+                   for ix in range(12)]
+    fund_matcher = ExactFundMatcher(match_funds)
+    fund_matcher.retire_match_fund("fund_3")
+
+    for minor_units in range(500, 6000, 3):
+        amount = minor_units / 100
+        quote = fund_matcher.quote(amount)
+        with_breakdown = fund_matcher.quote(amount, breakdown=True)
+        del with_breakdown['allocations']
+        assert quote == with_breakdown
+
+    assert fund_matcher.quote(6.01) == ForkedFundMatcher(fund_matcher).quote(6.01)
+    assert isinstance(ForkedFundMatcher(fund_matcher).quote(6.01)['donation_balance_unmatched'], int)
+
+    for ix in range(60):
+        amount = round(rng.uniform(5, 12), 2)
+        quote = quoted(fund_matcher, amount)
+        assert quote == totals(fund_matcher.reserve_funds(Donation("donation_%s" % ix, amount)))
+        if ix % 4 == 0:
+            fund_matcher.expire_donation("donation_%s" % (ix // 2))
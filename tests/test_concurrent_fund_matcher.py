@@ -0,0 +1,259 @@
+from matcher.match_fund import MatchFund
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.fund_matcher import RESERVED, EXPIRED
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+
+import random
+import sys
+import threading
+import pytest
+
+@pytest.fixture
+def stress_match_funds():
+    """
+    fixture of many funds with mixed ratios and shared match orders
+    """
+
+    rng = random.Random(7)
+    return [MatchFund("fund_%s" % ix, rng.choice([50.00, 200.00, 1000.00]), rng.randint(0, 10), [rng.randint(1, 3), 1])
+            for ix in range(30)]
+
+def run_threads(target, count):
+    # switch threads far more often than the default, to force interleavings
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=target, args=(ix,)) for ix in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+@pytest.mark.order(501)
+def test_concurrent_reserve_and_expire_never_over_allocates(stress_match_funds):
+    """
+    test funds never go negative and every fund balances exactly
+    (initial total == balance + live allocations) after concurrent reserve, collect and expire
+    test every donation draws from funds in match_order
+    """
+    initial_totals = {mf.match_fund_id: mf.total_amount for mf in stress_match_funds}
+    fund_matcher = ConcurrentFundMatcher(stress_match_funds)
+    match_orders = {mf.match_fund_id: fund_matcher._fund_keys[mf.match_fund_id] for mf in stress_match_funds}
+
+    def worker(thread_ix):
+        rng = random.Random(thread_ix)
+        for ix in range(300):
+            donation_id = "donation_%s_%s" % (thread_ix, ix)
+            fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 80)))
+            action = rng.random()
+            if action < 0.4:
+                fund_matcher.expire_donation(donation_id)
+            elif action < 0.6:
+                fund_matcher.collect_donation(donation_id)
+
+    run_threads(worker, 8)
+
+    allocated = {match_fund_id: 0 for match_fund_id in initial_totals}
+    for donation_id in fund_matcher.allocation_state:
+        record = fund_matcher.allocation_state[donation_id]
+        allocations = record['allocations']
+        keys = [match_orders[a.match_fund_id] for a in allocations]
+        assert keys == sorted(keys)
+        if record['overall_status'] != EXPIRED:
+            for a in allocations:
+                allocated[a.match_fund_id] += a.match_fund_allocation
+
+    for mf in fund_matcher.get_match_funds_as_list():
+        assert mf.total_amount >= 0
+        assert mf.total_amount + allocated[mf.match_fund_id] == pytest.approx(initial_totals[mf.match_fund_id])
+
+    assert len(fund_matcher.allocation_state) == 8 * 300
+
+@pytest.mark.order(502)
+def test_concurrent_expire_refunds_once(stress_match_funds):
+    """
+    test only one of many threads expiring the same donation succeeds
+    """
+    fund_matcher = ConcurrentFundMatcher(stress_match_funds)
+    fund_matcher.reserve_funds(Donation("donation_1", 100))
+    total_before = sum(mf.total_amount for mf in fund_matcher.get_match_funds_as_list())
+
+    outcomes = []
+
+    def worker(thread_ix):
+        try:
+            fund_matcher.expire_donation("donation_1")
+            outcomes.append(True)
+        except BadRequestException:
+            outcomes.append(False)
+
+    run_threads(worker, 8)
+
+    assert outcomes.count(True) == 1
+    refunded = sum(a.match_fund_allocation for a in fund_matcher.allocation_state["donation_1"]['allocations'])
+    assert sum(mf.total_amount for mf in fund_matcher.get_match_funds_as_list()) == pytest.approx(total_before + refunded)
+
+@pytest.mark.order(503)
+def test_concurrent_batches_alongside_single_reservations(stress_match_funds):
+    """
+    test batched and single reservations from different threads keep funds balanced
+    """
+    initial_total = sum(mf.total_amount for mf in stress_match_funds)
+    fund_matcher = ConcurrentFundMatcher(stress_match_funds)
+
+    def worker(thread_ix):
+        rng = random.Random(thread_ix)
+        if thread_ix % 2:
+            donations = [Donation("donation_%s_%s" % (thread_ix, ix), rng.uniform(5, 50)) for ix in range(200)]
+            fund_matcher.reserve_funds_batch(donations)
+        else:
+            for ix in range(200):
+                fund_matcher.reserve_funds(Donation("donation_%s_%s" % (thread_ix, ix), rng.uniform(5, 50)))
+
+    run_threads(worker, 6)
+
+    allocated = sum(a.match_fund_allocation
+                    for donation_id in fund_matcher.allocation_state
+                    for a in fund_matcher.allocation_state[donation_id]['allocations'])
+    balance = sum(mf.total_amount for mf in fund_matcher.get_match_funds_as_list())
+
+    assert all(mf.total_amount >= 0 for mf in fund_matcher.get_match_funds_as_list())
+    assert balance + allocated == pytest.approx(initial_total)
+    assert all(fund_matcher.allocation_state[donation_id]['overall_status'] == RESERVED
+               for donation_id in fund_matcher.allocation_state)
+
+@pytest.mark.order(504)
+def test_concurrent_bulk_expire_refunds_once(stress_match_funds):
+    """
+    test threads bulk expiring overlapping donations refund each donation exactly once
+    """
+    fund_matcher = ConcurrentFundMatcher(stress_match_funds)
+    fund_matcher.reserve_funds_batch([Donation("donation_%s" % ix, 50) for ix in range(200)])
+    total_before = sum(mf.total_amount for mf in fund_matcher.get_match_funds_as_list())
+
+    outcomes = []
+
+    def worker(thread_ix):
+        donation_ids = ["donation_%s" % ix for ix in range(thread_ix * 20, thread_ix * 20 + 60)]
+        outcomes.extend(fund_matcher.expire_donations(donation_ids, atomic=False))
+
+    run_threads(worker, 8)
+
+    assert outcomes.count(EXPIRED) == 200
+    refunded = sum(a.match_fund_allocation for ix in range(200)
+                   for a in fund_matcher.allocation_state["donation_%s" % ix]['allocations'])
+    assert sum(mf.total_amount for mf in fund_matcher.get_match_funds_as_list()) == pytest.approx(total_before + refunded)
+
+@pytest.mark.order(505)
+def test_concurrent_fund_churn_alongside_reservations(stress_match_funds):
+    """
+    test funds added, topped up, reordered and retired mid-traffic still balance exactly
+    (initial total + top ups - retired balance == balance + live allocations)
+    test retired funds are out of the active index, even after expiries credited them
+    """
+    fund_matcher = ConcurrentFundMatcher(stress_match_funds)
+    credited = {mf.match_fund_id: mf.total_amount for mf in stress_match_funds}
+
+    def worker(thread_ix):
+        rng = random.Random(thread_ix)
+        if thread_ix == 0:
+            for ix in range(60):
+                match_fund_id = "new_fund_%s" % ix
+                fund_matcher.add_match_fund(MatchFund(match_fund_id, 100.00, rng.randint(0, 10), [rng.randint(1, 3), 1]))
+                credited[match_fund_id] = 100.00
+                top_up_id = rng.choice(sorted(credited))
+                if not fund_matcher.is_retired(top_up_id):
+                    fund_matcher.top_up(top_up_id, 25)
+                    credited[top_up_id] += 25
+                fund_matcher.reorder_match_fund(rng.choice(sorted(credited)), rng.randint(0, 10))
+                if ix % 5 == 0:
+                    retire_id = rng.choice(sorted(credited))
+                    if not fund_matcher.is_retired(retire_id):
+                        credited[retire_id] -= fund_matcher.retire_match_fund(retire_id)
+            return
+
+        for ix in range(300):
+            donation_id = "donation_%s_%s" % (thread_ix, ix)
+            fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 80)))
+            if rng.random() < 0.4:
+                fund_matcher.expire_donation(donation_id)
+
+    run_threads(worker, 6)
+
+    state = fund_matcher.allocation_state
+    allocated = {match_fund_id: 0 for match_fund_id in credited}
+    for donation_id in state:
+        row = state.row(donation_id)
+        if state.status(row) != EXPIRED:
+            for match_fund_id, amount in state.matches(row):
+                allocated[match_fund_id] += amount
+
+    for mf in fund_matcher.get_match_funds_as_list():
+        assert mf.total_amount >= 0
+        assert mf.total_amount + allocated[mf.match_fund_id] == pytest.approx(credited[mf.match_fund_id])
+
+    active_fund_ids = set(key[2] for key in fund_matcher._active_funds)
+    assert not active_fund_ids & fund_matcher._retired
+
+@pytest.mark.order(506)
+def test_concurrent_retries_reserve_once(stress_match_funds):
+    """
+    test threads retrying the same donations, one by one and in batches, match each once
+    """
+    fund_matcher = ConcurrentFundMatcher(stress_match_funds)
+    total = sum(mf.total_amount for mf in stress_match_funds)
+    rng = random.Random(11)
+    amounts = [rng.uniform(5, 80) for _ in range(200)]
+
+    errors = []
+
+    def worker(thread_ix):
+        order = list(range(len(amounts)))
+        random.Random(thread_ix).shuffle(order)
+        try:
+            if thread_ix % 2:
+                for ix in order:
+                    fund_matcher.reserve_funds(Donation("donation_%s" % ix, amounts[ix]))
+            else:
+                for start in range(0, len(order), 20):
+                    batch = order[start:start + 20]
+                    fund_matcher.reserve_funds_batch([Donation("donation_%s" % ix, amounts[ix]) for ix in batch])
+        except Exception as e:
+            errors.append(e)
+
+    run_threads(worker, 6)
+
+    assert errors == []
+    state = fund_matcher.allocation_state
+    assert len(state) == len(amounts)
+    assert not fund_matcher._claims
+    allocated = sum(amount for donation_id in state for _, amount in state.matches(state.row(donation_id)))
+    assert allocated + sum(mf.total_amount for mf in fund_matcher.get_match_funds_as_list()) == pytest.approx(total)
+
+@pytest.mark.order(507)
+def test_batch_locks_fund_added_while_locking(stress_match_funds):
+    """
+    test a fund added while a batch is taking the fund locks is locked before the batch draws from it
+    """
+
+    class RacedFundMatcher(ConcurrentFundMatcher):
+        def _funds_locked(self, match_fund_ids):
+            if "fund_new" not in self._fund_locks:
+                adder = threading.Thread(target=self.add_match_fund, args=(MatchFund("fund_new", 100, -1),))
+                adder.start()
+                adder.join()
+            return super()._funds_locked(match_fund_ids)
+
+        def _match_batch(self, amounts):
+            unlocked.extend(match_fund_id for match_fund_id, lock in self._fund_locks.items() if not lock.locked())
+            return super()._match_batch(amounts)
+
+    unlocked = []
+    fund_matcher = RacedFundMatcher(stress_match_funds)
+    fund_matcher.reserve_funds_batch([Donation("donation_%s" % ix, 10) for ix in range(3)])
+
+    assert unlocked == []
+    assert fund_matcher.match_funds["fund_new"].total_amount == 70
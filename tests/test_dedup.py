@@ -0,0 +1,69 @@
+from matcher.fund_matcher import FundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.fund_matcher import COLLECTED
+from matcher.archive import Archive
+from matcher.dedup import BloomFilter
+from datetime import timedelta
+
+import pytest
+
+@pytest.mark.order(1501)
+def test_bloom_filter():
+    """
+    test a Bloom filter never misses a key it holds, and keeps near its false positive rate
+    test a filter must have a capacity and an error rate between 0 and 1
+    """
+    bloom_filter = BloomFilter(10000, error_rate=0.01)
+    for ix in range(10000):
+        bloom_filter.add("donation_%s" % ix)
+
+    assert all("donation_%s" % ix in bloom_filter for ix in range(10000))
+    false_positives = sum("other_%s" % ix in bloom_filter for ix in range(10000))
+    assert false_positives < 200
+    assert 42 not in BloomFilter(10)
+
+    with pytest.raises(BadRequestException):
+        BloomFilter(100, error_rate=1)
+    with pytest.raises(BadRequestException):
+        BloomFilter(0)
+
+@pytest.mark.order(1502)
+def test_retries_answered_after_archiving(match_funds_with_ratios):
+    """
+    test the matcher answers retries itself, for donations held in memory and archived
+    test a retry with a different amount is rejected either way, leaving the balances alone
+    """
+    fund_matcher = FundMatcher(match_funds_with_ratios)
+    fund_matcher.archive = Archive(":memory:")
+
+    first = fund_matcher.reserve_funds(Donation("donation_1", 30))
+    assert fund_matcher.reserve_funds(Donation("donation_1", 30)).row == first.row
+    assert fund_matcher.reserve_columns(["donation_2", "donation_1", "donation_2"], [10, 30, 10])[1].row == first.row
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_funds(Donation("donation_1", 40))
+
+    fund_matcher.collect_donation("donation_1")
+    fund_matcher.archive_settled(timedelta(0))
+    balances = [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()]
+    assert fund_matcher.reserve_funds(Donation("donation_1", 30))['overall_status'] == COLLECTED
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_funds(Donation("donation_1", 40))
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == balances
+    assert len(fund_matcher.allocation_state) == 1
+
+@pytest.mark.order(1503)
+def test_bloom_filter_past_capacity():
+    """
+    test a filter filled past its capacity still never misses a key it holds, only answers yes more often
+    test keys of any hashable type are held, and every add is counted
+    """
+    bloom_filter = BloomFilter(100, error_rate=0.01)
+    keys = ["donation_%s" % ix for ix in range(1000)] + [7, ("donation", 7)]
+    for key in keys:
+        bloom_filter.add(key)
+
+    assert all(key in bloom_filter for key in keys)
+    assert len(bloom_filter) == 1002
+    false_positives = sum("other_%s" % ix in bloom_filter for ix in range(1000))
+    assert false_positives > 10
@@ -0,0 +1,100 @@
+from matcher.fund_matcher import FundMatcher
+from matcher.fund_matcher import RESERVED, COLLECTED, EXPIRED
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.expiry_scheduler import ExpiryScheduler
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from datetime import datetime, timedelta
+
+import asyncio
+import time
+import pytest
+
+@pytest.mark.order(1101)
+def test_expire_due_releases_overdue_reservations(simple_match_funds):
+    """
+    test only reservations past their TTL are expired, and their funds released
+    test collected donations and re-reserved ids are left alone
+    """
+    scheduler = ExpiryScheduler(FundMatcher(simple_match_funds), ttl=60)
+
+    scheduler.reserve_funds(Donation("donation_1", 100))
+    scheduler.reserve_funds_batch([Donation("donation_2", 50), Donation("donation_3", 50)])
+    scheduler.collect_donation("donation_2")
+    created = scheduler.allocation_state["donation_1"]['created_time']
+
+    assert scheduler.expire_due(created + timedelta(seconds=59)) == []
+    assert scheduler.next_due() == created + timedelta(seconds=60)
+
+    expired = scheduler.expire_due(created + timedelta(seconds=61))
+
+    assert expired == ["donation_1", "donation_3"]
+    assert scheduler.allocation_state["donation_2"]['overall_status'] == COLLECTED
+    assert scheduler.allocation_state["donation_3"]['overall_status'] == EXPIRED
+    assert sum(mf.total_amount for mf in scheduler.get_match_funds_as_list()) == 250
+    assert len(scheduler) == 0
+    assert scheduler.next_due() is None
+
+    with pytest.raises(BadRequestException):
+        ExpiryScheduler(FundMatcher([]), ttl=0)
+
+@pytest.mark.order(1102)
+def test_scheduler_picks_up_existing_reservations(simple_match_funds):
+    """
+    test reservations made before the scheduler, or directly on the matcher, are expired
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    fund_matcher.reserve_funds(Donation("before", 20))
+
+    scheduler = ExpiryScheduler(fund_matcher, ttl=timedelta(minutes=5))
+    fund_matcher.reserve_funds(Donation("direct", 20))
+    scheduler.track("direct")
+
+    with pytest.raises(BadRequestException):
+        scheduler.track("missing")
+
+    assert scheduler.expire_due(datetime.now() + timedelta(minutes=6)) == ["before", "direct"]
+    assert fund_matcher.allocation_state["direct"]['overall_status'] == EXPIRED
+
+@pytest.mark.order(1104)
+def test_retries_are_tracked_once(simple_match_funds):
+    """
+    test retrying a reservation, one at a time, in batches or by tracking it, keeps one heap entry
+    """
+    scheduler = ExpiryScheduler(FundMatcher(simple_match_funds), ttl=60)
+    for _ in range(3):
+        scheduler.reserve_funds(Donation("donation_1", 20))
+        scheduler.reserve_funds_batch([Donation("donation_1", 20), Donation("donation_2", 20)])
+        scheduler.track("donation_2")
+    assert len(scheduler) == 2
+
+    created = scheduler.allocation_state["donation_1"]['created_time']
+    assert scheduler.expire_due(created + timedelta(seconds=61)) == ["donation_1", "donation_2"]
+    assert len(scheduler) == 0
+    assert scheduler._tracked == {}
+
+@pytest.mark.order(1103)
+def test_scheduler_runs_in_background(simple_match_funds):
+    """
+    test the background thread and the asyncio task expire reservations as they fall due
+    """
+    scheduler = ExpiryScheduler(ConcurrentFundMatcher(simple_match_funds), ttl=0.01)
+    scheduler.start(interval=0.005)
+    scheduler.reserve_funds(Donation("donation_1", 20))
+
+    deadline = time.monotonic() + 5
+    while scheduler.allocation_state["donation_1"]['overall_status'] == RESERVED and time.monotonic() < deadline:
+        time.sleep(0.005)
+    scheduler.stop()
+
+    assert scheduler.allocation_state["donation_1"]['overall_status'] == EXPIRED
+
+    async def main():
+        task = asyncio.create_task(scheduler.run(interval=0.005))
+        scheduler.reserve_funds(Donation("donation_2", 20))
+        while scheduler.allocation_state["donation_2"]['overall_status'] == RESERVED:
+            await asyncio.sleep(0.005)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+    assert scheduler.allocation_state["donation_2"]['overall_status'] == EXPIRED
@@ -0,0 +1,200 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher
+from matcher.fund_matcher import RESERVED, COLLECTED, EXPIRED
+from matcher.fork import ForkedFundMatcher
+from matcher.money import ExactFundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException, ConflictException
+
+import copy
+import random
+import pytest
+
+@pytest.fixture
+def four_match_funds():
+    """
+    fixture of four funds with uneven balances and ratios
+    """
+
+    example_funds_data = [
+        ["fund_1", 100.00, 3, [2, 1]],
+        ["fund_2", 200.00, 7, [1, 1]],
+        ["fund_3", 50.00, 1, [3, 1]],
+        ["fund_4", 400.00, 9, [1, 2]]
+    ]
+    return [MatchFund(*ef) for ef in example_funds_data]
+
+@pytest.fixture
+def fund_matcher(four_match_funds):
+    """
+    fixture matcher with reservations, one of which drained fund_3
+    """
+
+    fund_matcher = FundMatcher(four_match_funds)
+    for ix, amount in enumerate([10, 25, 40, 15]):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, amount))
+    fund_matcher.collect_donation("donation_1")
+    return fund_matcher
+
+def fund_balances(fund_matcher):
+    return [(mf.match_fund_id, mf.total_amount) for mf in fund_matcher.get_match_funds_as_list()]
+
+def allocations(fund_matcher):
+    return [(doc['donation_id'], doc['allocations'], doc['overall_status'])
+            for doc in fund_matcher.list_match_fund_allocations()]
+
+@pytest.mark.order(1401)
+def test_fork_previews_and_commits(fund_matcher):
+    """
+    test a fork matches as the matcher itself would, leaving the matcher untouched
+    test only the funds the fork changed are copied
+    test committing applies the same operations to the matcher
+    """
+    expected = copy.deepcopy(fund_matcher)
+    before = (fund_balances(fund_matcher), allocations(fund_matcher))
+
+    fork = ForkedFundMatcher(fund_matcher)
+    assert fork._funds == {}
+
+    rng = random.Random(3)
+    amounts = [rng.uniform(5, 60) for _ in range(5)]
+    for target in (expected, fork):
+        target.expire_donation("donation_0")
+        target.reserve_funds(Donation("pledge_0", 30))
+        target.reserve_columns(["pledge_%s" % ix for ix in range(1, 6)], amounts)
+        target.collect_donations(["donation_2", "pledge_1"])
+        target.top_up("fund_3", 20)
+        target.reserve_funds(Donation("pledge_6", 10))
+        target.expire_donations(["pledge_2", "donation_3"])
+
+    assert (fund_balances(fund_matcher), allocations(fund_matcher)) == before
+    assert fund_balances(fork) == fund_balances(expected)
+
+    expected_pledges = [(donation_id, allocation, status) for donation_id, allocation, status in allocations(expected)
+                        if donation_id.startswith("pledge")]
+    assert allocations(fork) == expected_pledges
+
+    changes = fork.changes()
+    assert changes['reserved'] == ["pledge_%s" % ix for ix in range(7)]
+    assert changes['settled'] == {"donation_0": EXPIRED, "donation_2": COLLECTED, "donation_3": EXPIRED}
+    assert set(changes['funds']) <= {"fund_1", "fund_2", "fund_3", "fund_4"}
+    assert all(fund_matcher.match_funds[match_fund_id].total_amount == before_balance
+               for match_fund_id, (before_balance, _) in changes['funds'].items())
+
+    fork.commit()
+
+    assert fund_balances(fund_matcher) == fund_balances(expected)
+    assert allocations(fund_matcher) == allocations(expected)
+
+    with pytest.raises(BadRequestException):
+        fork.reserve_funds(Donation("pledge_7", 10))
+
+@pytest.mark.order(1402)
+def test_fork_conflicts_and_discard(fund_matcher):
+    """
+    test a fork cannot be committed once the matcher has moved on
+    test a discarded fork leaves the matcher as it was, and forks are independent
+    """
+    before = (fund_balances(fund_matcher), allocations(fund_matcher))
+
+    first = ForkedFundMatcher(fund_matcher)
+    second = ForkedFundMatcher(fund_matcher)
+    first.reserve_funds(Donation("pledge_1", 50))
+    second.reserve_funds(Donation("pledge_1", 20))
+    assert first.allocation_state["pledge_1"]['original_donation'] == 50
+    assert second.allocation_state["pledge_1"]['original_donation'] == 20
+
+    with pytest.raises(BadRequestException):
+        first.reserve_funds(Donation("donation_2", 10))
+    with pytest.raises(BadRequestException):
+        first.collect_donation("donation_1")
+    with pytest.raises(BadRequestException):
+        first.retire_match_fund("fund_1")
+    outcomes = first.collect_donations(["donation_2", "donation_1"])
+    assert str(outcomes[1]) == "Invalid collection request. Allocation is not reserved"
+    assert "donation_2" not in first.changes()['settled']
+
+    second.commit()
+    with pytest.raises(ConflictException):
+        first.commit()
+    first.discard()
+
+    third = ForkedFundMatcher(fund_matcher)
+    third.reserve_funds(Donation("pledge_2", 20))
+    fund_matcher.top_up("fund_2", 10)
+    with pytest.raises(ConflictException):
+        third.commit()
+    assert "pledge_2" not in fund_matcher.allocation_state
+    assert len(fund_matcher.allocation_state) == len(before[1]) + 1
+
+@pytest.mark.order(1403)
+def test_fork_of_fork_and_exact_engine(four_match_funds):
+    """
+    test a fork of a fork reads through both, and commits into its parent fork
+    test a fund run dry in the matcher is matched again once a fork refunds it
+    test forks keep the exact engine's minor unit arithmetic
+    """
+    fund_matcher = ExactFundMatcher(four_match_funds)
+    fund_matcher.reserve_funds(Donation("donation_0", 20))
+    assert fund_matcher.match_funds["fund_3"].total_amount == 0
+
+    fork = ForkedFundMatcher(fund_matcher)
+    fork.expire_donation("donation_0")
+    assert fork.match_funds["fund_3"].total_amount == 5000
+
+    nested = ForkedFundMatcher(fork)
+    nested.reserve_funds(Donation("pledge_1", 10.005))
+    assert nested.allocation_state["pledge_1"]['original_donation'] == 1000
+    assert [(a.match_fund_id, a.match_fund_allocation) for a in nested.allocation_state["pledge_1"]['allocations']] == \
+        [("fund_3", 3000)]
+    assert fork.match_funds["fund_3"].total_amount == 5000
+    assert fund_matcher.match_funds["fund_3"].total_amount == 0
+
+    nested.commit()
+    assert fork.allocation_state["pledge_1"]['overall_status'] == RESERVED
+    assert fork.match_funds["fund_3"].total_amount == 2000
+
+    expected = copy.deepcopy(fund_matcher)
+    expected.expire_donation("donation_0")
+    expected.reserve_funds(Donation("pledge_1", 10.005))
+
+    fork.commit()
+    assert fund_balances(fund_matcher) == fund_balances(expected)
+    assert allocations(fund_matcher) == allocations(expected)
+
+@pytest.mark.order(1404)
+def test_fork_rejects_what_it_cannot_commit(fund_matcher):
+    """
+    test a fork refuses fund registry changes and archiving, which it cannot commit
+    test a fork rejects bad top ups without recording them
+    test a discarded or committed fork refuses any further use
+    """
+    fork = ForkedFundMatcher(fund_matcher)
+    with pytest.raises(BadRequestException):
+        fork.add_match_fund(MatchFund("fund_5", 10, 2))
+    with pytest.raises(BadRequestException):
+        fork.reorder_match_fund("fund_1", 8)
+    with pytest.raises(BadRequestException):
+        fork.archive_settled(None)
+
+    with pytest.raises(BadRequestException):
+        fork.top_up("fund_1", 0)
+    with pytest.raises(BadRequestException):
+        fork.top_up("fund_5", 10)
+    with pytest.raises(BadRequestException):
+        fork.expire_donation("donation_1")
+    assert fork.changes() == {'funds': {}, 'reserved': [], 'settled': {}}
+
+    fork.discard()
+    with pytest.raises(BadRequestException):
+        fork.top_up("fund_1", 10)
+    with pytest.raises(BadRequestException):
+        fork.commit()
+
+    committed = ForkedFundMatcher(fund_matcher)
+    committed.top_up("fund_3", 10)
+    committed.commit()
+    assert fund_matcher.match_funds["fund_3"].total_amount == 10
+    with pytest.raises(BadRequestException):
+        committed.commit()
+    assert fund_matcher.match_funds["fund_3"].total_amount == 10
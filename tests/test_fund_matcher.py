@@ -2,83 +2,14 @@ from matcher.allocation import Allocation
 from matcher.match_fund import MatchFund
 from matcher.fund_matcher import FundMatcher
 from matcher.fund_matcher import RESERVED, COLLECTED, EXPIRED
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.money import ExactFundMatcher
 from matcher.donation import Donation
 from matcher.exceptions import BadRequestException
 
+import random
 import pytest
 
-@pytest.fixture
-def simple_match_funds():
-    """
-    fixture simple fund array without ratios (as default)
-    """
-
-    example_funds_data = [[
-        "fund_1",  # id
-        100.00,  # amount
-        3,  # order
-    ], [
-        "fund_2",
-        100.00,
-        7
-    ], [
-        "fund_3",
-        100.00,
-        1,
-    ]
-    ]
-    return [MatchFund(*ef) for ef in example_funds_data]
-
-@pytest.fixture
-def match_funds_with_ratios():
-    """
-    fixture fund arrays with ratios
-    """
-
-    example_funds_data = [[
-        "fund_1",  # id
-        100.00,  # amount
-        3,  # order
-        [1, 1]  # ratio
-    ], [
-        "fund_2",
-        100.00,
-        7,
-        [2, 1]
-    ], [
-        "fund_3",
-        100.00,
-        1,
-        [1, 1]
-    ]
-    ]
-    return [MatchFund(*ef) for ef in example_funds_data]
-
-@pytest.fixture
-def more_match_funds_with_ratios():
-    """
-    additional fixture fund arrays with ratios
-    """
-
-    example_funds_data = [[
-        "fund_1",  # id
-        100.00,  # amount
-        3,  # order
-        [2, 1]  # ratio
-    ], [
-        "fund_2",
-        100.00,
-        7,
-        [3, 1]
-    ], [
-        "fund_3",
-        100.00,
-        1,
-        [2, 1]
-    ]
-    ]
-    return [MatchFund(*ef) for ef in example_funds_data]
-
 @pytest.mark.order(301)
 def test_match_funds_are_sorted_by_match_order_correctly(simple_match_funds):
     """
@@ -433,4 +364,517 @@ def test_list_match_fund_allocations(simple_match_funds):
     assert allocations_list[0]['donation_id'] == min_expected_output[0]['donation_id']
     assert allocations_list[0]['allocations'] == min_expected_output[0]['allocations']
     assert allocations_list[1]['donation_id'] == min_expected_output[1]['donation_id']
-    assert allocations_list[1]['allocations'] == min_expected_output[1]['allocations']
\ No newline at end of file
+    assert allocations_list[1]['allocations'] == min_expected_output[1]['allocations']
+
+@pytest.mark.order(315)
+def test_exhausted_funds_leave_active_index(simple_match_funds):
+    """
+    test exhausted match funds are dropped from the active fund index
+    test the next donation is matched against the remaining funds in match_order
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    donation_1 = Donation("donation_1", 150)
+    donation_2 = Donation("donation_2", 20)
+
+    fund_matcher.reserve_funds(donation_1)
+
+    assert [key[2] for key in fund_matcher._active_funds] == ["fund_1", "fund_2"]
+
+    fund_matcher.reserve_funds(donation_2)
+
+    allocations = fund_matcher.allocation_state[donation_2.donation_id]['allocations']
+    assert len(allocations) == 1
+    assert allocations[0].match_fund_id == "fund_1"
+    assert allocations[0].match_fund_allocation == 20
+
+@pytest.mark.order(316)
+def test_expire_donation_reactivates_exhausted_fund(simple_match_funds):
+    """
+    test a refunded fund returns to the active fund index in match_order
+    test the refunded fund is used again before later funds
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    donation_1 = Donation("donation_1", 100)
+    donation_2 = Donation("donation_2", 150)
+    donation_3 = Donation("donation_3", 30)
+
+    fund_matcher.reserve_funds(donation_1)
+    fund_matcher.reserve_funds(donation_2)
+
+    assert [key[2] for key in fund_matcher._active_funds] == ["fund_2"]
+
+    fund_matcher.expire_donation(donation_1.donation_id)
+
+    assert [key[2] for key in fund_matcher._active_funds] == ["fund_3", "fund_2"]
+
+    fund_matcher.reserve_funds(donation_3)
+
+    allocations = fund_matcher.allocation_state[donation_3.donation_id]['allocations']
+    assert len(allocations) == 1
+    assert allocations[0].match_fund_id == "fund_3"
+
+@pytest.mark.order(317)
+def test_reserve_funds_batch_matches_sequential(more_match_funds_with_ratios):
+    """
+    test batched reservation gives the same allocations, balances and
+    unmatched amounts as reserving each donation in turn
+    """
+    amounts = [5, 12.5, 33.3, 7, 19.99, 41, 5.01, 60, 8]
+
+    sequential_matcher = FundMatcher(more_match_funds_with_ratios)
+    for ix, amount in enumerate(amounts):
+        sequential_matcher.reserve_funds(Donation("donation_%s" % ix, amount))
+
+    batch_funds = [MatchFund(mf.match_fund_id, 100.00, mf.match_order, mf.matching_ratio) for mf in more_match_funds_with_ratios]
+    batch_matcher = FundMatcher(batch_funds)
+    docs = batch_matcher.reserve_funds_batch([Donation("donation_%s" % ix, amount) for ix, amount in enumerate(amounts)])
+
+    assert len(docs) == len(amounts)
+
+    for ix in range(len(amounts)):
+        expected = sequential_matcher.allocation_state["donation_%s" % ix]
+        actual = batch_matcher.allocation_state["donation_%s" % ix]
+        assert [a.to_dict() for a in actual['allocations']] == [a.to_dict() for a in expected['allocations']]
+        assert actual['donation_balance_unmatched'] == expected['donation_balance_unmatched']
+
+    for expected, actual in zip(sequential_matcher.get_match_funds_as_list(), batch_matcher.get_match_funds_as_list()):
+        assert actual.total_amount == expected.total_amount
+
+@pytest.mark.order(318)
+def test_reserve_funds_batch_random_workload():
+    """
+    test batched reservation is identical to sequential reservation over a
+    larger random workload, including exhausting every fund
+    """
+    rng = random.Random(42)
+    funds_data = [["fund_%s" % ix, rng.uniform(50, 2000), rng.randint(0, 20), [rng.randint(1, 3), rng.randint(1, 2)]] for ix in range(40)]
+    amounts = [round(rng.uniform(5, 300), 2) for _ in range(2000)]
+
+    sequential_matcher = FundMatcher([MatchFund(*fd) for fd in funds_data])
+    for ix, amount in enumerate(amounts):
+        sequential_matcher.reserve_funds(Donation(ix, amount))
+
+    batch_matcher = FundMatcher([MatchFund(*fd) for fd in funds_data])
+    batch_matcher.reserve_funds_batch([Donation(ix, amount) for ix, amount in enumerate(amounts[:700])])
+    batch_matcher.reserve_funds_batch([Donation(ix + 700, amount) for ix, amount in enumerate(amounts[700:])])
+
+    for ix in range(len(amounts)):
+        expected = sequential_matcher.allocation_state[ix]
+        actual = batch_matcher.allocation_state[ix]
+        assert [a.to_dict() for a in actual['allocations']] == [a.to_dict() for a in expected['allocations']]
+        assert actual['donation_balance_unmatched'] == expected['donation_balance_unmatched']
+
+    for expected, actual in zip(sequential_matcher.get_match_funds_as_list(), batch_matcher.get_match_funds_as_list()):
+        assert actual.total_amount == expected.total_amount
+
+@pytest.mark.order(319)
+def test_list_match_fund_allocations_pages(simple_match_funds):
+    """
+    test pages of allocations follow on from the after_donation_id cursor
+    test expired donations are left out of every page
+    test status=RESERVED lists only reserved donations
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    for ix in range(6):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 20))
+
+    fund_matcher.expire_donation("donation_1")
+    fund_matcher.expire_donation("donation_2")
+    fund_matcher.collect_donation("donation_4")
+
+    first_page = fund_matcher.list_match_fund_allocations(limit=2)
+    second_page = fund_matcher.list_match_fund_allocations(limit=2, after_donation_id=first_page[-1]['donation_id'])
+    last_page = fund_matcher.list_match_fund_allocations(limit=2, after_donation_id=second_page[-1]['donation_id'])
+
+    assert [doc['donation_id'] for doc in first_page] == ["donation_0", "donation_3"]
+    assert [doc['donation_id'] for doc in second_page] == ["donation_4", "donation_5"]
+    assert last_page == []
+
+    reserved = fund_matcher.list_match_fund_allocations(status=RESERVED)
+    assert [doc['donation_id'] for doc in reserved] == ["donation_0", "donation_3", "donation_5"]
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.list_match_fund_allocations(after_donation_id="donation_9")
+
+@pytest.mark.order(320)
+def test_iter_match_fund_allocations(simple_match_funds):
+    """
+    test the generator yields the same documents as the list
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    for ix in range(4):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 20))
+    fund_matcher.expire_donation("donation_0")
+
+    iterator = fund_matcher.iter_match_fund_allocations()
+
+    assert next(iterator)['donation_id'] == "donation_1"
+    assert list(iterator) == fund_matcher.list_match_fund_allocations(after_donation_id="donation_1")
+
+@pytest.mark.order(321)
+def test_bulk_collect_and_expire(match_funds_with_ratios):
+    """
+    test bulk collect and expire give per id outcomes and share one timestamp
+    test refunds summed per fund leave the same balances as expiring one at a time
+    """
+    fund_matcher = FundMatcher(match_funds_with_ratios)
+    one_at_a_time = FundMatcher([MatchFund(mf.match_fund_id, 100.00, mf.match_order, mf.matching_ratio)
+                                 for mf in match_funds_with_ratios])
+
+    for ix in range(8):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 10 + ix))
+        one_at_a_time.reserve_funds(Donation("donation_%s" % ix, 10 + ix))
+
+    outcomes = fund_matcher.expire_donations(["donation_%s" % ix for ix in range(0, 8, 2)])
+    for ix in range(0, 8, 2):
+        one_at_a_time.expire_donation("donation_%s" % ix)
+
+    assert outcomes == [EXPIRED] * 4
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == \
+        pytest.approx([mf.total_amount for mf in one_at_a_time.get_match_funds_as_list()])
+    assert len(set(fund_matcher.allocation_state["donation_%s" % ix]['updated_time'] for ix in range(0, 8, 2))) == 1
+
+    outcomes = fund_matcher.collect_donations(["donation_1", "donation_3"])
+    assert outcomes == [COLLECTED, COLLECTED]
+    assert fund_matcher.allocation_state["donation_3"]['allocations'][0].status == COLLECTED
+
+@pytest.mark.order(322)
+def test_bulk_collect_is_all_or_nothing(simple_match_funds):
+    """
+    test one bad id means nothing is applied, and each id says why
+    test with atomic=False the valid ids are applied
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    for ix in range(4):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 10))
+    fund_matcher.expire_donation("donation_3")
+    totals = [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()]
+
+    donation_ids = ["donation_0", "missing", "donation_1", "donation_0", "donation_3"]
+    outcomes = fund_matcher.expire_donations(donation_ids)
+
+    assert all(isinstance(outcome, BadRequestException) for outcome in outcomes)
+    assert [str(outcome) for outcome in outcomes[1:]] == [
+        "Invalid donation id missing",
+        "Not applied, another donation id in the request was rejected",
+        "Duplicate donation id donation_0",
+        "Invalid collection request. Allocation is not reserved"
+    ]
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == totals
+    assert fund_matcher.allocation_state["donation_0"]['overall_status'] == RESERVED
+
+    outcomes = fund_matcher.collect_donations(donation_ids, atomic=False)
+
+    assert outcomes[0] == COLLECTED and outcomes[2] == COLLECTED
+    assert [isinstance(outcome, BadRequestException) for outcome in outcomes] == [False, True, False, True, True]
+    assert fund_matcher.allocation_state["donation_1"]['overall_status'] == COLLECTED
+    assert fund_matcher.collect_donations([]) == []
+
+@pytest.mark.order(323)
+def test_add_and_top_up_match_funds(simple_match_funds):
+    """
+    test a fund added mid-campaign is matched in its match_order
+    test topping up an exhausted fund puts it back into matching
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    fund_matcher.reserve_funds(Donation("donation_1", 100))
+
+    fund_matcher.add_match_fund(MatchFund("fund_4", 50.00, 1))
+    fund_matcher.add_match_fund(MatchFund("fund_5", 50.00, 0))
+
+    assert [mf.match_fund_id for mf in fund_matcher.get_match_funds_as_list()] == ["fund_5", "fund_3", "fund_4", "fund_1", "fund_2"]
+
+    fund_matcher.reserve_funds(Donation("donation_2", 120))
+    assert fund_matcher.allocation_state.matches(fund_matcher.allocation_state.row("donation_2")) == [
+        ("fund_5", 50.0), ("fund_4", 50.0), ("fund_1", 20.0)]
+
+    fund_matcher.top_up("fund_3", 30)
+    fund_matcher.reserve_funds(Donation("donation_3", 10))
+    assert fund_matcher.allocation_state["donation_3"]['allocations'][0].match_fund_id == "fund_3"
+    assert fund_matcher.match_funds["fund_3"].total_amount == 20
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.add_match_fund(MatchFund("fund_4", 10.00, 1))
+    with pytest.raises(BadRequestException):
+        fund_matcher.top_up("fund_3", -5)
+    with pytest.raises(BadRequestException):
+        fund_matcher.top_up("no_such_fund", 5)
+
+@pytest.mark.order(324)
+def test_retire_match_fund(simple_match_funds):
+    """
+    test a retired fund is never drawn from again and hands back its balance
+    test its reservations can still be collected, and expiring one credits it without reactivating it
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    fund_matcher.reserve_funds(Donation("donation_1", 60))
+    fund_matcher.reserve_funds(Donation("donation_2", 20))
+
+    assert fund_matcher.retire_match_fund("fund_3") == 20
+    assert fund_matcher.is_retired("fund_3")
+
+    fund_matcher.reserve_funds(Donation("donation_3", 10))
+    assert fund_matcher.allocation_state["donation_3"]['allocations'][0].match_fund_id == "fund_1"
+
+    fund_matcher.collect_donation("donation_2")
+    fund_matcher.expire_donation("donation_1")
+    assert fund_matcher.match_funds["fund_3"].total_amount == 60
+
+    fund_matcher.reserve_funds(Donation("donation_4", 10))
+    assert fund_matcher.allocation_state["donation_4"]['allocations'][0].match_fund_id == "fund_1"
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.retire_match_fund("fund_3")
+    with pytest.raises(BadRequestException):
+        fund_matcher.top_up("fund_3", 10)
+
+@pytest.mark.order(325)
+def test_reorder_match_fund(simple_match_funds):
+    """
+    test reordering changes which fund is drawn first, for funds with and without a balance
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+
+    fund_matcher.reorder_match_fund("fund_2", 0)
+    fund_matcher.reserve_funds(Donation("donation_1", 100))
+    assert fund_matcher.allocation_state["donation_1"]['allocations'][0].match_fund_id == "fund_2"
+    assert fund_matcher.match_funds["fund_2"].match_order == 0
+
+    fund_matcher.reorder_match_fund("fund_2", 9)
+    fund_matcher.reorder_match_fund("fund_1", 0)
+    assert [mf.match_fund_id for mf in fund_matcher.get_match_funds_as_list()] == ["fund_1", "fund_3", "fund_2"]
+
+    fund_matcher.expire_donation("donation_1")
+    fund_matcher.reserve_funds(Donation("donation_2", 150))
+    assert fund_matcher.allocation_state.matches(fund_matcher.allocation_state.row("donation_2")) == [
+        ("fund_1", 100.0), ("fund_3", 50.0)]
+
+@pytest.mark.order(326)
+def test_fund_summaries_match_a_full_scan(match_funds_with_ratios):
+    """
+    test running fund totals equal totals recomputed by walking every donation
+    test available + reserved + collected is what each fund was given
+    test the reverse index lists each fund's allocations by donation
+    """
+    rng = random.Random(5)
+    fund_matcher = FundMatcher(match_funds_with_ratios)
+    given = {mf.match_fund_id: mf.total_amount for mf in match_funds_with_ratios}
+
+    for ix in range(200):
+        donation_id = "donation_%s" % ix
+        fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 40)))
+        action = rng.random()
+        if action < 0.3:
+            fund_matcher.expire_donation(donation_id)
+        elif action < 0.5:
+            fund_matcher.collect_donation(donation_id)
+        if ix % 50 == 0:
+            fund_matcher.top_up("fund_2", 60)
+            given["fund_2"] += 60
+    given["fund_3"] -= fund_matcher.retire_match_fund("fund_3")
+
+    scanned = {}
+    for donation_id in fund_matcher.allocation_state:
+        for a in fund_matcher.allocation_state[donation_id]['allocations']:
+            key = (a.match_fund_id, a.status)
+            scanned[key] = scanned.get(key, 0) + a.match_fund_allocation
+
+    summary = fund_matcher.get_summary()
+    assert [fund['match_fund_id'] for fund in summary['funds']] == ["fund_3", "fund_1", "fund_2"]
+
+    for fund in summary['funds']:
+        match_fund_id = fund['match_fund_id']
+        assert fund == fund_matcher.get_fund_summary(match_fund_id)
+        assert fund['reserved'] == pytest.approx(scanned.get((match_fund_id, RESERVED), 0))
+        assert fund['collected'] == pytest.approx(scanned.get((match_fund_id, COLLECTED), 0))
+        assert fund['expired'] == pytest.approx(scanned.get((match_fund_id, EXPIRED), 0))
+        assert fund['available'] + fund['reserved'] + fund['collected'] == pytest.approx(given[match_fund_id])
+
+        allocations = list(fund_matcher.iter_fund_allocations(match_fund_id, status=COLLECTED))
+        assert len(allocations) == fund['collected_allocations']
+        assert all(a['donation_id'] in fund_matcher.allocation_state for a in allocations)
+
+    assert summary['funds'][0]['retired']
+    assert summary['reserved'] == pytest.approx(sum(fund['reserved'] for fund in summary['funds']))
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.get_fund_summary("no_such_fund")
+    with pytest.raises(BadRequestException):
+        list(fund_matcher.iter_fund_allocations("fund_1", status="Pending"))
+
+@pytest.mark.order(327)
+def test_reserve_columns(match_funds_with_ratios):
+    """
+    test reserving columns allocates exactly as reserving Donation objects
+    test an invalid amount rejects the whole call, leaving the funds untouched
+    """
+    rng = random.Random(7)
+    amounts = [round(rng.uniform(5, 80), 2) for _ in range(40)]
+    donation_ids = ["donation_%s" % ix for ix in range(len(amounts))]
+
+    expected = FundMatcher([MatchFund(mf.match_fund_id, mf.total_amount, mf.match_order, mf.matching_ratio)
+                            for mf in match_funds_with_ratios])
+    expected.reserve_funds_batch([Donation(*donation) for donation in zip(donation_ids, amounts)])
+
+    fund_matcher = FundMatcher(match_funds_with_ratios)
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_columns(["donation_a", "donation_b"], ["10", "4.99"])
+    assert len(fund_matcher.allocation_state) == 0
+
+    allocation_state_docs = fund_matcher.reserve_columns(donation_ids, [str(amount) for amount in amounts])
+
+    assert [fund_matcher.allocation_state.donation_id(doc.row) for doc in allocation_state_docs] == donation_ids
+    for actual_doc, expected_doc in zip(fund_matcher.list_match_fund_allocations(), expected.list_match_fund_allocations()):
+        assert (actual_doc['allocations'], actual_doc['donation_balance_unmatched']) == \
+            (expected_doc['allocations'], expected_doc['donation_balance_unmatched'])
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == \
+        [mf.total_amount for mf in expected.get_match_funds_as_list()]
+
+@pytest.mark.order(328)
+def test_reserve_is_idempotent(match_funds_with_ratios):
+    """
+    test a retried reservation returns the original result and leaves the balances alone
+    test a retry with a different amount is rejected
+    test retries in a batch, of earlier donations or within the batch, are matched once
+    """
+    fund_matcher = FundMatcher(match_funds_with_ratios)
+
+    first = fund_matcher.reserve_funds(Donation("donation_1", 30))
+    balances = [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()]
+
+    retry = fund_matcher.reserve_funds(Donation("donation_1", 30))
+    assert retry.row == first.row
+    assert [(a.match_fund_id, a.match_fund_allocation) for a in retry['allocations']] == \
+        [(a.match_fund_id, a.match_fund_allocation) for a in first['allocations']]
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == balances
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_funds(Donation("donation_1", 31))
+
+    fund_matcher.collect_donation("donation_1")
+    assert fund_matcher.reserve_funds(Donation("donation_1", 30))['overall_status'] == COLLECTED
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_funds_batch([Donation("donation_2", 10), Donation("donation_1", 20)])
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_funds_batch([Donation("donation_2", 10), Donation("donation_2", 20)])
+    assert "donation_2" not in fund_matcher.allocation_state
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == balances
+
+    allocation_state_docs = fund_matcher.reserve_funds_batch(
+        [Donation("donation_2", 10), Donation("donation_1", 30), Donation("donation_2", 10), Donation("donation_3", 15)])
+    assert [doc.row for doc in allocation_state_docs] == \
+        [fund_matcher.allocation_state.row(donation_id) for donation_id in ("donation_2", "donation_1", "donation_2", "donation_3")]
+
+    expected = FundMatcher([MatchFund(mf.match_fund_id, 100.00, mf.match_order, mf.matching_ratio)
+                            for mf in match_funds_with_ratios])
+    for donation in (Donation("donation_1", 30), Donation("donation_2", 10), Donation("donation_3", 15)):
+        expected.reserve_funds(donation)
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == \
+        [mf.total_amount for mf in expected.get_match_funds_as_list()]
+    assert len(fund_matcher.allocation_state) == 3
+
+def matched(doc):
+    return [(a.match_fund_id, a.match_fund_allocation, a.status) for a in doc['allocations']]
+
+@pytest.mark.order(329)
+def test_backfill_released_funds(simple_match_funds):
+    """
+    test released funds are matched against under-matched reserved donations, oldest first
+    test collected donations are not backfilled
+    test backfilled allocations show in the listings and summaries, and are refunded on expiry
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    fund_matcher.reserve_funds(Donation("donation_0", 200))
+    fund_matcher.reserve_funds(Donation("donation_1", 150))
+    fund_matcher.reserve_funds(Donation("donation_2", 80))
+    fund_matcher.reserve_funds(Donation("donation_3", 30))
+    fund_matcher.enable_backfill()
+    fund_matcher.collect_donation("donation_3")
+
+    fund_matcher.expire_donation("donation_0")
+
+    assert matched(fund_matcher.get_allocation("donation_1")) == [("fund_2", 100.0, RESERVED), ("fund_3", 50.0, RESERVED)]
+    assert fund_matcher.get_allocation("donation_1")['donation_balance_unmatched'] == 0
+    assert matched(fund_matcher.get_allocation("donation_2")) == [("fund_3", 50.0, RESERVED), ("fund_1", 30.0, RESERVED)]
+    assert fund_matcher.get_allocation("donation_2")['donation_balance_unmatched'] == 0
+    assert matched(fund_matcher.get_allocation("donation_3")) == []
+    assert fund_matcher.get_allocation("donation_3")['donation_balance_unmatched'] == 30
+
+    fund_1 = fund_matcher.get_fund_summary("fund_1")
+    assert (fund_1['available'], fund_1['reserved'], fund_1['expired']) == (70.0, 30.0, 100.0)
+    assert [a['donation_id'] for a in fund_matcher.iter_fund_allocations("fund_3", status=RESERVED)] == \
+        ["donation_1", "donation_2"]
+    assert [doc['donation_id'] for doc in fund_matcher.list_match_fund_allocations(status=RESERVED)] == \
+        ["donation_1", "donation_2"]
+
+    fund_matcher.expire_donation("donation_2")
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == [50.0, 100.0, 0]
+    assert fund_matcher.get_summary()['reserved'] == 150.0
+
+    # a fund added or topped up backfills as a release does
+    fund_matcher.reserve_funds(Donation("donation_4", 200))
+    fund_matcher.top_up("fund_2", 20)
+    assert matched(fund_matcher.get_allocation("donation_4"))[-1] == ("fund_2", 20.0, RESERVED)
+    fund_matcher.add_match_fund(MatchFund("fund_4", 500.00, 9))
+    assert fund_matcher.get_allocation("donation_4")['donation_balance_unmatched'] == 0
+    assert fund_matcher.get_fund_summary("fund_4")['reserved'] == 30.0
+
+@pytest.mark.order(330)
+@pytest.mark.parametrize("matcher_class", [FundMatcher, ExactFundMatcher, ConcurrentFundMatcher])
+def test_backfill_random_workload(match_funds_with_ratios, matcher_class):
+    """
+    test no reserved donation is left under-matched while a fund has a balance
+    test fund summaries stay consistent with what each fund was given
+    """
+    rng = random.Random(8)
+    fund_matcher = matcher_class(match_funds_with_ratios)
+    fund_matcher.enable_backfill()
+    given = {mf.match_fund_id: 100.0 for mf in match_funds_with_ratios}
+
+    for ix in range(300):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, rng.uniform(5, 60)))
+        action = rng.random()
+        earlier = "donation_%s" % rng.randrange(ix + 1)
+        if fund_matcher.donation_status(earlier) == RESERVED:
+            if action < 0.3:
+                fund_matcher.expire_donation(earlier)
+            elif action < 0.5:
+                fund_matcher.collect_donation(earlier)
+        if ix % 40 == 0:
+            fund_matcher.top_up("fund_1", 30)
+            given["fund_1"] += 30
+        if ix % 25 == 0:
+            fund_matcher.expire_donations([donation_id for donation_id in fund_matcher.allocation_state
+                                           if fund_matcher.donation_status(donation_id) == RESERVED][:3])
+
+        under_matched = [doc['donation_id'] for doc in fund_matcher.list_match_fund_allocations(status=RESERVED)
+                         if doc['donation_balance_unmatched'] != 0]
+        assert not under_matched or all(mf.total_amount == 0 for mf in fund_matcher.get_match_funds_as_list())
+
+    for fund in fund_matcher.get_summary()['funds']:
+        assert fund['available'] + fund['reserved'] + fund['collected'] == \
+            pytest.approx(fund_matcher._amount(given[fund['match_fund_id']]))
+
+@pytest.mark.order(331)
+def test_backfill_cost_follows_donations_backfilled():
+    """
+    test a release only matches against the donations it backfills, not every reserved donation
+    """
+    fund_matcher = FundMatcher([MatchFund("fund_1", 5000.00, 1)])
+    fund_matcher.enable_backfill()
+    for ix in range(900):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 5))
+    for ix, amount in enumerate([400, 300, 200]):
+        fund_matcher.reserve_funds(Donation("large_%s" % ix, amount))
+    assert list(fund_matcher._backfill_queue) == ["large_1", "large_2"]
+
+    draws = []
+    match_amount = fund_matcher._match_amount
+    fund_matcher._match_amount = lambda donation_balance: draws.append(donation_balance) or match_amount(donation_balance)
+    fund_matcher.expire_donation("donation_0")
+    fund_matcher.expire_donation("donation_1")
+
+    assert draws == [200.0, 195.0]
+    assert list(fund_matcher._backfill_queue) == ["large_1", "large_2"]
+    assert fund_matcher.get_allocation("large_1")['donation_balance_unmatched'] == 190.0
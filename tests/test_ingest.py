@@ -0,0 +1,139 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.ingest import ingest, iter_records, read_match_funds, AllocationWriter, RejectWriter, CSV, NDJSON
+from matcher.__main__ import main
+
+import csv
+import io
+import json
+import pytest
+
+FUNDS_CSV = """match_fund_id,total_amount,match_order,match_ratio
+fund_1,100.00,3,1:1
+fund_2,300.00,7,2:1
+fund_3,50.00,1,
+"""
+
+DONATIONS_CSV = """donation_id,amount
+donation_1,20
+donation_2,abc
+donation_3,1.50
+donation_1,30
+,40
+donation_4,200
+"""
+
+@pytest.mark.order(1201)
+def test_ingest_matches_reserve_funds(simple_match_funds):
+    """
+    test streamed chunks allocate exactly as reserving each donation in turn
+    test bad rows are rejected with their line and reason, and the run carries on
+    """
+    fund_matcher = FundMatcher(simple_match_funds)
+    output = io.StringIO()
+    rejects = io.StringIO()
+    chunks = []
+
+    stats = ingest(fund_matcher, iter_records(io.StringIO(DONATIONS_CSV), CSV), AllocationWriter(output, NDJSON),
+                   RejectWriter(rejects), chunk_size=2, progress=lambda stats: chunks.append(stats.rows))
+
+    assert (stats.rows, stats.reserved, stats.rejected, stats.chunks) == (6, 2, 4, 3)
+    assert chunks == [2, 4, 6]
+
+    expected = FundMatcher([MatchFund("fund_%s" % ix, 100.00, order) for ix, order in ((1, 3), (2, 7), (3, 1))])
+    expected.reserve_funds(Donation("donation_1", 20))
+    expected.reserve_funds(Donation("donation_4", 200))
+    written = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(doc['donation_id'], doc['allocations']) for doc in written] == \
+        [(doc['donation_id'], doc['allocations']) for doc in expected.list_match_fund_allocations()]
+
+    rejected = list(csv.DictReader(io.StringIO(rejects.getvalue())))
+    assert [(row['line'], row['donation_id']) for row in rejected] == \
+        [("3", "donation_2"), ("4", "donation_3"), ("5", "donation_1"), ("6", "")]
+    assert rejected[0]['error'].startswith("Amount cannot be expressed as a float")
+    assert rejected[2]['error'] == "Duplicate donation id donation_1"
+
+@pytest.mark.order(1202)
+def test_ingest_reads_ndjson_and_funds(tmp_path):
+    """
+    test match funds are read with their ratios, and a bad fund is an error
+    test unparseable NDJSON lines are rejected rather than aborting the run
+    """
+    funds_path = tmp_path / "funds.csv"
+    funds_path.write_text(FUNDS_CSV)
+    match_funds = read_match_funds(str(funds_path))
+    assert [(mf.match_fund_id, mf.total_amount, mf.match_order, mf.matching_ratio) for mf in match_funds] == \
+        [("fund_1", 100.0, 3, [1, 1]), ("fund_2", 300.0, 7, [2, 1]), ("fund_3", 50.0, 1, [1, 1])]
+
+    bad_funds_path = tmp_path / "bad_funds.ndjson"
+    bad_funds_path.write_text('{"match_fund_id": "fund_1", "total_amount": 10, "match_order": "first"}\n')
+    with pytest.raises(BadRequestException, match="line 1: Invalid match fund fund_1, Match order must be an integer"):
+        read_match_funds(str(bad_funds_path))
+    bad_funds_path.write_text(FUNDS_CSV.replace("300.00", "-300.00"))
+    with pytest.raises(BadRequestException, match="line 3: Invalid match fund fund_2, Total amount cannot be negative"):
+        read_match_funds(str(bad_funds_path), CSV)
+
+    donations = io.StringIO('{"donation_id": "donation_1", "amount": 10}\n\n{"donation_id": \n[1, 2]\n')
+    fund_matcher = FundMatcher(match_funds)
+    stats = ingest(fund_matcher, iter_records(donations, NDJSON))
+    assert (stats.rows, stats.reserved, stats.rejected) == (3, 1, 2)
+    assert fund_matcher.allocation_state["donation_1"]['overall_status'] == "Reserved"
+
+@pytest.mark.order(1203)
+def test_cli(tmp_path, capsys):
+    """
+    test the command line writes allocations, rejects and an exit status
+    """
+    funds_path = tmp_path / "funds.csv"
+    funds_path.write_text(FUNDS_CSV)
+    donations_path = tmp_path / "donations.csv"
+    donations_path.write_text(DONATIONS_CSV)
+    output_path = tmp_path / "allocations.csv"
+    rejects_path = tmp_path / "rejects.csv"
+
+    assert main(["--funds", str(funds_path), str(donations_path), "--output", str(output_path),
+                 "--rejects", str(rejects_path), "--chunk-size", "4"]) == 0
+    assert "6 rows, 2 reserved, 4 rejected" in capsys.readouterr().err
+
+    allocations = list(csv.DictReader(output_path.open()))
+    assert [(row['donation_id'], row['match_fund_id'], float(row['match_fund_allocation'])) for row in allocations] == \
+        [("donation_1", "fund_3", 20.0), ("donation_4", "fund_3", 30.0), ("donation_4", "fund_1", 100.0),
+         ("donation_4", "fund_2", 140.0)]
+    assert len(list(csv.DictReader(rejects_path.open()))) == 4
+
+    assert main(["--funds", str(funds_path), str(donations_path), "--output", str(output_path), "--rejects", "-"]) == 0
+    rejects = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    assert [row['line'] for row in rejects] == ["3", "4", "5", "6"]
+    with pytest.raises(SystemExit):
+        main(["--funds", str(funds_path), str(donations_path), "--rejects", "-"])
+    assert "cannot both be stdout" in capsys.readouterr().err
+
+    assert main(["--funds", str(tmp_path / "missing.csv"), str(donations_path)]) == 2
+    assert "error" in capsys.readouterr().err
+
+@pytest.mark.order(1204)
+def test_cli_rejects_unreadable_lines(tmp_path, capsys):
+    """
+    test lines with bytes that are not UTF-8, or that break the CSV reader, are rejected and the run carries on
+    """
+    funds_path = tmp_path / "funds.csv"
+    funds_path.write_text(FUNDS_CSV)
+    donations_path = tmp_path / "donations.csv"
+    donations_path.write_bytes(b"donation_id,amount\ndonation_1,20\ndonation_\xff,20\ndonation_2,"
+                               + b"1" * 200000 + b"\ndonation_3,30\n")
+    ndjson_path = tmp_path / "donations.ndjson"
+    ndjson_path.write_bytes(b'{"donation_id": "donation_1", "amount": 20}\n{"donation_id": "\xe9", "amount": 20}\n')
+    output_path = tmp_path / "allocations.csv"
+    rejects_path = tmp_path / "rejects.csv"
+
+    assert main(["--funds", str(funds_path), str(donations_path), "--output", str(output_path),
+                 "--rejects", str(rejects_path)]) == 0
+    assert "4 rows, 2 reserved, 2 rejected" in capsys.readouterr().err
+    rejects = list(csv.DictReader(rejects_path.open()))
+    assert [(row['line'], row['error']) for row in rejects] == \
+        [("3", "Invalid UTF-8 in line 3"), ("4", "Invalid CSV, field larger than field limit (131072)")]
+
+    assert main(["--funds", str(funds_path), str(ndjson_path), "--output", str(output_path)]) == 0
+    assert "2 rows, 1 reserved, 1 rejected" in capsys.readouterr().err
@@ -0,0 +1,94 @@
+from matcher.fund_matcher import FundMatcher
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.metrics import InstrumentedFundMatcher, Metrics, Histogram, LATENCY, REJECTED, MATCH, FUND_EXHAUSTED, FULL, PARTIAL, UNMATCHED
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+
+import pytest
+
+@pytest.mark.order(1001)
+def test_histogram_percentiles():
+    """
+    test values land in the bucket of their upper bound, and overflow reports the maximum
+    """
+    histogram = Histogram((1, 2, 4, 8))
+
+    for value in [1, 1, 2, 3, 3, 3, 5, 7, 8, 20]:
+        histogram.record(value)
+
+    assert histogram.buckets == [2, 1, 3, 3, 1]
+    assert histogram.percentile(50) == 4
+    assert histogram.percentile(90) == 8
+    assert histogram.percentile(100) == 20
+    assert histogram.to_dict()['count'] == 10
+    assert Histogram((1, 2)).percentile(50) is None
+
+@pytest.mark.order(1002)
+def test_metrics_count_matches_exhaustions_and_rejects(simple_match_funds):
+    """
+    test full, partial and unmatched reservations, funds scanned and exhausted funds
+    test rejected requests are counted and still raised
+    """
+    fund_matcher = InstrumentedFundMatcher(FundMatcher(simple_match_funds))
+
+    fund_matcher.reserve_funds(Donation("donation_1", 150))
+    fund_matcher.reserve_funds(Donation("donation_2", 100))
+    fund_matcher.reserve_funds(Donation("donation_3", 100))
+    fund_matcher.reserve_funds(Donation("donation_4", 20))
+    fund_matcher.collect_donation("donation_1")
+    fund_matcher.list_match_fund_allocations(limit=2)
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.collect_donation("donation_1")
+    with pytest.raises(BadRequestException):
+        fund_matcher.expire_donation("no_such_donation")
+
+    snapshot = fund_matcher.metrics.snapshot()
+
+    assert snapshot['matches'] == {FULL: 2, PARTIAL: 1, UNMATCHED: 1}
+    assert snapshot['funds_scanned']['count'] == 4
+    assert snapshot['funds_scanned']['max'] == 2
+    assert snapshot['fund_exhaustions_by_fund'] == {"fund_3": 1, "fund_1": 1, "fund_2": 1}
+    assert snapshot['rejected'] == 2
+    assert snapshot['operations']['collect_donation']['rejected'] == 1
+    assert snapshot['operations']['expire_donation']['rejected'] == 1
+    assert snapshot['operations']['reserve_funds']['latency']['count'] == 4
+    assert snapshot['operations']['collect_donation']['latency']['count'] == 2
+    assert snapshot['operations']['list_match_fund_allocations']['latency']['count'] == 1
+
+    # other attributes pass through to the matcher
+    assert fund_matcher.get_match_funds_as_list()[0].match_fund_id == "fund_3"
+
+@pytest.mark.order(1003)
+def test_metrics_push_to_listeners_and_disable(simple_match_funds):
+    """
+    test listeners receive each event as it happens
+    test batched reservations count a drained fund once
+    test nothing is recorded while disabled
+    """
+    metrics = Metrics()
+    events = []
+    metrics.add_listener(lambda event, value, labels: events.append((event, labels)))
+    fund_matcher = InstrumentedFundMatcher(ConcurrentFundMatcher(simple_match_funds), metrics)
+
+    fund_matcher.reserve_funds_batch([Donation("donation_%s" % ix, 40) for ix in range(4)])
+
+    assert (FUND_EXHAUSTED, {'match_fund_id': "fund_3"}) in events
+    assert [e for e in events if e[0] == FUND_EXHAUSTED] == [(FUND_EXHAUSTED, {'match_fund_id': "fund_3"})]
+    assert [e for e in events if e[0] == MATCH] == [(MATCH, {'outcome': FULL})] * 4
+    assert (LATENCY, {'operation': "reserve_funds_batch"}) in events
+
+    with pytest.raises(BadRequestException):
+        fund_matcher.collect_donation("no_such_donation")
+    assert events[-2][0] == REJECTED
+    assert events[-2][1]['operation'] == "collect_donation"
+
+    metrics.enabled = False
+    event_count = len(events)
+    fund_matcher.reserve_funds(Donation("donation_5", 40))
+    fund_matcher.expire_donation("donation_5")
+    assert len(events) == event_count
+    assert metrics.snapshot()['operations']['reserve_funds']['latency']['count'] == 0
+
+    metrics.reset()
+    assert metrics.snapshot()['matches'] == {FULL: 0, PARTIAL: 0, UNMATCHED: 0}
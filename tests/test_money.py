@@ -0,0 +1,112 @@
+from matcher.match_fund import MatchFund
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.money import ExactFundMatcher, to_minor_units, from_minor_units, ratio_as_fraction, divide, divide_array
+from decimal import Decimal, ROUND_DOWN, ROUND_UP, ROUND_HALF_EVEN, ROUND_HALF_UP
+from fractions import Fraction
+
+import numpy as np
+import random
+import pytest
+
+@pytest.mark.order(901)
+def test_to_minor_units_rounding():
+    """
+    test amounts convert through their decimal representation, rounding half to even
+    """
+
+    assert to_minor_units(12.34) == 1234
+    assert to_minor_units(0.125) == 12
+    assert to_minor_units(0.135) == 14
+    assert to_minor_units("19.999") == 2000
+    assert to_minor_units(5, minor_units=1000) == 5000
+    assert from_minor_units(1234) == Decimal("12.34")
+
+    with pytest.raises(BadRequestException):
+        to_minor_units("500g")
+
+@pytest.mark.order(902)
+def test_divide_rounding_modes():
+    """
+    test integer division follows each rounding mode, for scalars and arrays
+    """
+
+    cases = [(7, 2), (5, 2), (9, 3), (10, 4), (1, 3)]
+    expected = {
+        ROUND_DOWN: [3, 2, 3, 2, 0],
+        ROUND_UP: [4, 3, 3, 3, 1],
+        ROUND_HALF_UP: [4, 3, 3, 3, 0],
+        ROUND_HALF_EVEN: [4, 2, 3, 2, 0]
+    }
+
+    for rounding, quotients in expected.items():
+        assert [divide(n, d, rounding) for n, d in cases] == quotients
+
+    numerators = np.array([7, 5, 10, 1], dtype=np.int64)
+    assert divide_array(numerators, 2, ROUND_HALF_EVEN).tolist() == [4, 2, 5, 0]
+    assert ratio_as_fraction([1.5, 1]) == Fraction(3, 2)
+
+@pytest.mark.order(903)
+def test_exact_matcher_uses_minor_units(more_match_funds_with_ratios):
+    """
+    test balances and allocations are integer minor units
+    test a partial match at 3:1 leaves an exact unmatched balance
+    """
+    fund_matcher = ExactFundMatcher(more_match_funds_with_ratios)
+
+    fund_matcher.reserve_funds(Donation("donation_1", 60))
+    fund_matcher.reserve_funds(Donation("donation_2", 33.33))
+
+    record_1 = fund_matcher.allocation_state["donation_1"]
+    assert [a.to_dict() for a in record_1['allocations']] == [
+        {"match_fund_id": "fund_3", "match_fund_allocation": 10000, "status": "Reserved"},
+        {"match_fund_id": "fund_1", "match_fund_allocation": 2000, "status": "Reserved"}
+    ]
+    assert record_1['donation_balance_unmatched'] == 0
+
+    record_2 = fund_matcher.allocation_state["donation_2"]
+    # 8000 left in fund_1 at 2:1 covers 4000 of 3333; the match owed is 6666
+    assert [a.match_fund_allocation for a in record_2['allocations']] == [6666]
+    assert all(isinstance(mf.total_amount, int) for mf in fund_matcher.get_match_funds_as_list())
+    assert [mf.total_amount for mf in fund_matcher.get_match_funds_as_list()] == [0, 1334, 10000]
+
+@pytest.mark.order(904)
+def test_exact_matcher_conserves_every_minor_unit():
+    """
+    test fund balances plus live allocations equal the starting amounts exactly
+    after reservations, expiries and exhausting funds with awkward ratios
+    test batched reservation gives identical results
+    """
+    rng = random.Random(11)
+    funds_data = [["fund_%s" % ix, round(rng.uniform(50, 500), 2), rng.randint(0, 5), [rng.randint(1, 7), rng.randint(1, 3)]]
+                  for ix in range(15)]
+    amounts = [round(rng.uniform(5, 120), 2) for _ in range(600)]
+
+    sequential_matcher = ExactFundMatcher([MatchFund(*fd) for fd in funds_data])
+    for ix, amount in enumerate(amounts):
+        sequential_matcher.reserve_funds(Donation(ix, amount))
+        if ix % 4 == 3:
+            sequential_matcher.expire_donation(ix - 3)
+
+    batch_matcher = ExactFundMatcher([MatchFund(*fd) for fd in funds_data])
+    for start in range(0, len(amounts), 4):
+        batch_matcher.reserve_funds_batch([Donation(ix, amounts[ix]) for ix in range(start, start + 4)])
+        batch_matcher.expire_donation(start)
+
+    for fund_matcher in (sequential_matcher, batch_matcher):
+        allocated = {}
+        for donation_id in fund_matcher.allocation_state:
+            record = fund_matcher.allocation_state[donation_id]
+            if record['overall_status'] != "Expired":
+                for a in record['allocations']:
+                    allocated[a.match_fund_id] = allocated.get(a.match_fund_id, 0) + a.match_fund_allocation
+
+        for mf in fund_matcher.get_match_funds_as_list():
+            assert mf.total_amount + allocated.get(mf.match_fund_id, 0) == to_minor_units(
+                [fd[1] for fd in funds_data if fd[0] == mf.match_fund_id][0])
+
+    assert [mf.total_amount for mf in batch_matcher.get_match_funds_as_list()] == \
+        [mf.total_amount for mf in sequential_matcher.get_match_funds_as_list()]
+    for ix in range(len(amounts)):
+        assert batch_matcher.allocation_state.matches(batch_matcher.allocation_state.row(ix)) == \
+            sequential_matcher.allocation_state.matches(sequential_matcher.allocation_state.row(ix))
@@ -0,0 +1,156 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher, EXPIRED
+from matcher.shared_funds import SharedFundTable, SharedFundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+
+import copy
+import multiprocessing
+import random
+import pytest
+
+@pytest.fixture
+def mixed_match_funds():
+    """
+    fixture of funds with mixed ratios and shared match orders
+    """
+
+    rng = random.Random(5)
+    return [MatchFund("fund_%s" % ix, rng.choice([50.00, 200.00, 1000.00]), rng.randint(0, 5), [rng.randint(1, 3), 1])
+            for ix in range(12)]
+
+@pytest.fixture
+def table(mixed_match_funds):
+    """
+    fixture shared fund table, freed after the test
+    """
+
+    table = SharedFundTable(copy.deepcopy(mixed_match_funds))
+    yield table
+    table.close()
+
+def fund_balances(fund_matcher):
+    return [(mf.match_fund_id, mf.total_amount) for mf in fund_matcher.get_match_funds_as_list()]
+
+def allocations(fund_matcher):
+    return [(doc['donation_id'], doc['allocations'], doc['overall_status'])
+            for doc in fund_matcher.list_match_fund_allocations()]
+
+def reserve_in_process(table, process_ix, count, results):
+    fund_matcher = SharedFundMatcher(table)
+    rng = random.Random(process_ix)
+    for ix in range(count):
+        donation_id = "donation_%s_%s" % (process_ix, ix)
+        fund_matcher.reserve_funds(Donation(donation_id, rng.uniform(5, 80)))
+        if rng.random() < 0.3:
+            fund_matcher.expire_donation(donation_id)
+    fund_matcher.reserve_funds_batch([Donation("batch_%s_%s" % (process_ix, ix), 20) for ix in range(20)])
+
+    results.put([(donation_id, doc['overall_status'], [(a.match_fund_id, a.match_fund_allocation)
+                                                       for a in doc['allocations']])
+                 for donation_id, doc in fund_matcher.allocation_state.items()])
+
+@pytest.mark.order(1801)
+def test_shared_matcher_matches_as_fund_matcher(mixed_match_funds, table):
+    """
+    test a shared matcher in one process gives the results of a FundMatcher, through refunds and top ups
+    test quotes leave the table alone
+    test the fund registry cannot be changed
+    """
+    fund_matcher = FundMatcher(mixed_match_funds)
+    shared_matcher = SharedFundMatcher(table)
+
+    rng = random.Random(2)
+    for target in (fund_matcher, shared_matcher):
+        rng.seed(2)
+        for ix in range(150):
+            target.reserve_funds(Donation("donation_%s" % ix, rng.uniform(5, 100)))
+            if ix % 4 == 0:
+                target.expire_donation("donation_%s" % (ix // 2))
+        target.collect_donations(["donation_%s" % ix for ix in range(1, 150, 4)])
+        target.top_up("fund_3", 500)
+        target.reserve_funds_batch([Donation("batch_%s" % ix, rng.uniform(5, 100)) for ix in range(30)])
+
+    assert fund_balances(shared_matcher) == fund_balances(fund_matcher)
+    assert allocations(shared_matcher) == allocations(fund_matcher)
+    assert shared_matcher.get_summary() == fund_matcher.get_summary()
+    assert fund_balances(SharedFundMatcher(table)) == fund_balances(fund_matcher)
+
+    for breakdown in (False, True):
+        assert shared_matcher.quote(250, breakdown) == fund_matcher.quote(250, breakdown)
+    assert fund_balances(shared_matcher) == fund_balances(fund_matcher)
+
+    with pytest.raises(BadRequestException):
+        shared_matcher.add_match_fund(MatchFund("fund_new", 10, 1))
+    with pytest.raises(BadRequestException):
+        shared_matcher.retire_match_fund("fund_1")
+    with pytest.raises(BadRequestException):
+        shared_matcher.reorder_match_fund("fund_1", 9)
+
+@pytest.mark.order(1802)
+def test_shared_table_across_processes(mixed_match_funds, table):
+    """
+    test processes reserving against one table never over-allocate, and every fund balances exactly
+    (initial total == balance + live allocations across processes)
+    test every donation draws from funds in match_order
+    """
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=reserve_in_process, args=(table, ix, 150, results)) for ix in range(3)]
+    for process in processes:
+        process.start()
+    donations = [donation for _ in processes for donation in results.get(timeout=60)]
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+
+    fund_matcher = SharedFundMatcher(table)
+    initial_totals = {mf.match_fund_id: mf.total_amount for mf in mixed_match_funds}
+    allocated = {match_fund_id: 0 for match_fund_id in initial_totals}
+    for _, status, matches in donations:
+        if status != EXPIRED:
+            for match_fund_id, amount in matches:
+                allocated[match_fund_id] += amount
+
+    for match_fund_id, initial_total in initial_totals.items():
+        balance = fund_matcher.match_funds[match_fund_id].total_amount
+        assert balance >= 0
+        assert balance + allocated[match_fund_id] == pytest.approx(initial_total)
+
+    positions = {key[2]: position for position, key in enumerate(fund_matcher._fund_order)}
+    for _, _, matches in donations:
+        drawn = [positions[match_fund_id] for match_fund_id, _ in matches]
+        assert drawn == sorted(drawn)
+    assert len(donations) == 3 * 170
+    assert sum(allocated.values()) > 0.9 * sum(initial_totals.values())
+
+@pytest.mark.order(1803)
+def test_shared_table_front_and_errors():
+    """
+    test a table refuses duplicate fund ids
+    test funds run dry move the table's front on, and a top up of one brings it back
+    test bad top ups leave the table alone
+    """
+    with pytest.raises(BadRequestException):
+        SharedFundTable([MatchFund("fund_1", 10, 1), MatchFund("fund_1", 20, 2)])
+
+    table = SharedFundTable([MatchFund("fund_1", 10, 1), MatchFund("fund_2", 100, 2)])
+    try:
+        fund_matcher = SharedFundMatcher(table)
+        fund_matcher.reserve_funds(Donation("donation_0", 15))
+        assert table.front == 1
+        assert fund_balances(fund_matcher) == [("fund_1", 0), ("fund_2", 95)]
+
+        with pytest.raises(BadRequestException):
+            fund_matcher.top_up("fund_1", -5)
+        with pytest.raises(BadRequestException):
+            fund_matcher.top_up("no_such_fund", 5)
+        assert table.front == 1
+
+        fund_matcher.top_up("fund_1", 5)
+        assert table.front == 0
+        fund_matcher.reserve_funds(Donation("donation_1", 10))
+        assert [(a.match_fund_id, a.match_fund_allocation) for a in fund_matcher.allocation_state["donation_1"]['allocations']] == \
+            [("fund_1", 5), ("fund_2", 5)]
+        assert table.front == 1
+    finally:
+        table.close()
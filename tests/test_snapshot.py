@@ -0,0 +1,165 @@
+from matcher.fund_matcher import FundMatcher
+from matcher.fund_matcher import COLLECTED, EXPIRED
+from matcher.money import ExactFundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.snapshot import write_snapshot, open_snapshot
+from matcher.write_ahead_log import DurableFundMatcher, SYNC
+
+import pytest
+
+@pytest.fixture
+def fund_matcher(match_funds_with_ratios):
+    """
+    fixture matcher with reserved, collected and expired donations
+    """
+
+    fund_matcher = FundMatcher(match_funds_with_ratios)
+    for ix in range(12):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 15 + ix))
+    fund_matcher.reserve_funds(Donation(42, 10))
+    fund_matcher.collect_donation("donation_1")
+    fund_matcher.expire_donation("donation_2")
+    return fund_matcher
+
+def assert_same_state(expected, actual, compare_times=True):
+    assert [(mf.match_fund_id, mf.total_amount) for mf in actual.get_match_funds_as_list()] == \
+        [(mf.match_fund_id, mf.total_amount) for mf in expected.get_match_funds_as_list()]
+    assert list(actual.allocation_state) == list(expected.allocation_state)
+    for donation_id in expected.allocation_state:
+        actual_doc = actual.allocation_state.to_dict(actual.allocation_state.row(donation_id))
+        expected_doc = expected.allocation_state.to_dict(expected.allocation_state.row(donation_id))
+        if not compare_times:
+            for doc in (actual_doc, expected_doc):
+                del doc['created_time'], doc['updated_time']
+        assert actual_doc == expected_doc
+    assert actual.get_summary() == expected.get_summary()
+
+@pytest.mark.order(801)
+def test_snapshot_round_trip(tmp_path, fund_matcher):
+    """
+    test an opened snapshot has the same balances and allocation state
+    test integer and string donation ids both survive
+    """
+    path = str(tmp_path / "matcher.snap")
+    write_snapshot(fund_matcher, path)
+
+    opened = open_snapshot(path)
+
+    assert_same_state(fund_matcher, opened)
+    assert opened.allocation_state[42]['original_donation'] == 10
+    assert "donation_99" not in opened.allocation_state
+    assert opened.list_match_fund_allocations() == fund_matcher.list_match_fund_allocations()
+
+@pytest.mark.order(802)
+def test_snapshot_serves_new_operations(tmp_path, fund_matcher):
+    """
+    test an opened snapshot accepts reservations, collections and expiries
+    and ends up in the same state as the matcher it was taken from
+    """
+    path = str(tmp_path / "matcher.snap")
+    write_snapshot(fund_matcher, path)
+    opened = open_snapshot(path)
+
+    for matcher in (fund_matcher, opened):
+        matcher.expire_donation("donation_0")
+        matcher.collect_donation("donation_3")
+        matcher.reserve_funds(Donation("donation_new", 25))
+        matcher.expire_donation("donation_new")
+        matcher.reserve_funds(Donation("donation_4", 19))
+
+    assert_same_state(fund_matcher, opened, compare_times=False)
+    assert opened.allocation_state["donation_0"]['overall_status'] == EXPIRED
+    assert opened.allocation_state["donation_3"]['overall_status'] == COLLECTED
+
+    with pytest.raises(BadRequestException):
+        opened.collect_donation("donation_2")
+
+@pytest.mark.order(803)
+def test_snapshot_of_opened_snapshot(tmp_path, fund_matcher):
+    """
+    test a matcher opened from a snapshot can itself be snapshotted
+    """
+    first_path = str(tmp_path / "first.snap")
+    second_path = str(tmp_path / "second.snap")
+
+    write_snapshot(fund_matcher, first_path)
+    opened = open_snapshot(first_path)
+    opened.reserve_funds(Donation("donation_new", 25))
+    write_snapshot(opened, second_path)
+
+    assert_same_state(opened, open_snapshot(second_path))
+
+@pytest.mark.order(804)
+def test_checkpoint_recovery(tmp_path, match_funds_with_ratios):
+    """
+    test recovery from a checkpoint replays only the log written after it
+    """
+    path = str(tmp_path / "matcher.wal")
+    snapshot_path = str(tmp_path / "matcher.snap")
+
+    fund_matcher = DurableFundMatcher(path, match_funds_with_ratios, durability=SYNC, snapshot_path=snapshot_path)
+    for ix in range(10):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 20))
+    fund_matcher.checkpoint()
+    fund_matcher.expire_donation("donation_0")
+    fund_matcher.reserve_funds(Donation("donation_10", 20))
+    fund_matcher.close()
+
+    recovered = DurableFundMatcher(path, durability=SYNC, snapshot_path=snapshot_path)
+
+    assert_same_state(fund_matcher, recovered)
+    assert recovered.generation == 1
+
+    recovered.checkpoint()
+    recovered.close()
+
+    assert_same_state(fund_matcher, DurableFundMatcher(path, durability=SYNC, snapshot_path=snapshot_path))
+
+@pytest.mark.order(805)
+def test_checkpoint_interrupted_before_log_restart(tmp_path, match_funds_with_ratios):
+    """
+    test a log from before the checkpoint is not replayed on top of the snapshot
+    """
+    path = str(tmp_path / "matcher.wal")
+    snapshot_path = str(tmp_path / "matcher.snap")
+
+    fund_matcher = DurableFundMatcher(path, match_funds_with_ratios, durability=SYNC, snapshot_path=snapshot_path)
+    fund_matcher.reserve_funds(Donation("donation_1", 20))
+    fund_matcher.close()
+
+    with open(path, 'rb') as f:
+        old_log = f.read()
+    fund_matcher = DurableFundMatcher(path, durability=SYNC, snapshot_path=snapshot_path)
+    fund_matcher.checkpoint()
+    fund_matcher.close()
+
+    # simulate a crash between writing the snapshot and restarting the log
+    with open(path, 'wb') as f:
+        f.write(old_log)
+
+    recovered = DurableFundMatcher(path, durability=SYNC, snapshot_path=snapshot_path)
+
+    assert recovered.get_match_funds_as_list()[0].total_amount == 80
+    assert list(recovered.allocation_state) == ["donation_1"]
+
+@pytest.mark.order(806)
+def test_snapshot_round_trip_exact(tmp_path, match_funds_with_ratios):
+    """
+    test an exact matcher reopens with the balances it had, in minor units, and serves on from them
+    """
+    path = str(tmp_path / "matcher.snap")
+    fund_matcher = ExactFundMatcher(match_funds_with_ratios)
+    for ix in range(8):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, 12.34 + ix))
+    fund_matcher.expire_donation("donation_3")
+    write_snapshot(fund_matcher, path)
+
+    opened = open_snapshot(path, ExactFundMatcher)
+
+    assert_same_state(fund_matcher, opened)
+    assert all(isinstance(mf.total_amount, int) for mf in opened.get_match_funds_as_list())
+
+    for target in (fund_matcher, opened):
+        target.reserve_funds(Donation("donation_new", 33.33))
+    assert_same_state(fund_matcher, opened, compare_times=False)
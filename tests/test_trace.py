@@ -0,0 +1,122 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher, RESERVED
+from matcher.concurrent_fund_matcher import ConcurrentFundMatcher
+from matcher.money import ExactFundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.write_ahead_log import encode_record
+from matcher.trace import RecordingFundMatcher, read_trace, replay, main, RESERVE, EXPIRE, CPROFILE, TRACEMALLOC
+
+import os
+import random
+import time
+import pytest
+
+def record_operations(fund_matcher, path):
+    rng = random.Random(9)
+    with RecordingFundMatcher(fund_matcher, path) as recorder:
+        for ix in range(60):
+            recorder.reserve_funds(Donation("donation_%s" % ix, round(rng.uniform(5, 30), 2)))
+            earlier = "donation_%s" % rng.randrange(ix + 1)
+            if recorder.donation_status(earlier) == RESERVED:
+                if rng.random() < 0.3:
+                    recorder.expire_donation(earlier)
+                else:
+                    recorder.collect_donation(earlier)
+        with pytest.raises(BadRequestException):
+            recorder.expire_donation("no_such_donation")
+        with pytest.raises(BadRequestException):
+            recorder.reserve_funds(Donation("donation_0", 99))
+    return recorder
+
+@pytest.mark.order(2001)
+@pytest.mark.parametrize("matcher_class", [FundMatcher, ExactFundMatcher, ConcurrentFundMatcher])
+def test_replay_rebuilds_recorded_state(tmp_path, match_funds_with_ratios, matcher_class):
+    """
+    test a recorded trace holds the match funds and every call, rejected ones included
+    test replaying it, on any matcher, rebuilds the recorded state
+    """
+    path = str(tmp_path / "matcher.trace")
+    record_operations(FundMatcher(match_funds_with_ratios), path)
+
+    match_funds, calls, state = read_trace(path)
+    assert [(mf.match_fund_id, mf.total_amount) for mf in match_funds] == \
+        [("fund_3", 100.0), ("fund_1", 100.0), ("fund_2", 100.0)]
+    assert calls[0][0] == RESERVE and calls[0][4] == "donation_0"
+    assert calls[-2][0] == EXPIRE and calls[-2][3]
+    assert all(later[1] >= earlier[1] for earlier, later in zip(calls, calls[1:]))
+    assert state['donations'] == 60
+
+    # the exact engine rounds each allocation to the penny
+    tolerance = 0.01 if matcher_class is ExactFundMatcher else 1e-6
+    result = replay(path, matcher_class, tolerance=tolerance)
+    assert result['calls'] == len(calls)
+    assert result['mismatches'] == []
+    assert isinstance(result['fund_matcher'], matcher_class)
+
+@pytest.mark.order(2002)
+def test_replay_finds_mismatches(tmp_path, match_funds_with_ratios):
+    """
+    test replaying against other funds reports the calls and balances that differ
+    test a trace cut off before it was closed replays, without a state to compare
+    """
+    path = str(tmp_path / "matcher.trace")
+    record_operations(FundMatcher(match_funds_with_ratios), path)
+
+    result = replay(path, lambda match_funds: FundMatcher([MatchFund("fund_3", 10.00, 1)]))
+    assert any(mismatch.startswith("Match fund fund_1 balance") for mismatch in result['mismatches'])
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    result = replay(path)
+    assert result['mismatches'] == ["Trace was not closed, so has no recorded state"]
+
+    with pytest.raises(BadRequestException):
+        RecordingFundMatcher(result['fund_matcher'], str(tmp_path / "second.trace"))
+    with pytest.raises(BadRequestException):
+        replay(path, profile="perf")
+
+@pytest.mark.order(2003)
+def test_replay_pace_and_profiles(tmp_path, match_funds_with_ratios, capsys):
+    """
+    test a replay at the original pace takes as long as the recording
+    test a replay can report a cProfile or tracemalloc profile, from the command line too
+    """
+    path = str(tmp_path / "matcher.trace")
+    with RecordingFundMatcher(FundMatcher(match_funds_with_ratios), path) as recorder:
+        recorder.reserve_funds(Donation("donation_0", 20))
+        time.sleep(0.1)
+        recorder.expire_donation("donation_0")
+
+    assert replay(path)['elapsed'] < 0.1
+    assert replay(path, speed=1)['elapsed'] >= 0.1
+    assert replay(path, speed=4)['elapsed'] < 0.1
+
+    assert "reserve_funds" in replay(path, profile=CPROFILE)['profile']
+    assert replay(path, profile=TRACEMALLOC)['profile'].startswith("peak")
+
+    assert main([path, "--matcher", "exact", "--profile", CPROFILE]) == 0
+    assert "2 calls" in capsys.readouterr().out
+    assert main([os.path.join(str(tmp_path), "missing.trace")]) == 2
+
+@pytest.mark.order(2004)
+def test_read_trace_rejects_other_files(tmp_path, match_funds_with_ratios):
+    """
+    test a file that does not start with match funds is not read as a trace, on the command line too
+    test a record of an unknown type is rejected rather than skipped
+    """
+    path = str(tmp_path / "empty.trace")
+    open(path, 'wb').close()
+    with pytest.raises(BadRequestException):
+        read_trace(path)
+    assert main([path]) == 2
+
+    path = str(tmp_path / "matcher.trace")
+    with RecordingFundMatcher(FundMatcher(match_funds_with_ratios), path) as recorder:
+        recorder.reserve_funds(Donation("donation_0", 20))
+    with open(path, 'ab') as f:
+        f.write(encode_record(99, b"{}"))
+    with pytest.raises(BadRequestException):
+        read_trace(path)
@@ -0,0 +1,56 @@
+from matcher.validation import parse_floats, validate_donations, validate_match_funds, match_funds_from_columns
+from matcher.validation import VALID, INVALID_AMOUNT, AMOUNT_TOO_SMALL, AMOUNT_TOO_HIGH
+from matcher.validation import NEGATIVE_TOTAL_AMOUNT, INVALID_MATCH_ORDER, INVALID_MATCH_RATIO
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+
+import numpy as np
+import pytest
+
+@pytest.mark.order(1301)
+def test_validate_donations():
+    """
+    test text, numeric and mixed columns are parsed without raising
+    test the mask and error codes agree with validating one Donation at a time
+    """
+    text = ["20", " 5.00 ", "4.99", "25000", "25000.01", "2.5e1", "", "abc", "nan", "inf", "1.2.3", "--5", "1e", "+7"]
+    amounts, valid, codes = validate_donations(text)
+
+    assert codes.tolist() == [VALID, VALID, AMOUNT_TOO_SMALL, VALID, AMOUNT_TOO_HIGH, VALID, INVALID_AMOUNT,
+                              INVALID_AMOUNT, INVALID_AMOUNT, INVALID_AMOUNT, INVALID_AMOUNT, INVALID_AMOUNT,
+                              INVALID_AMOUNT, VALID]
+    assert valid.tolist() == [code == VALID for code in codes.tolist()]
+    assert amounts[valid].tolist() == [20.0, 5.0, 25000.0, 25.0, 7.0]
+
+    for value, ok in zip(text, valid.tolist()):
+        try:
+            Donation("donation", float(value))
+            accepted = value.strip().lower() not in ("nan", "inf")
+        except (BadRequestException, ValueError):
+            accepted = False
+        assert accepted == ok
+
+    mixed = parse_floats([10, None, "12.5", 7.5, True, float("inf")])
+    assert np.array_equal(mixed, [10.0, np.nan, 12.5, 7.5, np.nan, np.nan], equal_nan=True)
+    assert validate_donations(np.array([4, 5, 6]))[2].tolist() == [AMOUNT_TOO_SMALL, VALID, VALID]
+
+@pytest.mark.order(1302)
+def test_validate_match_funds():
+    """
+    test amounts, orders and ratio shapes are checked per row, text ratios included
+    test only the valid rows become MatchFunds
+    """
+    match_funds, valid, codes = match_funds_from_columns(
+        ["fund_1", "fund_2", "fund_3", "fund_4", "fund_5", "fund_6", "fund_7"],
+        ["100", "-1", "x", 50, 20, 30, "40"],
+        [3, 1, 2, 1.5, 4, 5, "7"],
+        ["2:1", [1, 1], [1, 1], [1, 1], "1:0", [1, 2, 3], (1.5, "1")])
+
+    assert codes.tolist() == [VALID, NEGATIVE_TOTAL_AMOUNT, INVALID_AMOUNT, INVALID_MATCH_ORDER,
+                              INVALID_MATCH_RATIO, INVALID_MATCH_RATIO, VALID]
+    assert valid.tolist() == [True, False, False, False, False, False, True]
+    assert [(mf.match_fund_id, mf.total_amount, mf.match_order, mf.matching_ratio) for mf in match_funds] == \
+        [("fund_1", 100.0, 3, [2, 1]), ("fund_7", 40.0, 7, [1.5, 1])]
+
+    with pytest.raises(BadRequestException):
+        validate_match_funds([1, 2], [1], [[1, 1], [1, 1]])
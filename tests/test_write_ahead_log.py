@@ -0,0 +1,244 @@
+from matcher.match_fund import MatchFund
+from matcher.fund_matcher import FundMatcher
+from matcher.donation import Donation
+from matcher.exceptions import BadRequestException
+from matcher.write_ahead_log import DurableFundMatcher, WriteAheadLog, read_records
+from matcher.write_ahead_log import SYNC, GROUP, ASYNC, RESERVE
+
+import random
+import threading
+import pytest
+
+def run_operations(fund_matcher):
+    rng = random.Random(3)
+    for ix in range(40):
+        fund_matcher.reserve_funds(Donation("donation_%s" % ix, rng.uniform(5, 30)))
+    fund_matcher.reserve_funds_batch([Donation("batch_%s" % ix, rng.uniform(5, 30)) for ix in range(10)])
+    for ix in range(0, 40, 3):
+        fund_matcher.expire_donation("donation_%s" % ix)
+    for ix in range(1, 40, 3):
+        fund_matcher.collect_donation("donation_%s" % ix)
+    fund_matcher.expire_donations(["batch_%s" % ix for ix in range(0, 10, 2)])
+    fund_matcher.collect_donations(["batch_1", "batch_3", "donation_1"], atomic=False)
+
+def assert_same_state(expected, actual):
+    assert [(mf.match_fund_id, mf.total_amount) for mf in actual.get_match_funds_as_list()] == \
+        [(mf.match_fund_id, mf.total_amount) for mf in expected.get_match_funds_as_list()]
+    assert [key[2] for key in actual._active_funds] == [key[2] for key in expected._active_funds]
+    assert list(actual.allocation_state) == list(expected.allocation_state)
+    for donation_id in expected.allocation_state:
+        expected_row = expected.allocation_state.row(donation_id)
+        actual_row = actual.allocation_state.row(donation_id)
+        assert actual.allocation_state.to_dict(actual_row) == expected.allocation_state.to_dict(expected_row)
+
+@pytest.mark.order(701)
+@pytest.mark.parametrize("durability", [SYNC, GROUP, ASYNC])
+def test_recovery_rebuilds_state_exactly(tmp_path, match_funds_with_ratios, durability):
+    """
+    test replaying the log rebuilds balances and allocation state, timestamps included
+    """
+    path = str(tmp_path / "matcher.wal")
+
+    fund_matcher = DurableFundMatcher(path, match_funds_with_ratios, durability=durability)
+    run_operations(fund_matcher)
+    fund_matcher.close()
+
+    recovered = DurableFundMatcher(path, durability=durability)
+
+    assert_same_state(fund_matcher, recovered)
+
+    recovered.reserve_funds(Donation("after_restart", 20))
+    recovered.close()
+
+    assert "after_restart" in DurableFundMatcher(path).allocation_state
+
+@pytest.mark.order(702)
+def test_recovery_cuts_off_torn_record(tmp_path, match_funds_with_ratios):
+    """
+    test a partially written last record is dropped and the log stays appendable
+    """
+    path = str(tmp_path / "matcher.wal")
+
+    fund_matcher = DurableFundMatcher(path, match_funds_with_ratios, durability=SYNC)
+    fund_matcher.reserve_funds(Donation("donation_1", 50))
+    fund_matcher.reserve_funds(Donation("donation_2", 50))
+    fund_matcher.close()
+
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 3)
+
+    recovered = DurableFundMatcher(path, durability=SYNC)
+
+    assert list(recovered.allocation_state) == ["donation_1"]
+    assert recovered.get_match_funds_as_list()[0].total_amount == 50
+
+    recovered.reserve_funds(Donation("donation_3", 10))
+    recovered.close()
+
+    records, _ = read_records(path)
+    assert [record_type for record_type, _ in records[1:]] == [RESERVE, RESERVE]
+
+@pytest.mark.order(703)
+def test_failed_operations_are_not_logged(tmp_path, match_funds_with_ratios):
+    """
+    test a rejected request leaves no record to replay
+    test a retried reservation is not logged again
+    """
+    path = str(tmp_path / "matcher.wal")
+
+    fund_matcher = DurableFundMatcher(path, match_funds_with_ratios, durability=SYNC)
+    with pytest.raises(BadRequestException):
+        fund_matcher.collect_donation("donation_1")
+    fund_matcher.reserve_funds(Donation("donation_2", 10))
+    fund_matcher.reserve_funds(Donation("donation_2", 10))
+    fund_matcher.reserve_funds_batch([Donation("donation_2", 10), Donation("donation_3", 10), Donation("donation_3", 10)])
+    with pytest.raises(BadRequestException):
+        fund_matcher.reserve_funds(Donation("donation_2", 20))
+    fund_matcher.close()
+
+    records, _ = read_records(path)
+    assert [record_type for record_type, _ in records[1:]] == [RESERVE, RESERVE]
+
+    recovered = DurableFundMatcher(path)
+    assert_same_state(fund_matcher, recovered)
+    recovered.close()
+
+@pytest.mark.order(704)
+def test_new_log_needs_match_funds(tmp_path):
+    with pytest.raises(BadRequestException):
+        DurableFundMatcher(str(tmp_path / "matcher.wal"))
+
+@pytest.mark.order(705)
+def test_group_commit_shares_fsyncs(tmp_path, match_funds_with_ratios):
+    """
+    test concurrent committers are made durable by fewer fsyncs than operations
+    """
+    path = str(tmp_path / "matcher.wal")
+    funds = [MatchFund("fund_%s" % ix, 100000.00, ix) for ix in range(5)]
+    fund_matcher = DurableFundMatcher(path, funds, durability=GROUP)
+
+    def worker(thread_ix):
+        for ix in range(50):
+            fund_matcher.reserve_funds(Donation("donation_%s_%s" % (thread_ix, ix), 10))
+
+    threads = [threading.Thread(target=worker, args=(ix,)) for ix in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    fund_matcher.close()
+
+    assert fund_matcher.log.fsync_count < 8 * 50
+    assert len(DurableFundMatcher(path).allocation_state) == 8 * 50
+
+@pytest.mark.order(706)
+def test_recovery_replays_fund_registry_changes(tmp_path, match_funds_with_ratios):
+    """
+    test added, topped up, reordered and retired funds are rebuilt by replay
+    test a retired fund stays retired across a checkpoint
+    """
+    path = str(tmp_path / "matcher.wal")
+    snapshot_path = str(tmp_path / "matcher.snap")
+
+    fund_matcher = DurableFundMatcher(path, match_funds_with_ratios, durability=SYNC, snapshot_path=snapshot_path)
+    run_operations(fund_matcher)
+    fund_matcher.add_match_fund(MatchFund("fund_4", 80.00, 0, [3, 1]))
+    fund_matcher.top_up("fund_2", 40)
+    fund_matcher.reorder_match_fund("fund_2", 0)
+    fund_matcher.reserve_funds(Donation("after_changes", 30))
+    fund_matcher.retire_match_fund("fund_4")
+    fund_matcher.close()
+
+    recovered = DurableFundMatcher(path, snapshot_path=snapshot_path)
+    assert_same_state(fund_matcher, recovered)
+    assert recovered.is_retired("fund_4")
+
+    recovered.checkpoint()
+    recovered.expire_donation("after_changes")
+    recovered.close()
+
+    after_checkpoint = DurableFundMatcher(path, snapshot_path=snapshot_path)
+    assert_same_state(recovered, after_checkpoint)
+    assert after_checkpoint.is_retired("fund_4")
+    assert "fund_4" not in [key[2] for key in after_checkpoint._active_funds]
+
+@pytest.mark.order(707)
+def test_recovery_with_backfill(tmp_path, match_funds_with_ratios):
+    """
+    test backfilled allocations are rebuilt by replay, and across a checkpoint, without being logged
+    """
+    path = str(tmp_path / "matcher.wal")
+    snapshot_path = str(tmp_path / "matcher.snap")
+
+    fund_matcher = DurableFundMatcher(path, match_funds_with_ratios, durability=SYNC, snapshot_path=snapshot_path,
+                                      backfill=True)
+    run_operations(fund_matcher)
+    fund_matcher.top_up("fund_2", 40)
+    fund_matcher.close()
+
+    recovered = DurableFundMatcher(path, snapshot_path=snapshot_path, backfill=True)
+    assert_same_state(fund_matcher, recovered)
+    # reserved once the funds had run dry, then backfilled by the expiries and the top up
+    assert len(recovered.get_allocation("donation_19")['allocations']) == 3
+
+    recovered.checkpoint()
+    recovered.expire_donation("donation_2")
+    # backfilled from as it is added, so logged with the amount it was given
+    recovered.add_match_fund(MatchFund("fund_4", 60.00, 0, [1, 1]))
+    assert recovered.get_fund_summary("fund_4")['reserved'] > 0
+    recovered.close()
+
+    after_checkpoint = DurableFundMatcher(path, snapshot_path=snapshot_path, backfill=True)
+    assert_same_state(recovered, after_checkpoint)
+
+@pytest.mark.order(708)
+def test_checkpoint_between_append_and_commit(tmp_path, match_funds_with_ratios):
+    """
+    test an operation commits on the log it appended to, when a checkpoint replaces the log in between
+    test operations and checkpoints racing from many threads all complete and recover
+    """
+    path = str(tmp_path / "matcher.wal")
+    snapshot_path = str(tmp_path / "matcher.snap")
+    funds = [MatchFund("fund_%s" % ix, 100000.00, ix) for ix in range(5)]
+    fund_matcher = DurableFundMatcher(path, funds, durability=GROUP, snapshot_path=snapshot_path)
+
+    class CheckpointOnRelease(object):
+        # lets go of the matcher lock, then checkpoints before the operation goes on to commit
+        def __init__(self, lock):
+            self.lock = lock
+            self.pending = True
+
+        def __enter__(self):
+            self.lock.acquire()
+
+        def __exit__(self, *exc_info):
+            self.lock.release()
+            if self.pending:
+                self.pending = False
+                fund_matcher.checkpoint()
+
+    fund_matcher._lock = CheckpointOnRelease(fund_matcher._lock)
+    reserving = threading.Thread(target=fund_matcher.reserve_funds, args=(Donation("donation_0", 10),), daemon=True)
+    reserving.start()
+    reserving.join(5)
+    assert not reserving.is_alive()
+    fund_matcher._lock = fund_matcher._lock.lock
+
+    def worker(thread_ix):
+        for ix in range(50):
+            fund_matcher.reserve_funds(Donation("donation_%s_%s" % (thread_ix, ix), 10))
+
+    def checkpoints():
+        for _ in range(10):
+            fund_matcher.checkpoint()
+
+    threads = [threading.Thread(target=worker, args=(ix,), daemon=True) for ix in range(4)]
+    threads.append(threading.Thread(target=checkpoints, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(20)
+    assert not any(thread.is_alive() for thread in threads)
+    fund_matcher.close()
+
+    assert len(DurableFundMatcher(path, snapshot_path=snapshot_path).allocation_state) == 4 * 50 + 1